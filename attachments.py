@@ -0,0 +1,190 @@
+import os
+import time
+import socket
+import hashlib
+import string
+
+from protocol import UPLOAD, CHUNK, OFFSET, FETCH, FrameDecoder, ProtocolError, encode_frame, encode_header
+
+CHUNK_SIZE = 256 * 1024
+MAX_ATTACHMENT = 4 * 1024 * 1024 * 1024
+
+
+def is_digest(digest):
+    return len(digest) == 64 and all(c in string.hexdigits.lower() for c in digest)
+
+
+def hash_file(hasher, path, block=1024 * 1024):
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                return size
+            hasher.update(data)
+            size += len(data)
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    hash_file(hasher, path)
+    return hasher.hexdigest()
+
+
+class AttachmentStore:
+    # files are named by their sha256, so the same upload is only ever stored once
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def part_path(self, digest):
+        return self.path(digest) + ".part"
+
+    def size(self, digest):
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return None
+
+
+class Upload:
+    def __init__(self, store, digest, size):
+        self.store = store
+        self.digest = digest
+        self.size = size
+        self.part = store.part_path(digest)
+        os.makedirs(os.path.dirname(self.part), exist_ok=True)
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.file = None
+
+    def resume(self):
+        # blocking: the bytes already on disk have to go through the hash again
+        if os.path.exists(self.part):
+            self.offset = hash_file(self.hasher, self.part)
+            if self.offset > self.size:
+                os.remove(self.part)
+                self.hasher = hashlib.sha256()
+                self.offset = 0
+        self.file = open(self.part, "ab")
+        return self.offset
+
+    def write(self, offset, data):
+        if self.file is None:
+            raise ProtocolError("chunk before the upload was resumed")
+        if offset != self.offset:
+            raise ProtocolError(f"chunk at {offset}, expected {self.offset}")
+        if offset + len(data) > self.size:
+            raise ProtocolError("chunk past the end of the upload")
+        self.file.write(data)
+        self.hasher.update(data)
+        self.offset += len(data)
+        return self.offset == self.size
+
+    def finish(self):
+        self.file.close()
+        if self.hasher.hexdigest() != self.digest:
+            os.remove(self.part)
+            return False
+        os.replace(self.part, self.store.path(self.digest))
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def receive(sock, decoder):
+    while True:
+        yield from decoder.frames()
+        n = sock.recv_into(decoder.writable())
+        if not n:
+            raise ConnectionError("relay closed the connection")
+        decoder.advance(n)
+
+
+class TransferClient:
+    # blocking and meant for a worker thread; every transfer gets its own connection so a
+    # large file never queues behind, or in front of, chat traffic
+    def __init__(self, host, port, store, retries=5, timeout=30.0):
+        self.host, self.port = host, port
+        self.store = store
+        self.retries = retries
+        self.timeout = timeout
+
+    def retry(self, transfer):
+        for attempt in range(self.retries):
+            try:
+                return transfer()
+            except (OSError, ProtocolError) as e:
+                if attempt == self.retries - 1:
+                    raise
+                print(f"Transfer error: {e}, resuming")
+                time.sleep(min(0.2 * 2 ** attempt, 5.0))
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return sock, receive(sock, FrameDecoder(CHUNK_SIZE + 1024))
+
+    def upload(self, path, progress=None):
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        if size > MAX_ATTACHMENT:
+            raise ValueError(f"{path} is larger than {MAX_ATTACHMENT} bytes")
+        self.retry(lambda: self.upload_once(path, digest, size, progress))
+        return digest
+
+    def upload_once(self, path, digest, size, progress):
+        sock, frames = self.connect()
+        with sock:
+            sock.sendall(encode_frame(UPLOAD, 0, 0, size, payload=digest.encode("ascii")))
+            reply = next(frames)
+            offset = reply.msg_id
+            if offset < size:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while offset < size:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            raise ValueError(f"{path} changed during upload")
+                        sock.sendall(encode_header(CHUNK, 0, 0, offset, 0, len(data)))
+                        sock.sendall(data)
+                        offset += len(data)
+                        if progress is not None:
+                            progress(offset, size)
+                reply = next(frames)
+            if reply.kind != OFFSET or reply.msg_id != size:
+                raise ValueError(f"relay rejected upload {digest}")
+
+    def download(self, digest, progress=None):
+        if not is_digest(digest):
+            raise ValueError(f"bad attachment digest {digest!r}")
+        path = self.store.path(digest)
+        if not os.path.exists(path):
+            self.retry(lambda: self.download_once(digest, progress))
+        return path
+
+    def download_once(self, digest, progress):
+        part = self.store.part_path(digest)
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        hasher = hashlib.sha256()
+        offset = hash_file(hasher, part) if os.path.exists(part) else 0
+        sock, frames = self.connect()
+        with sock, open(part, "ab") as f:
+            sock.sendall(encode_frame(FETCH, 0, 0, offset, payload=digest.encode("ascii")))
+            size = next(frames).msg_id
+            while offset < size:
+                frame = next(frames)
+                if frame.kind != CHUNK or frame.msg_id != offset:
+                    raise ProtocolError(f"unexpected frame {frame.kind} at {frame.msg_id}")
+                f.write(frame.payload)
+                hasher.update(frame.payload)
+                offset += len(frame.payload)
+                if progress is not None:
+                    progress(offset, size)
+        if hasher.hexdigest() != digest:
+            os.remove(part)
+            raise ValueError(f"attachment {digest} is missing or corrupt")
+        os.replace(part, self.store.path(digest))
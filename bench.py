@@ -0,0 +1,1602 @@
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import itertools
+import argparse
+import subprocess
+
+from protocol import HEADER, HEADER_SIZE, LENGTH_SIZE, HELLO, MESSAGE, FrameDecoder, encode_frame
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"relay did not start on {host}:{port}")
+
+
+def start_relay(port, *extra):
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "relay.py"), "--port", str(port), *extra])
+    wait_for_port("localhost", port)
+    return proc
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(title, rows):
+    print(title)
+    for name, value in rows:
+        print(f"  {name:<32}{value}")
+
+
+async def relay_load(host, port, clients, messages):
+    conns = []
+    for user_id in range(1, clients + 1):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode_frame(HELLO, user_id, 0))
+        conns.append((user_id, reader, writer))
+    await asyncio.sleep(0.2)
+
+    total = clients * messages
+    latencies = []
+    done = asyncio.Event()
+
+    async def receive(reader):
+        while True:
+            try:
+                header = await reader.readexactly(HEADER_SIZE)
+                payload = await reader.readexactly(HEADER.unpack(header)[0] + LENGTH_SIZE - HEADER_SIZE)
+            except asyncio.IncompleteReadError:
+                return
+            latencies.append(time.perf_counter_ns() - int(payload))
+            if len(latencies) >= total:
+                done.set()
+
+    async def send(user_id, writer):
+        for _ in range(messages):
+            receiver_id = random.randint(1, clients - 1)
+            if receiver_id >= user_id:
+                receiver_id += 1
+            writer.write(encode_frame(MESSAGE, user_id, receiver_id, payload=b"%d" % time.perf_counter_ns()))
+            await writer.drain()
+
+    receivers = [asyncio.create_task(receive(reader)) for _, reader, _ in conns]
+    start = time.perf_counter()
+    await asyncio.gather(*(send(user_id, writer) for user_id, _, writer in conns))
+    try:
+        await asyncio.wait_for(done.wait(), timeout=60)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    for _, _, writer in conns:
+        writer.close()
+    for task in receivers:
+        task.cancel()
+    return total, latencies, elapsed
+
+
+def bench_relay(args):
+    proc = None
+    port = args.port
+    if port is None:
+        port = free_port()
+        proc = start_relay(port)
+    try:
+        total, latencies, elapsed = asyncio.run(relay_load(args.host, port, args.clients, args.messages))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report(f"relay load: {args.clients} clients x {args.messages} messages", [
+        ("sent", total),
+        ("delivered", len(latencies)),
+        ("messages/sec", f"{len(latencies) / elapsed:,.0f}"),
+        ("p50 latency (ms)", f"{percentile(latencies, 50) / 1e6:.2f}"),
+        ("p99 latency (ms)", f"{percentile(latencies, 99) / 1e6:.2f}"),
+    ])
+
+
+def text_frames(messages):
+    return b"".join(f"user{i % 100}:{text}\n".encode("utf-8") for i, text in enumerate(messages))
+
+
+def decode_text(stream, chunk):
+    count = 0
+    buffer = b""
+    for pos in range(0, len(stream), chunk):
+        buffer += stream[pos:pos + chunk]
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            username, message = line.decode("utf-8").split(":", 1)
+            count += 1
+    return count
+
+
+def binary_frames(messages):
+    return b"".join(encode_frame(MESSAGE, i % 100, 1, i, 0, text.encode("utf-8")) for i, text in enumerate(messages))
+
+
+def decode_binary(stream, chunk):
+    count = 0
+    decoder = FrameDecoder()
+    view = memoryview(stream)
+    for pos in range(0, len(stream), chunk):
+        data = view[pos:pos + chunk]
+        target = decoder.writable()
+        while len(target) < len(data):
+            target[:] = data[:len(target)]
+            decoder.advance(len(target))
+            data = data[len(target):]
+            for frame in decoder.frames():
+                frame.text()
+                count += 1
+            target = decoder.writable()
+        target[:len(data)] = data
+        decoder.advance(len(data))
+        for frame in decoder.frames():
+            frame.text()
+            count += 1
+    return count
+
+
+def bench_framing(args):
+    rng = random.Random(1)
+    messages = ["x" * rng.randint(1, args.size * 2) for _ in range(args.messages)]
+    rows = []
+    for name, encode, decode in (("text", text_frames, decode_text), ("binary", binary_frames, decode_binary)):
+        start = time.perf_counter()
+        stream = encode(messages)
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        count = decode(stream, args.chunk)
+        decode_time = time.perf_counter() - start
+        assert count == len(messages), (name, count)
+        rows.append((f"{name} encode msgs/sec", f"{len(messages) / encode_time:,.0f}"))
+        rows.append((f"{name} decode msgs/sec", f"{len(messages) / decode_time:,.0f}"))
+        rows.append((f"{name} decode MB/sec", f"{len(stream) / decode_time / 1e6:,.1f}"))
+    report(f"framing: {args.messages} messages, ~{args.size} B each, {args.chunk} B reads", rows)
+
+
+def bench_inserts(args):
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from database import Database
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "per-row.db"))
+        start = time.perf_counter()
+        for i in range(args.messages):
+            db.add_message(1, 2, f"message {i}")
+        rows.append(("per-row commit", f"{args.messages / (time.perf_counter() - start):,.0f} inserts/sec"))
+        db.close()
+
+        db = Database(os.path.join(tmp, "group.db"), group_commit=True,
+                      batch_size=args.batch_size, flush_interval=args.flush_ms / 1000)
+        start = time.perf_counter()
+        futures = [db.add_message_async(1, 2, f"message {i}") for i in range(args.messages)]
+        ids = [f.result() for f in futures]
+        rows.append(("group commit", f"{args.messages / (time.perf_counter() - start):,.0f} inserts/sec"))
+        assert ids == sorted(set(ids)) and len(ids) == args.messages
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(lambda i: db.add_message(1, 2, f"message {i}"), range(args.messages)))
+        rows.append((f"group, {args.threads} blocking", f"{args.messages / (time.perf_counter() - start):,.0f} inserts/sec"))
+        db.close()
+    report(f"inserts: {args.messages} messages, batch {args.batch_size} / {args.flush_ms} ms", rows)
+
+
+def bench_chat_open(args):
+    import tempfile
+    from database import Database, INSERT_MESSAGE, conversation_key
+    rng = random.Random(1)
+
+    def synthetic(count):
+        for i in range(count):
+            sender_id = rng.randint(1, args.users)
+            receiver_id = rng.randint(1, args.users)
+            yield sender_id, receiver_id, f"synthetic message {i}", conversation_key(sender_id, receiver_id), None
+
+    legacy_query = """
+        SELECT * FROM messages
+        WHERE (sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)
+        ORDER BY timestamp
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "chat-open.db"))
+        start = time.perf_counter()
+        for done in range(0, args.messages, 100000):
+            db.conn.executemany(INSERT_MESSAGE, synthetic(min(100000, args.messages - done)))
+            db.conn.commit()
+        print(f"generated {args.messages:,} messages in {time.perf_counter() - start:.1f}s")
+        pairs = [(rng.randint(1, args.users), rng.randint(1, args.users)) for _ in range(args.opens)]
+        rows = []
+        for name, open_chat in (
+            ("legacy OR + sort", lambda a, b: db.conn.execute(legacy_query, (a, b, b, a)).fetchall()),
+            ("conversation index", db.get_messages),
+        ):
+            timings = []
+            for a, b in pairs[:args.legacy_opens] if name.startswith("legacy") else pairs:
+                t = time.perf_counter()
+                open_chat(a, b)
+                timings.append(time.perf_counter() - t)
+            rows.append((f"{name} p50 (ms)", f"{percentile(timings, 50) * 1000:.2f}"))
+            rows.append((f"{name} p99 (ms)", f"{percentile(timings, 99) * 1000:.2f}"))
+        db.close()
+    report(f"chat open: {args.messages:,} messages across {args.users} users", rows)
+
+
+def bench_search(args):
+    import tempfile
+    from database import Database, INSERT_MESSAGE, conversation_key
+    rng = random.Random(1)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+                  for _ in range(args.vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def synthetic(count):
+        for _ in range(count):
+            sender_id = rng.randint(1, args.users)
+            receiver_id = rng.randint(1, args.users)
+            text = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=8))
+            yield sender_id, receiver_id, text, conversation_key(sender_id, receiver_id), None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "search.db"))
+        start = time.perf_counter()
+        for done in range(0, args.messages, 100000):
+            db.conn.executemany(INSERT_MESSAGE, synthetic(min(100000, args.messages - done)))
+            db.conn.commit()
+        print(f"generated and indexed {args.messages:,} messages in {time.perf_counter() - start:.1f}s")
+        rows = []
+        for name, pool in (("common term", vocabulary[:20]), ("rare term", vocabulary[-500:]),
+                           ("two terms", [f"{a} {b}" for a, b in zip(vocabulary[:50], vocabulary[50:100])]),
+                           ("prefix", [word[:3] for word in vocabulary[100:150]])):
+            timings = []
+            for _ in range(args.queries):
+                query = rng.choice(pool)
+                t = time.perf_counter()
+                db.search_messages(rng.randint(1, args.users), query, 50)
+                timings.append(time.perf_counter() - t)
+            rows.append((f"{name} p50 (ms)", f"{percentile(timings, 50) * 1000:.2f}"))
+            rows.append((f"{name} p99 (ms)", f"{percentile(timings, 99) * 1000:.2f}"))
+        db.close()
+    report(f"search: {args.messages:,} messages, {args.users} users", rows)
+
+
+class CountingTransport:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    def is_closing(self):
+        return False
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def writelines(self, chunks):
+        for data in chunks:
+            self.write(data)
+
+    def close(self):
+        pass
+
+
+def bench_routing(args):
+    from relay import Relay, RelayProtocol
+    from protocol import encode_ids
+    rng = random.Random(1)
+    relay = Relay()
+    conns = []
+    start = time.perf_counter()
+    for user_id in range(1, args.users + 1):
+        conn = RelayProtocol(relay)
+        conn.connection_made(CountingTransport())
+        contacts = rng.sample(range(1, args.users + 1), args.contacts)
+        for frame in FrameDecoder(1024).feed(encode_frame(HELLO, user_id, 0, payload=encode_ids(contacts))):
+            relay.route(conn, frame)
+        conns.append(conn)
+    connect_time = time.perf_counter() - start
+
+    frames = []
+    for _ in range(args.messages):
+        sender, receiver = rng.sample(conns, 2)
+        frames.append((sender, encode_frame(MESSAGE, sender.user_id, receiver.user_id, payload=b"x" * 100)))
+    decoded = [(conn, next(FrameDecoder(len(data)).feed(data))) for conn, data in frames]
+
+    start = time.perf_counter()
+    for conn, frame in decoded:
+        relay.route(conn, frame)
+    routed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for conn, frame in decoded[:args.broadcast_messages]:
+        data = bytes(frame.raw)
+        for target in conns:
+            if target is not conn:
+                target.transport.write(data)
+    broadcast = (time.perf_counter() - start) / min(args.broadcast_messages, len(decoded)) * len(decoded)
+
+    start = time.perf_counter()
+    for conn in conns[:args.churn]:
+        relay.unregister(conn)
+        # the same object stands in for the reconnected client, which starts without an identity
+        user_id, conn.user_id = conn.user_id, None
+        for frame in FrameDecoder(1024).feed(encode_frame(HELLO, user_id, 0)):
+            relay.route(conn, frame)
+    churn = time.perf_counter() - start
+
+    report(f"routing: {args.users:,} connected users, {args.contacts} contacts each", [
+        ("register + subscribe (us/user)", f"{connect_time / args.users * 1e6:.1f}"),
+        ("routed delivery (us/msg)", f"{routed / args.messages * 1e6:.2f}"),
+        ("broadcast delivery (us/msg)", f"{broadcast / args.messages * 1e6:.2f}"),
+        ("presence churn (us/event)", f"{churn / max(1, args.churn) * 1e6:.1f}"),
+        ("relay delivered", relay.delivered),
+    ])
+
+
+def bench_resync(args):
+    import threading
+    from PyQt6.QtCore import Qt
+    from messanger import ClientSocket, CONNECTED
+    port = free_port()
+    proc = start_relay(port)
+    rng = random.Random(1)
+    lock = threading.Lock()
+    received = {}
+    receiver_ids = list(range(args.senders + 1, args.senders + args.receivers + 1))
+
+    def connect(user_id, last_seen=0):
+        client = ClientSocket("localhost", port, user_id, last_seen)
+        # no event loop here, so deliver on the receive thread instead of queueing to the main thread
+        client.message_received.connect(lambda sender_id, text: record(user_id, text),
+                                        Qt.ConnectionType.DirectConnection)
+        connected = threading.Event()
+        client.state_changed.connect(lambda state: state == CONNECTED and connected.set(),
+                                     Qt.ConnectionType.DirectConnection)
+        client.connect_to_server()
+        if not connected.wait(10):
+            raise RuntimeError(f"receiver {user_id} could not connect")
+        return client
+
+    def record(user_id, text):
+        with lock:
+            received.setdefault(user_id, []).append(text)
+
+    def send(sender_id):
+        client = ClientSocket("localhost", port, sender_id)
+        client.connect_to_server()
+        pause = args.duration / args.messages * 100
+        for n in range(args.messages):
+            client.send_message(receiver_ids[(sender_id + n) % len(receiver_ids)], f"{sender_id}:{n}")
+            if n % 100 == 99:
+                time.sleep(pause)
+        client.close()
+
+    receivers = {user_id: connect(user_id) for user_id in receiver_ids}
+    senders = [threading.Thread(target=send, args=(sender_id,)) for sender_id in range(1, args.senders + 1)]
+    total = args.senders * args.messages
+    kills = 0
+    try:
+        start = time.perf_counter()
+        for thread in senders:
+            thread.start()
+        while any(thread.is_alive() for thread in senders):
+            user_id = rng.choice(receiver_ids)
+            old = receivers[user_id]
+            old.close()
+            old.thread.join()
+            time.sleep(rng.uniform(0, args.downtime_ms / 1000))
+            receivers[user_id] = connect(user_id, old.last_seen)
+            kills += 1
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            with lock:
+                if sum(len(texts) for texts in received.values()) >= total:
+                    break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+    finally:
+        for client in receivers.values():
+            client.close()
+        proc.terminate()
+        proc.wait()
+
+    expected = {f"{sender_id}:{n}" for sender_id in range(1, args.senders + 1) for n in range(args.messages)}
+    seen = set()
+    duplicates = 0
+    for texts in received.values():
+        duplicates += len(texts) - len(set(texts))
+        seen.update(texts)
+    lost = len(expected - seen)
+    report(f"resync: {args.senders} senders x {args.messages} messages to {args.receivers} restarting receivers", [
+        ("receiver restarts", kills),
+        ("delivered/sec", f"{len(seen) / elapsed:,.0f}"),
+        ("lost", lost),
+        ("duplicates", duplicates),
+    ])
+    if lost or duplicates:
+        raise SystemExit("resync: messages were lost or duplicated")
+
+
+def bench_link(args):
+    import threading
+    import messanger
+    from PyQt6.QtCore import Qt
+    from messanger import ClientSocket, CONNECTED
+
+    class CountingSocket(socket.socket):
+        sends = 0
+        sent = 0
+        received = 0
+
+        def sendall(self, data, *flags):
+            self.sends += 1
+            self.sent += len(data)
+            return super().sendall(data, *flags)
+
+        def recv_into(self, buffer, *args):
+            n = super().recv_into(buffer, *args)
+            self.received += n
+            return n
+
+    def create_connection(address, timeout=None):
+        sock = CountingSocket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        return sock
+
+    # every write ClientSocket makes goes through sendall, so counting those counts its send syscalls
+    messanger.socket.create_connection = create_connection
+    port = free_port()
+    proc = start_relay(port, "--compression-level", "6")
+    rng = random.Random(1)
+    words = ["hello", "are", "you", "coming", "tonight", "the", "meeting", "moved", "to", "three", "ok", "thanks",
+             "see", "lunch", "tomorrow", "where", "is", "report", "sent", "it", "already", "call", "me", "later"]
+    modes = [("plain", 0, False), (f"coalesce {args.coalesce_ms:g}ms", args.coalesce_ms, False),
+             ("zlib", 0, True), (f"coalesce {args.coalesce_ms:g}ms + zlib", args.coalesce_ms, True)]
+    user_ids = itertools.count(1)
+
+    def connect(coalesce_ms, compress, on_message=None):
+        client = ClientSocket("localhost", port, next(user_ids), coalesce_ms=coalesce_ms, compress=compress)
+        if on_message is not None:
+            client.message_received.connect(on_message, Qt.ConnectionType.DirectConnection)
+        connected = threading.Event()
+        client.state_changed.connect(lambda state: state == CONNECTED and connected.set(),
+                                     Qt.ConnectionType.DirectConnection)
+        client.connect_to_server()
+        if not connected.wait(10):
+            raise RuntimeError("could not connect to the relay")
+        return client
+
+    rows = []
+    try:
+        for rate in [int(rate) for rate in args.rates.split(",")]:
+            total = int(rate * args.duration)
+            texts = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 12))) for _ in range(total)]
+            for name, coalesce_ms, compress in modes:
+                latencies = []
+                done = threading.Event()
+
+                def on_message(sender_id, text):
+                    latencies.append(time.perf_counter_ns() - int(text.split(" ", 1)[0]))
+                    if len(latencies) == total:
+                        done.set()
+
+                receiver = connect(coalesce_ms, compress, on_message)
+                sender = connect(coalesce_ms, compress)
+                # let the compression grant arrive before measuring
+                time.sleep(0.2)
+                receiver_sock, sender_sock = receiver.socket, sender.socket
+                sends_start, sent_start, received_start = sender_sock.sends, sender_sock.sent, receiver_sock.received
+                start = time.perf_counter()
+                for i, text in enumerate(texts):
+                    ahead = start + i / rate - time.perf_counter()
+                    if ahead > 0:
+                        time.sleep(ahead)
+                    sender.send_message(receiver.user_id, f"{time.perf_counter_ns()} {text}")
+                elapsed = time.perf_counter() - start
+                done.wait(30)
+                sends = sender_sock.sends - sends_start
+                sent = sender_sock.sent - sent_start
+                received = receiver_sock.received - received_start
+                sender.close()
+                receiver.close()
+                rows.append((f"{rate}/s {name}",
+                             f"{sends / elapsed:7,.0f} sends/s  {sent / total:5.1f} B up  {received / total:5.1f} B down  "
+                             f"p50 {percentile(latencies, 50) / 1e6:6.2f} ms  p99 {percentile(latencies, 99) / 1e6:6.2f} ms"
+                             + ("" if len(latencies) == total else f"  {total - len(latencies)} lost")))
+    finally:
+        proc.terminate()
+        proc.wait()
+    report(f"link: one sender for {args.duration:g}s at each rate, client to client through the relay "
+           f"(bytes per message on the wire)", rows)
+
+
+def bench_attachments(args):
+    import tempfile
+    import threading
+    from attachments import AttachmentStore, TransferClient
+    from protocol import PING
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.bin")
+        block = os.urandom(16 * 1024 * 1024)
+        with open(source, "wb") as f:
+            for pos in range(0, size, len(block)):
+                f.write(block[:size - pos])
+        port = free_port()
+        proc = start_relay(port, "--attachments", os.path.join(tmp, "relay"))
+        rtts = []
+        stop = threading.Event()
+
+        def ping():
+            # a chat connection pinging the relay while the transfer runs on its own connection
+            with socket.create_connection(("localhost", port)) as sock:
+                sock.sendall(encode_frame(HELLO, 1, 0))
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    sock.sendall(encode_frame(PING, 1, 0))
+                    sock.recv(HEADER_SIZE, socket.MSG_WAITALL)
+                    rtts.append(time.perf_counter() - start)
+                    time.sleep(0.01)
+
+        try:
+            client = TransferClient("localhost", port, AttachmentStore(os.path.join(tmp, "downloads")))
+            pinger = threading.Thread(target=ping)
+            pinger.start()
+            start = time.perf_counter()
+            digest = client.upload(source)
+            upload = time.perf_counter() - start
+            stop.set()
+            pinger.join()
+            start = time.perf_counter()
+            client.upload(source)
+            dedup = time.perf_counter() - start
+            start = time.perf_counter()
+            client.download(digest)
+            download = time.perf_counter() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+    report(f"attachments: {args.size_mb} MB over loopback", [
+        ("upload (MB/s)", f"{args.size_mb / upload:,.0f}"),
+        ("duplicate upload (s)", f"{dedup:.2f}"),
+        ("download (MB/s)", f"{args.size_mb / download:,.0f}"),
+        ("ping p50 during upload (ms)", f"{percentile(rtts, 50) * 1000:.2f}"),
+        ("ping p99 during upload (ms)", f"{percentile(rtts, 99) * 1000:.2f}"),
+    ])
+
+
+def bench_groups(args):
+    import tempfile
+    from relay import Relay, RelayProtocol
+    from protocol import JOIN, GROUP, encode_ids
+    from database import Database, INSERT_MESSAGE, conversation_key
+    relay = Relay()
+    conns = []
+    for user_id in range(1, args.members + 1):
+        conn = RelayProtocol(relay)
+        conn.connection_made(CountingTransport())
+        relay.register(conn, user_id)
+        conns.append(conn)
+    sender = conns[0]
+    member_ids = [conn.user_id for conn in conns]
+    for frame in FrameDecoder(len(member_ids) * 4 + 1024).feed(encode_frame(JOIN, 1, 1, payload=encode_ids(member_ids))):
+        relay.route(sender, frame)
+
+    data = encode_frame(GROUP, 1, 1, payload=b"x" * 100)
+    frame = next(FrameDecoder(len(data)).feed(data))
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        relay.route(sender, frame)
+    fan_out = (time.perf_counter() - start) / args.messages
+
+    per_recipient = [next(FrameDecoder(len(data)).feed(data)) for data in
+                     (encode_frame(MESSAGE, 1, member_id, payload=b"x" * 100) for member_id in member_ids[1:])]
+    start = time.perf_counter()
+    for _ in range(args.legacy_messages):
+        for frame in per_recipient:
+            relay.route(sender, frame)
+    unicast = (time.perf_counter() - start) / args.legacy_messages
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "groups.db"))
+        db.conn.executemany("INSERT INTO users (username, phone, password) VALUES (?, ?, ?)",
+                            [(f"user{i}", str(i), "pw") for i in member_ids])
+        db.conn.commit()
+        start = time.perf_counter()
+        group = db.create_group(1, "everyone", member_ids)
+        create = time.perf_counter() - start
+        pages = db.conn.execute("PRAGMA page_count").fetchone()[0]
+        start = time.perf_counter()
+        for i in range(args.messages):
+            db.add_group_message(group, 1, f"group message {i}")
+        stored = (time.perf_counter() - start) / args.messages
+        group_bytes = (db.conn.execute("PRAGMA page_count").fetchone()[0] - pages) * 4096 / args.messages
+        pages = db.conn.execute("PRAGMA page_count").fetchone()[0]
+        start = time.perf_counter()
+        for i in range(args.legacy_messages):
+            db.conn.executemany(INSERT_MESSAGE, [(1, member_id, f"copy {i}", conversation_key(1, member_id), None)
+                                                 for member_id in member_ids[1:]])
+            db.conn.commit()
+        copies = (time.perf_counter() - start) / args.legacy_messages
+        copy_bytes = (db.conn.execute("PRAGMA page_count").fetchone()[0] - pages) * 4096 / args.legacy_messages
+        start = time.perf_counter()
+        db.get_groups(member_ids[-1])
+        unread = time.perf_counter() - start
+        start = time.perf_counter()
+        db.mark_read(member_ids[-1], -group)
+        mark = time.perf_counter() - start
+        db.close()
+
+    report(f"groups: {args.members:,}-member group", [
+        ("relay fan-out (ms/msg)", f"{fan_out * 1000:.2f}"),
+        ("relay per-recipient (ms/msg)", f"{unicast * 1000:.2f}"),
+        ("create group (ms)", f"{create * 1000:.1f}"),
+        ("store once (ms/msg)", f"{stored * 1000:.2f}"),
+        ("store once (bytes/msg)", f"{group_bytes:,.0f}"),
+        ("row per recipient (ms/msg)", f"{copies * 1000:.2f}"),
+        ("row per recipient (bytes/msg)", f"{copy_bytes:,.0f}"),
+        ("unread count (ms)", f"{unread * 1000:.2f}"),
+        ("mark read (ms)", f"{mark * 1000:.2f}"),
+    ])
+
+
+def bench_contacts(args):
+    import tempfile
+    from database import Database, INSERT_MESSAGE, conversation_key
+    rng = random.Random(1)
+    contact_ids = list(range(2, args.contacts + 2))
+
+    def synthetic(count):
+        for i in range(count):
+            peer_id = rng.choice(contact_ids)
+            sender_id, receiver_id = (1, peer_id) if rng.random() < 0.5 else (peer_id, 1)
+            yield sender_id, receiver_id, f"synthetic message {i}", conversation_key(sender_id, receiver_id), None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "contacts.db"))
+        db.conn.executemany("INSERT INTO users (username, phone, password) VALUES (?, ?, ?)",
+                            [(f"user{i}", str(i), "pw") for i in range(1, args.contacts + 2)])
+        db.conn.executemany("INSERT INTO contacts (user_id, contact_id) VALUES (1, ?)",
+                            [(contact_id,) for contact_id in contact_ids])
+        start = time.perf_counter()
+        for done in range(0, args.messages, 100000):
+            db.conn.executemany(INSERT_MESSAGE, synthetic(min(100000, args.messages - done)))
+            db.conn.commit()
+        generate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        legacy = []
+        for contact in db.get_contacts(1):
+            history = db.get_messages(1, contact[0])
+            legacy.append((history[-1][0] if history else 0, contact[0]))
+        legacy.sort(reverse=True)
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        chats = db.get_chat_list(1)
+        summary_time = time.perf_counter() - start
+        assert [chat[0] for chat in chats] == [contact_id for _, contact_id in legacy]
+        assert sum(chat[4] for chat in chats) == db.conn.execute(
+            "SELECT count(*) FROM messages WHERE receiver_id=1").fetchone()[0]
+
+        start = time.perf_counter()
+        for i in range(args.inserts):
+            db.add_message(rng.choice(contact_ids), 1, f"live message {i}")
+        insert = (time.perf_counter() - start) / args.inserts
+        start = time.perf_counter()
+        db.mark_read(1, contact_ids[0])
+        mark = time.perf_counter() - start
+        db.close()
+
+    report(f"contacts: {args.contacts:,} contacts, {args.messages:,} messages", [
+        ("generate, summary triggers (s)", f"{generate:.1f}"),
+        ("history per contact (ms)", f"{legacy_time * 1000:.1f}"),
+        ("get_chat_list (ms)", f"{summary_time * 1000:.2f}"),
+        ("add_message with summary (ms)", f"{insert * 1000:.3f}"),
+        ("mark read (ms)", f"{mark * 1000:.3f}"),
+    ])
+
+
+def bench_archive(args):
+    import tempfile
+    import threading
+    from datetime import datetime, timedelta
+    from database import Database, conversation_key
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    span = timedelta(days=30 * args.months)
+    kept = conversation_key(1, 2)
+
+    def synthetic(start, count):
+        # ids follow time, oldest first, as they do in a real history
+        for i in range(start, start + count):
+            sender_id, receiver_id = rng.randint(1, args.users), rng.randint(1, args.users)
+            if i % 50 == 0:
+                sender_id, receiver_id = 1, 2
+            stamp = now - span + span * i / args.messages
+            yield (sender_id, receiver_id, f"synthetic message {i} word{i % 997}", stamp.strftime("%Y-%m-%d %H:%M:%S"),
+                   conversation_key(sender_id, receiver_id))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "archive.db")
+        db = Database(path)
+        start = time.perf_counter()
+        for done in range(0, args.messages, 100000):
+            db.conn.executemany("INSERT INTO messages (sender_id, receiver_id, message, timestamp, conversation) "
+                                "VALUES (?, ?, ?, ?, ?)", synthetic(done, min(100000, args.messages - done)))
+            db.conn.commit()
+        generate = time.perf_counter() - start
+        db.set_retention(args.keep_days)
+        db.set_retention(None, kept)
+        horizon = db.retention_horizon()
+        total = db.conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+        due = db.conn.execute("SELECT count(*) FROM messages WHERE timestamp<? AND conversation!=?",
+                              (horizon, kept)).fetchone()[0]
+        size_before = os.path.getsize(path)
+
+        # the archiver runs on its own connection while this one keeps writing and paging
+        result = {}
+
+        def archive():
+            archiver = Database(path)
+            t = time.perf_counter()
+            batches, after_id = [], 0
+            archived = 0
+            while after_id is not None:
+                b = time.perf_counter()
+                count, after_id = archiver.archive_batch(after_id, args.batch_size)
+                batches.append(time.perf_counter() - b)
+                archived += count
+            result.update(archived=archived, elapsed=time.perf_counter() - t, batches=batches)
+            archiver.close()
+        thread = threading.Thread(target=archive)
+        thread.start()
+        writes, reads = [], []
+        while thread.is_alive():
+            sender_id, receiver_id = rng.randint(1, args.users), rng.randint(1, args.users)
+            t = time.perf_counter()
+            db.add_message(sender_id, receiver_id, "live message")
+            writes.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            db.get_messages_page(sender_id, receiver_id)
+            reads.append(time.perf_counter() - t)
+        thread.join()
+
+        remaining = db.conn.execute("SELECT count(*) FROM messages").fetchone()[0]
+        overdue = db.conn.execute("SELECT count(*) FROM messages WHERE timestamp<? AND conversation!=?",
+                                  (horizon, kept)).fetchone()[0]
+        exempt = db.conn.execute("SELECT count(*) FROM messages WHERE conversation=? AND timestamp<?",
+                                 (kept, horizon)).fetchone()[0]
+        t = time.perf_counter()
+        hits = db.search_archive(3, "word3")
+        search = time.perf_counter() - t
+        freelist = db.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        archive_size = sum(os.path.getsize(os.path.join(db.archive, name)) for name in os.listdir(db.archive))
+        months = len([name for name in os.listdir(db.archive) if name.endswith(".db")])
+        db.close()
+        # the file is truncated when the WAL is checkpointed, which closing does
+        size_after = os.path.getsize(path)
+
+    report(f"archive: {args.messages:,} messages over {args.months} months, keep {args.keep_days} days", [
+        ("generate (s)", f"{generate:.1f}"),
+        ("archived / due", f"{result['archived']:,} / {due:,}"),
+        ("archive pass (s)", f"{result['elapsed']:.1f}"),
+        ("archive rows/sec", f"{result['archived'] / max(result['elapsed'], 1e-9):,.0f}"),
+        ("batch p99 / max (ms)", f"{percentile(result['batches'], 99) * 1000:.1f} / "
+                                 f"{max(result['batches']) * 1000:.1f}"),
+        ("live insert p99 / max (ms)", f"{percentile(writes, 99) * 1000:.2f} / {max(writes, default=0) * 1000:.2f}"),
+        ("live page read p99 / max (ms)", f"{percentile(reads, 99) * 1000:.2f} / {max(reads, default=0) * 1000:.2f}"),
+        ("db size before / after (MB)", f"{size_before / 1e6:.0f} / {size_after / 1e6:.0f}"),
+        ("free pages left", f"{freelist:,}"),
+        ("archives (files / MB)", f"{months} / {archive_size / 1e6:.0f}"),
+        ("search_archive (ms, hits)", f"{search * 1000:.1f}, {len(hits)}"),
+    ])
+    failures = []
+    # rows keep ageing past the horizon while the pass runs, so a few more than counted up front is fine
+    if result["archived"] < due or remaining + result["archived"] != total + len(writes):
+        failures.append("archived rows do not match the rows past retention")
+    if overdue:
+        failures.append(f"{overdue} rows past retention were left behind")
+    if not exempt:
+        failures.append("the keep-forever conversation was archived")
+    if not hits:
+        failures.append("search_archive found nothing")
+    if size_after >= size_before:
+        failures.append("freed pages were not returned to the file system")
+    failures += archive_upgraded(args)
+    if failures:
+        raise SystemExit("archive: " + "; ".join(failures))
+
+
+def archive_upgraded(args):
+    # a database from before search: its rows are only indexed once the backfill reaches them,
+    # and archiving must wait for that instead of deleting rows the index has never seen
+    import sqlite3
+    import tempfile
+    from database import Database
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "upgraded.db")
+        conn = sqlite3.connect(path)
+        conn.execute("""
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_id INTEGER NOT NULL,
+                receiver_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.executemany("INSERT INTO messages (sender_id, receiver_id, message, timestamp) "
+                         "VALUES (?, ?, ?, '2000-01-01 00:00:00')",
+                         ((i % 7 + 1, i % 5 + 1, f"upgraded message {i}") for i in range(args.upgraded)))
+        conn.commit()
+        conn.close()
+        db = Database(path)
+        db.set_retention(args.keep_days)
+        start = time.perf_counter()
+        if db.archive_batch(0, args.batch_size)[0]:
+            failures.append("rows were archived while the search backfill was pending")
+        try:
+            archived = db.archive_messages(args.batch_size)
+            db.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('integrity-check')")
+        except Exception as e:
+            failures.append(f"archiving an upgraded database failed: {e}")
+            archived = 0
+        elapsed = time.perf_counter() - start
+        if archived != args.upgraded:
+            failures.append(f"archived {archived} of {args.upgraded} rows from the upgraded database")
+        db.close()
+    report(f"archive: {args.upgraded:,} messages in a database upgraded from before search", [
+        ("backfill + archive (s)", f"{elapsed:.1f}"),
+        ("archived", f"{archived:,}"),
+    ])
+    return failures
+
+
+async def login_load(mode, check, concurrency, seconds, threads):
+    # clients sign in back to back for the given time while a ticker measures how late the loop runs
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(threads)
+    latencies, lags = [], []
+    deadline = time.perf_counter() + seconds
+
+    async def ticker():
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - t - 0.01)
+
+    async def client(n):
+        i = n
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            if mode == "inline":
+                check(i)
+            else:
+                await loop.run_in_executor(pool, check, i)
+            latencies.append(time.perf_counter() - t)
+            i += concurrency
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(ticker(), *(client(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return latencies, lags, elapsed
+
+
+def bench_logins(args):
+    # the relay has no accounts of its own, so this drives Database.check_password the way a relay
+    # login handler on an asyncio loop would: inline on the loop, or handed to a thread pool
+    import tempfile
+    import threading
+    import passwords
+    from database import Database
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "logins.db")
+        db = Database(path)
+        start = time.perf_counter()
+        for i in range(args.users):
+            db.add_user(f"user{i}", str(i), f"password{i}")
+        setup = time.perf_counter() - start
+        local = threading.local()
+
+        def check(i):
+            if not hasattr(local, "db"):
+                local.db = Database(path, check_same_thread=False)
+            user_id = i % args.users
+            # every tenth attempt is a wrong password, which is never cached
+            password = f"password{user_id}" if i % 10 else "wrong"
+            user = local.db.check_password(f"user{user_id}", password)
+            assert (user is not None) == (password != "wrong")
+
+        rows = [("hash one password (ms)", f"{setup / args.users * 1000:.0f}")]
+        for mode in ("inline", "pool", "cached"):
+            # a zero-size cache forgets every entry as soon as it is added
+            passwords.verification_cache.clear()
+            passwords.verification_cache.size = passwords.CACHE_SIZE if mode == "cached" else 0
+            if mode == "cached":
+                for user_id in range(args.users):
+                    db.check_password(f"user{user_id}", f"password{user_id}")
+            latencies, lags, elapsed = asyncio.run(login_load(mode, check, args.concurrency, args.seconds,
+                                                              args.threads))
+            rows += [
+                (f"{mode} logins/sec", f"{len(latencies) / elapsed:,.1f}"),
+                (f"{mode} p50 / p99 (ms)",
+                 f"{percentile(latencies, 50) * 1000:.0f} / {percentile(latencies, 99) * 1000:.0f}"),
+                (f"{mode} loop lag max (ms)", f"{max(lags, default=0) * 1000:.0f}"),
+            ]
+        db.close()
+    report(f"logins: {args.users} accounts, {args.concurrency} concurrent clients, "
+           f"scrypt n={passwords.SCRYPT_N} r={passwords.SCRYPT_R} p={passwords.SCRYPT_P}", rows)
+
+
+def bench_history(args):
+    import json
+    import tempfile
+    from database import Database, HISTORY_VERSION, conversation_key, open_history
+    rng = random.Random(1)
+    suffix = ".ndjson.gz" if args.compress else ".ndjson"
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "history" + suffix)
+        start = time.perf_counter()
+        with open_history(source, "w") as f:
+            f.write(json.dumps({"type": "header", "version": HISTORY_VERSION}) + "\n")
+            for user_id in range(1, args.users + 1):
+                f.write(json.dumps({"type": "user", "id": user_id, "username": f"user{user_id}",
+                                    "phone": str(user_id), "password": "pw"}) + "\n")
+            for i in range(1, args.messages + 1):
+                sender_id, receiver_id = rng.randint(1, args.users), rng.randint(1, args.users)
+                f.write(json.dumps({"type": "message", "id": i, "sender_id": sender_id, "receiver_id": receiver_id,
+                                    "message": f"synthetic message {i}", "timestamp": "2025-01-01 00:00:00",
+                                    "conversation": conversation_key(sender_id, receiver_id)}) + "\n")
+        print(f"generated {args.messages:,} messages in {time.perf_counter() - start:.1f}s")
+        rows = args.users + args.messages
+        base = anon_mb()
+
+        db = Database(os.path.join(tmp, "imported.db"))
+        start = time.perf_counter()
+        with open_history(source, "r") as f:
+            counts = db.import_history(f, args.batch_size)
+        imported = time.perf_counter() - start
+        assert counts["message"] == args.messages and counts["user"] == args.users
+        after = anon_mb()
+        start = time.perf_counter()
+        with open_history(os.path.join(tmp, "export" + suffix), "w") as f:
+            exported = db.export_history(f)
+        export_time = time.perf_counter() - start
+        assert exported == rows
+        db.close()
+
+    report(f"history: {args.messages:,} messages, batch {args.batch_size:,}" + (", gzip" if args.compress else ""), [
+        ("import (rows/sec)", f"{rows / imported:,.0f}"),
+        ("import incl. index rebuild (s)", f"{imported:.1f}"),
+        ("export (rows/sec)", f"{rows / export_time:,.0f}"),
+        ("anon RSS before import (MB)", f"{base:.0f}"),
+        ("anon RSS after import (MB)", f"{after:.0f}"),
+    ])
+
+
+DB_OPERATIONS = ("add_user", "add_contact", "get_contacts", "add_message", "get_messages")
+
+
+def db_suite(scale, args):
+    import tempfile
+    import passwords
+    from database import Database, MEMORY, INSERT_MESSAGE, conversation_key
+    # the suite times the SQL; scrypt at the real cost has its own bench (logins)
+    passwords.SCRYPT_N = 2
+    rng = random.Random(scale)
+    # users grow with the scale so every pair keeps roughly the same history length
+    users = max(args.contacts + 1, scale // 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(MEMORY if args.memory else os.path.join(tmp, "db.db"))
+        db.conn.executemany("INSERT INTO users (username, phone, password) VALUES (?, ?, ?)",
+                            [(f"user{i}", str(i), "pw") for i in range(1, users + 1)])
+        pairs = set()
+        for user_id in range(1, users + 1):
+            for contact_id in rng.sample(range(1, users + 1), args.contacts):
+                if contact_id != user_id:
+                    pairs.add((user_id, contact_id))
+        pairs = sorted(pairs)
+        db.conn.executemany("INSERT INTO contacts (user_id, contact_id) VALUES (?, ?)", pairs)
+        messages = ((a, b, f"synthetic message {i}", conversation_key(a, b), None)
+                    for i, (a, b) in enumerate(rng.choice(pairs) for _ in range(scale)))
+        db.conn.executemany(INSERT_MESSAGE, messages)
+        db.conn.commit()
+
+        operations = {
+            "add_user": lambda i: db.add_user(f"new{i}", f"new{i}", "pw"),
+            "add_contact": lambda i: db.add_contact(rng.randint(1, users), f"new{i}"),
+            "get_contacts": lambda i: db.get_contacts(rng.randint(1, users)),
+            "add_message": lambda i: db.add_message(*rng.choice(pairs), f"new message {i}"),
+            "get_messages": lambda i: db.get_messages(*rng.choice(pairs)),
+        }
+        results = {}
+        for name in DB_OPERATIONS:
+            timings = []
+            start = time.perf_counter()
+            for i in range(args.ops):
+                t = time.perf_counter()
+                operations[name](i)
+                timings.append(time.perf_counter() - t)
+            results[f"{name}@{scale}/{'memory' if args.memory else 'file'}"] = {
+                "p50_us": percentile(timings, 50) * 1e6,
+                "p99_us": percentile(timings, 99) * 1e6,
+                "ops_per_sec": args.ops / (time.perf_counter() - start),
+            }
+        db.close()
+    return results
+
+
+def bench_db(args):
+    import json
+    results = {}
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        scale_results = db_suite(scale, args)
+        results.update(scale_results)
+        report(f"db: {scale:,} messages, {'memory' if args.memory else 'file'}", [
+            (key.split("@")[0], f"p50 {r['p50_us']:8.1f} us  p99 {r['p99_us']:8.1f} us  {r['ops_per_sec']:>10,.0f}/s")
+            for key, r in scale_results.items()
+        ])
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # p50 is compared because p99 of sub-millisecond calls is mostly scheduler noise
+    regressions = []
+    for key, r in results.items():
+        if key in baseline:
+            change = r["p50_us"] / baseline[key]["p50_us"] - 1
+            print(f"  {key:<32}{change:+.0%}")
+            if change > args.threshold:
+                regressions.append(key)
+    if regressions:
+        print(f"regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def anon_mb():
+    # resident minus file-backed pages, so SQLite's mmap of the database is not counted
+    with open("/proc/self/statm") as f:
+        fields = f.read().split()
+    return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def transcript_run(variant, messages):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication, QTextEdit, QAbstractItemView
+    app = QApplication([])
+    from messanger import ChatModel, ChatView
+    if variant == "textedit":
+        view = QTextEdit()
+        view.setReadOnly(True)
+        append = lambda i: view.append(f"user{i % 2}: synthetic message number {i}")
+        scroll = lambda: view.verticalScrollBar().setValue(view.verticalScrollBar().maximum())
+    else:
+        model = ChatModel()
+        view = ChatView(model)
+        view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        append = lambda i: model.append_row(i, f"user{i % 2}", f"synthetic message number {i}")
+        scroll = view.scrollToBottom
+    view.resize(330, 550)
+    view.show()
+    app.processEvents()
+    base = rss_mb()
+    start = time.perf_counter()
+    for i in range(messages):
+        append(i)
+        if i % 100 == 0:
+            scroll()
+            app.processEvents()
+    app.processEvents()
+    elapsed = time.perf_counter() - start
+    print(f"{messages / elapsed:.0f} {rss_mb() - base:.1f}")
+
+
+def bench_transcript(args):
+    if args.variant:
+        transcript_run(args.variant, args.messages)
+        return
+    rows = []
+    for variant in ("textedit", "model"):
+        out = subprocess.run([sys.executable, __file__, "transcript", "--variant", variant,
+                              "--messages", str(args.messages)], capture_output=True, text=True, check=True)
+        rate, rss = out.stdout.split()
+        rows.append((f"{variant} appends/sec", f"{float(rate):,.0f}"))
+        rows.append((f"{variant} RSS growth (MB)", rss))
+    report(f"transcript: {args.messages:,} appended messages", rows)
+
+
+STARTUP_PHASES = (
+    ("database", "import database"),
+    ("relay", "import relay"),
+    ("messanger", "import messanger"),
+    ("export", "messanger.py export"),
+    ("sign-in", "sign in window shown"),
+    ("main-window", "main window, relay down"),
+)
+
+
+def startup_run(phase, db_path):
+    start = time.perf_counter()
+    if phase in ("database", "relay", "messanger"):
+        __import__(phase)
+    elif phase == "export":
+        import runpy
+        sys.argv = ["messanger.py", "export", os.devnull, "--db", db_path]
+        try:
+            runpy.run_path(os.path.join(BASE_DIR, "messanger.py"), run_name="__main__")
+        except SystemExit:
+            pass
+    else:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        import messanger
+        if phase == "sign-in":
+            app = messanger.MessengerApp([])
+            app.processEvents()
+            async_db = app.async_db
+        else:
+            app = messanger.QApplication([])
+            async_db = messanger.AsyncDatabase(db_path)
+            user = messanger.Database(db_path).get_user(username="bench")
+            window = messanger.MainWindow(async_db, user)
+            window.show()
+            app.processEvents()
+        elapsed = time.perf_counter() - start
+        async_db.close()
+        print(f"{elapsed:.4f} 1")
+        return
+    print(f"{time.perf_counter() - start:.4f} {int('PyQt6' in sys.modules)}")
+
+
+def bench_startup(args):
+    import tempfile
+    import statistics
+    if args.phase:
+        startup_run(args.phase, args.db)
+        return
+    from database import Database
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "startup.db")
+        db = Database(db_path)
+        db.add_user("bench", "0", "pw")
+        db.close()
+        # nothing may listen on the client's relay port, so the main window phase sees the relay down
+        env = dict(os.environ, MESSENGER_DB=db_path)
+        for phase, name in STARTUP_PHASES:
+            timings, qt = [], False
+            for _ in range(args.repeat):
+                out = subprocess.run([sys.executable, __file__, "startup", "--phase", phase, "--db", db_path],
+                                     capture_output=True, text=True, check=True, env=env)
+                elapsed, loaded = out.stdout.split()[-2:]
+                timings.append(float(elapsed))
+                qt = qt or loaded == "1"
+            rows.append((f"{name} (ms)", f"{statistics.median(timings) * 1000:8.1f}{'  Qt' if qt else ''}"))
+    report(f"startup: median of {args.repeat} fresh processes", rows)
+
+
+def metrics_run(ops):
+    import threading
+    import metrics
+    from database import Database, MEMORY
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from messanger import ClientSocket
+    # with metrics off the decorators must hand back the original functions
+    assert metrics.ENABLED or not hasattr(Database.get_messages, "__wrapped__")
+    results = []
+    db = Database(MEMORY)
+    start = time.perf_counter()
+    for i in range(ops):
+        db.add_message(1, 2, f"message {i}")
+        db.get_messages_page(1, 2, limit=20)
+    results.append(ops / (time.perf_counter() - start))
+    db.close()
+
+    client = ClientSocket("localhost", 0, 1)
+    client.socket, peer = socket.socketpair()
+
+    def drain():
+        while peer.recv(1 << 16):
+            pass
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+    start = time.perf_counter()
+    for i in range(ops * 10):
+        client.send_message(2, "x" * 100)
+    results.append(ops * 10 / (time.perf_counter() - start))
+    client.socket.close()
+    reader.join()
+
+    hist, count = metrics.histogram("bench"), metrics.counter("bench")
+    start = time.perf_counter()
+    for _ in range(ops * 10):
+        count.inc()
+        with hist.time():
+            pass
+    results.append((time.perf_counter() - start) / (ops * 10) * 1e9)
+    print(" ".join(f"{value:.1f}" for value in results))
+
+
+def bench_metrics(args):
+    if args.run:
+        metrics_run(args.ops)
+        return
+    modes = {}
+    for mode, flag in (("off", ""), ("on", "1")):
+        env = dict(os.environ, MESSENGER_METRICS=flag)
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, __file__, "metrics", "--run", "--ops", str(args.ops)],
+                                 capture_output=True, text=True, check=True, env=env)
+            runs.append([float(value) for value in out.stdout.split()[-3:]])
+        # best of the runs, the least disturbed by everything else on the machine
+        modes[mode] = [max(run[0] for run in runs), max(run[1] for run in runs), min(run[2] for run in runs)]
+    off, on = modes["off"], modes["on"]
+    report(f"metrics: instrumentation overhead, best of {args.repeat}", [
+        ("db calls/sec off", f"{off[0]:,.0f}"),
+        ("db calls/sec on", f"{on[0]:,.0f} ({on[0] / off[0] - 1:+.1%})"),
+        ("client sends/sec off", f"{off[1]:,.0f}"),
+        ("client sends/sec on", f"{on[1]:,.0f} ({on[1] / off[1] - 1:+.1%})"),
+        ("counter + timer off (ns)", f"{off[2]:.0f}"),
+        ("counter + timer on (ns)", f"{on[2]:.0f}"),
+    ])
+
+
+async def shard_load(port, first, count, peer_first, messages):
+    # one load generator: `count` users that each send `messages` to the next generator's users,
+    # spread so every one of those receives exactly `messages`, acknowledging as they go
+    from protocol import ACK
+    conns = []
+    for user_id in range(first, first + count):
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.write(encode_frame(HELLO, user_id, 0))
+        conns.append((user_id, reader, writer))
+    print("ready", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+
+    total = count * messages
+    latencies = []
+    done = asyncio.Event()
+
+    async def receive(reader, writer):
+        while True:
+            try:
+                header = await reader.readexactly(HEADER_SIZE)
+                payload = await reader.readexactly(HEADER.unpack(header)[0] + LENGTH_SIZE - HEADER_SIZE)
+            except asyncio.IncompleteReadError:
+                return
+            latencies.append(time.time_ns() - int(payload))
+            if len(latencies) % 64 == 0:
+                writer.write(encode_frame(ACK, 0, 0, HEADER.unpack(header)[4]))
+            if len(latencies) >= total:
+                done.set()
+
+    async def send(position, writer, user_id):
+        for i in range(messages):
+            receiver_id = peer_first + (position + i) % count
+            writer.write(encode_frame(MESSAGE, user_id, receiver_id, payload=b"%d" % time.time_ns()))
+            await writer.drain()
+
+    receivers = [asyncio.create_task(receive(reader, writer)) for _, reader, writer in conns]
+    start = time.time()
+    await asyncio.gather(*(send(position, writer, user_id) for position, (user_id, _, writer) in enumerate(conns)))
+    try:
+        await asyncio.wait_for(done.wait(), timeout=120)
+    except asyncio.TimeoutError:
+        pass
+    end = time.time()
+    for _, _, writer in conns:
+        writer.close()
+    for task in receivers:
+        task.cancel()
+    print(start, end, len(latencies), percentile(latencies, 50) / 1e6, percentile(latencies, 99) / 1e6)
+
+
+def bench_shards(args):
+    per = args.clients // args.generators
+    if args.generate is not None:
+        g = args.generate
+        asyncio.run(shard_load(args.port, 1 + g * per, per, 1 + (g + 1) % args.generators * per, args.messages))
+        return
+    rows, base = [], None
+    for workers in [int(n) for n in args.workers.split(",")]:
+        port = free_port()
+        relay = start_relay(port, "--workers", str(workers))
+        try:
+            generators = [subprocess.Popen([sys.executable, __file__, "shards", "--generate", str(g),
+                                            "--port", str(port), "--clients", str(args.clients),
+                                            "--messages", str(args.messages), "--generators", str(args.generators)],
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                          for g in range(args.generators)]
+            # every user is connected before anyone sends, so nothing waits in a mailbox
+            for proc in generators:
+                proc.stdout.readline()
+            for proc in generators:
+                proc.stdin.write("go\n")
+                proc.stdin.flush()
+            results = [[float(value) for value in proc.communicate()[0].split()] for proc in generators]
+        finally:
+            relay.terminate()
+            relay.wait()
+        received = sum(int(result[2]) for result in results)
+        rate = received / (max(result[1] for result in results) - min(result[0] for result in results))
+        base = base or rate
+        rows.append((f"{workers} workers messages/sec", f"{rate:,.0f} (x{rate / base:.2f})"))
+        rows.append((f"{workers} workers delivered", f"{received}/{per * args.generators * args.messages}"))
+        rows.append((f"{workers} workers worst p99 (ms)", f"{max(result[4] for result in results):.2f}"))
+    report(f"shards: {per * args.generators} clients x {args.messages} messages from {args.generators} "
+           f"generator processes, {os.cpu_count()} cores", rows)
+
+
+def bench_avatars(args):
+    import tempfile
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtGui import QImage, QColor, QPixmap, QPainter, QPainterPath
+    from PyQt6.QtCore import Qt
+    app = QApplication([])
+    import messanger
+
+    def legacy(contacts):
+        for contact in contacts:
+            size = 48
+            pixmap = QPixmap(contact[2]).scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
+                                                Qt.TransformationMode.SmoothTransformation)
+            rounded = QPixmap(size, size)
+            rounded.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(rounded)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            path = QPainterPath()
+            path.addEllipse(0, 0, size, size)
+            painter.setClipPath(path)
+            painter.drawPixmap(0, 0, pixmap)
+            painter.end()
+
+    def timed_show(window, contacts):
+        start = time.perf_counter()
+        window.show_contacts(contacts)
+        window.contacts_view.repaint()
+        app.processEvents()
+        shown = time.perf_counter() - start
+        window.avatars.wait()
+        app.processEvents()
+        return shown, time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        contacts = []
+        for i in range(args.contacts):
+            path = os.path.join(tmp, f"avatar_{i}.jpg")
+            image = QImage(args.image_size, args.image_size, QImage.Format.Format_RGB32)
+            image.fill(QColor.fromHsv(i % 360, 200, 200))
+            image.save(path, "JPEG")
+            contacts.append((i + 2, f"user{i}", path))
+        path = os.path.join(tmp, "avatars.db")
+        db = messanger.Database(path)
+        user_id = db.add_user("bench", "0", "pw")
+        async_db = messanger.AsyncDatabase(path)
+        thumbs = os.path.join(tmp, "thumbnails")
+        window = messanger.MainWindow(async_db, db.get_user(user_id=user_id), messanger.AvatarCache(thumbs))
+        window.show()
+        app.processEvents()
+
+        rows = []
+        start = time.perf_counter()
+        legacy(contacts)
+        rows.append(("legacy decode per row (s)", f"{time.perf_counter() - start:.3f}"))
+        for name in ("cold", "warm (memory)"):
+            shown, ready = timed_show(window, contacts)
+            rows.append((f"{name} list shown (s)", f"{shown:.3f}"))
+            rows.append((f"{name} visible avatars (s)", f"{ready:.3f}"))
+        window.avatars = messanger.AvatarCache(thumbs)
+        window.avatars.ready.connect(window.on_avatar_ready)
+        window.contacts_view.itemDelegate().avatars = window.avatars
+        shown, ready = timed_show(window, contacts)
+        rows.append(("warm (disk) list shown (s)", f"{shown:.3f}"))
+        rows.append(("warm (disk) visible avatars (s)", f"{ready:.3f}"))
+
+        images = messanger.ImageStore(os.path.join(tmp, "images"))
+        start = time.perf_counter()
+        stored = [(contact_id, username, images.store(path)) for contact_id, username, path in contacts]
+        rows.append(("store + variants (ms/image)", f"{(time.perf_counter() - start) / len(contacts) * 1000:.2f}"))
+        start = time.perf_counter()
+        images.store(contacts[0][2])
+        rows.append(("duplicate store (ms)", f"{(time.perf_counter() - start) * 1000:.2f}"))
+        window.avatars = messanger.AvatarCache(os.path.join(tmp, "thumbnails-variants"), images=images)
+        window.avatars.ready.connect(window.on_avatar_ready)
+        window.contacts_view.itemDelegate().avatars = window.avatars
+        shown, ready = timed_show(window, stored)
+        rows.append(("cold, 48px variants shown (s)", f"{shown:.3f}"))
+        rows.append(("cold, 48px variants avatars (s)", f"{ready:.3f}"))
+        window.close()
+        async_db.close()
+    report(f"avatars: load_contacts with {args.contacts} contacts, {args.image_size}px sources", rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for messanger.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("relay", help="load-test the relay server")
+    p.add_argument("--host", default="localhost")
+    p.add_argument("--port", type=int, help="use a running relay instead of starting one")
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=20)
+    p.set_defaults(func=bench_relay)
+
+    p = sub.add_parser("framing", help="text vs length-prefixed binary frame codec throughput")
+    p.add_argument("--messages", type=int, default=200000)
+    p.add_argument("--size", type=int, default=100)
+    p.add_argument("--chunk", type=int, default=65536)
+    p.set_defaults(func=bench_framing)
+
+    p = sub.add_parser("inserts", help="per-row commit vs group-commit message inserts")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--batch-size", type=int, default=256)
+    p.add_argument("--flush-ms", type=float, default=5)
+    p.add_argument("--threads", type=int, default=32)
+    p.set_defaults(func=bench_inserts)
+
+    p = sub.add_parser("chat-open", help="open chats against a large synthetic messages table")
+    p.add_argument("--messages", type=int, default=10_000_000)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--opens", type=int, default=200)
+    p.add_argument("--legacy-opens", type=int, default=5)
+    p.set_defaults(func=bench_chat_open)
+
+    p = sub.add_parser("transcript", help="QTextEdit.append vs ChatModel append throughput and RSS")
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--variant", choices=("textedit", "model"), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_transcript)
+
+    p = sub.add_parser("routing", help="relay delivery cost per message with many connected users")
+    p.add_argument("--users", type=int, default=10000)
+    p.add_argument("--contacts", type=int, default=50)
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--broadcast-messages", type=int, default=200)
+    p.add_argument("--churn", type=int, default=1000)
+    p.set_defaults(func=bench_routing)
+
+    p = sub.add_parser("resync", help="restart receivers under load and check for lost or duplicate messages")
+    p.add_argument("--senders", type=int, default=20)
+    p.add_argument("--receivers", type=int, default=20)
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--duration", type=float, default=10, help="seconds each sender spreads its messages over")
+    p.add_argument("--downtime-ms", type=float, default=20)
+    p.set_defaults(func=bench_resync)
+
+    p = sub.add_parser("link", help="send syscalls, bytes on the wire and latency with coalescing and zlib")
+    p.add_argument("--rates", default="100,1000,10000", help="comma-separated messages/sec")
+    p.add_argument("--duration", type=float, default=3)
+    p.add_argument("--coalesce-ms", type=float, default=5)
+    p.set_defaults(func=bench_link)
+
+    p = sub.add_parser("attachments", help="chunked upload/download throughput for a large file")
+    p.add_argument("--size-mb", type=int, default=1024)
+    p.set_defaults(func=bench_attachments)
+
+    p = sub.add_parser("groups", help="sending into a large group: relay fan-out and storage")
+    p.add_argument("--members", type=int, default=5000)
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--legacy-messages", type=int, default=20)
+    p.set_defaults(func=bench_groups)
+
+    p = sub.add_parser("contacts", help="contacts list with previews and unread counts vs per-contact history")
+    p.add_argument("--contacts", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--inserts", type=int, default=1000)
+    p.set_defaults(func=bench_contacts)
+
+    p = sub.add_parser("logins", help="password checks/sec under concurrent sign-ins, inline vs thread pool vs cache")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.set_defaults(func=bench_logins)
+
+    p = sub.add_parser("history", help="NDJSON import/export throughput and memory")
+    p.add_argument("--messages", type=int, default=50_000_000)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--batch-size", type=int, default=50000)
+    p.add_argument("--compress", action="store_true", help="gzip the NDJSON file")
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser("archive", help="retention archiving of a large old history while the app keeps writing")
+    p.add_argument("--messages", type=int, default=1_000_000)
+    p.add_argument("--months", type=int, default=24)
+    p.add_argument("--keep-days", type=int, default=180)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--batch-size", type=int, default=2000)
+    p.add_argument("--upgraded", type=int, default=50000, help="messages in the pre-search database case")
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser("db", help="Database call latency at several scales, with a regression check")
+    p.add_argument("--scales", default="1000,10000,100000", help="comma-separated message counts")
+    p.add_argument("--ops", type=int, default=2000, help="timed calls per operation")
+    p.add_argument("--contacts", type=int, default=20, help="contacts per synthetic user")
+    p.add_argument("--file", dest="memory", action="store_false", help="use a database file instead of :memory:")
+    p.add_argument("--save", help="write results to this JSON file")
+    p.add_argument("--baseline", help="JSON file from an earlier --save to compare against")
+    p.add_argument("--threshold", type=float, default=0.25, help="allowed p50 slowdown before failing")
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("search", help="FTS5 search_messages latency over a large synthetic history")
+    p.add_argument("--messages", type=int, default=10_000_000)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--vocabulary", type=int, default=20000)
+    p.add_argument("--queries", type=int, default=50)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("startup", help="import and window startup times, and which paths load Qt")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--phase", choices=[phase for phase, _ in STARTUP_PHASES], help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("metrics", help="cost of the metrics instrumentation when off and on")
+    p.add_argument("--ops", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("shards", help="relay messages/sec as worker processes are added")
+    p.add_argument("--workers", default=",".join(str(2 ** i) for i in range((os.cpu_count() or 1).bit_length())),
+                   help="comma-separated worker counts to try")
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--generators", type=int, default=max(2, (os.cpu_count() or 1) // 2),
+                   help="load generator processes, so the clients are not limited to one core")
+    p.add_argument("--generate", type=int, help=argparse.SUPPRESS)
+    p.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("avatars", help="load_contacts time with cold and warm avatar caches")
+    p.add_argument("--contacts", type=int, default=1000)
+    p.add_argument("--image-size", type=int, default=800)
+    p.set_defaults(func=bench_avatars)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1075 @@
+import sys
+import os
+import sqlite3
+import threading
+import queue
+import time
+import json
+import gzip
+import zlib
+import string
+from concurrent.futures import Future
+
+import metrics
+from passwords import hash_password, is_hashed, verification_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.environ.get("MESSENGER_DB", os.path.join(BASE_DIR, "messenger.db"))
+MEMORY = ":memory:"
+
+PRAGMAS = (
+    # only takes effect on a new database, before its first table; see Database.compact for old ones
+    ("auto_vacuum", "INCREMENTAL"),
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -64000),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+)
+
+MAX_ID = (1 << 63) - 1
+HIGHLIGHT = ("[", "]")
+
+# group messages are stored once with receiver_id 0; the conversation column says which group
+GROUP_RECEIVER = 0
+
+PREVIEW_LENGTH = 80
+ATTACHMENT_MARK = "\U0001F4CE "
+
+query_timer = metrics.timed_by("db_query", "Database call latency", "method")
+MESSAGES_WRITTEN = metrics.counter("db_messages_written", "Messages committed by the group-commit writer")
+MESSAGES_ARCHIVED = metrics.counter("db_messages_archived", "Messages moved out by the retention policy")
+FLUSH_TIME = metrics.histogram("db_flush", "Group-commit transaction latency")
+
+# retention: messages older than their conversation's keep_days move to monthly archive databases
+ARCHIVE_BATCH = 2000
+ARCHIVE_MERGE_PAGES = 128
+ARCHIVE_LOCK_ROWS = 100
+ARCHIVE_VACUUM_PAGES = 256
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS blocks (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        conversation INTEGER NOT NULL,
+        block INTEGER NOT NULL REFERENCES blocks (id),
+        timestamp DATETIME
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, id);
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        message, participants, content='', tokenize='unicode61 remove_diacritics 2'
+    );
+"""
+
+INSERT_MESSAGE = ("INSERT INTO messages (sender_id, receiver_id, message, conversation, attachment) "
+                  "VALUES (?, ?, ?, ?, ?)")
+
+
+def conversation_key(user1_id, user2_id):
+    return (min(user1_id, user2_id) << 32) | max(user1_id, user2_id)
+
+
+def group_key(conversation_id):
+    # negative so group conversations never collide with 1:1 keys, which are always > 2**32
+    return -conversation_id
+
+
+def message_preview(message, attachment=None):
+    # same text the summary triggers store, so the list looks the same before and after a reload
+    return ((ATTACHMENT_MARK + message) if attachment else message)[:PREVIEW_LENGTH]
+
+
+def pragma_settings(overrides=None):
+    # overrides is a dict; a value of None leaves SQLite's default for that pragma
+    settings = dict(PRAGMAS)
+    settings.update(overrides or {})
+    return tuple((name, value) for name, value in settings.items() if value is not None)
+
+
+def configure_connection(conn, pragmas=PRAGMAS):
+    for name, value in pragmas:
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+def archive_dir(path):
+    return os.path.splitext(path)[0] + "-archive"
+
+
+def participants(sender_id, receiver_id, conversation):
+    # the same tokens messages_search indexes, so archive search filters the same way
+    if conversation < 0:
+        return f"u{sender_id} g{-conversation}"
+    return f"u{sender_id} u{receiver_id}"
+
+
+def migrate_conversation_key(cursor):
+    cursor.execute("ALTER TABLE messages ADD COLUMN conversation INTEGER")
+    cursor.execute("""
+        UPDATE messages
+        SET conversation = (min(sender_id, receiver_id) << 32) | max(sender_id, receiver_id)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, id)")
+
+
+def migrate_message_search(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+    # participants are indexed as tokens so a user filter is a doclist intersection inside FTS
+    cursor.execute("""
+        CREATE VIEW messages_search AS
+        SELECT id, message, 'u' || sender_id || ' u' || receiver_id AS participants FROM messages
+    """)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            message, participants, content='messages_search', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message, participants)
+            VALUES (new.id, new.message, 'u' || new.sender_id || ' u' || new.receiver_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+            VALUES ('delete', old.id, old.message, 'u' || old.sender_id || ' u' || old.receiver_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+            VALUES ('delete', old.id, old.message, 'u' || old.sender_id || ' u' || old.receiver_id);
+            INSERT INTO messages_fts (rowid, message, participants)
+            VALUES (new.id, new.message, 'u' || new.sender_id || ' u' || new.receiver_id);
+        END
+    """)
+    # rows that existed before the triggers are indexed later by backfill_search_index
+    cursor.execute("""
+        INSERT OR REPLACE INTO meta (key, value)
+        SELECT 'fts_backfill_upto', coalesce(max(id), 0) FROM messages
+    """)
+
+
+def migrate_attachments(cursor):
+    # sha256 of a file held by the relay's attachment store; message is the file name
+    cursor.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+
+
+def migrate_group_chats(cursor):
+    cursor.execute("""
+        CREATE TABLE conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            created_by INTEGER REFERENCES users (id),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE members (
+            conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (conversation_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX idx_members_user ON members (user_id)")
+    # group rows are indexed under a g<conversation> token instead of their placeholder receiver
+    participants = """CASE WHEN {0}.conversation < 0 THEN 'u' || {0}.sender_id || ' g' || -{0}.conversation
+                      ELSE 'u' || {0}.sender_id || ' u' || {0}.receiver_id END"""
+    cursor.execute("DROP VIEW messages_search")
+    cursor.execute(f"""
+        CREATE VIEW messages_search AS
+        SELECT id, message, {participants.format('messages')} AS participants FROM messages
+    """)
+    for name in ("insert", "delete", "update"):
+        cursor.execute(f"DROP TRIGGER messages_fts_{name}")
+    cursor.execute(f"""
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message, participants)
+            VALUES (new.id, new.message, {participants.format('new')});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+            VALUES ('delete', old.id, old.message, {participants.format('old')});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+            VALUES ('delete', old.id, old.message, {participants.format('old')});
+            INSERT INTO messages_fts (rowid, message, participants)
+            VALUES (new.id, new.message, {participants.format('new')});
+        END
+    """)
+
+
+SUMMARY_PREVIEW = f"""substr(CASE WHEN {{0}}.attachment IS NULL THEN {{0}}.message
+                         ELSE '{ATTACHMENT_MARK}' || {{0}}.message END, 1, {PREVIEW_LENGTH})"""
+
+
+def migrate_conversation_summary(cursor):
+    # one row per (user, peer) kept current by a trigger, so it commits with the message itself
+    cursor.execute("""
+        CREATE TABLE conversation_summary (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            peer_id INTEGER NOT NULL REFERENCES users (id),
+            last_message_id INTEGER NOT NULL,
+            preview TEXT NOT NULL,
+            last_timestamp DATETIME,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id)
+        ) WITHOUT ROWID
+    """)
+    # groups keep their preview on the conversation; unread there comes from the members read cursor
+    for column in ("last_message_id INTEGER NOT NULL DEFAULT 0", "preview TEXT", "last_timestamp DATETIME"):
+        cursor.execute(f"ALTER TABLE conversations ADD COLUMN {column}")
+    preview = SUMMARY_PREVIEW
+    cursor.execute(f"""
+        CREATE TRIGGER messages_summary AFTER INSERT ON messages WHEN new.conversation >= 0 BEGIN
+            INSERT INTO conversation_summary (user_id, peer_id, last_message_id, preview, last_timestamp)
+            VALUES (new.sender_id, new.receiver_id, new.id, {preview.format('new')}, new.timestamp)
+            ON CONFLICT (user_id, peer_id) DO UPDATE SET last_message_id = excluded.last_message_id,
+                preview = excluded.preview, last_timestamp = excluded.last_timestamp;
+            INSERT INTO conversation_summary (user_id, peer_id, last_message_id, preview, last_timestamp, unread)
+            SELECT new.receiver_id, new.sender_id, new.id, {preview.format('new')}, new.timestamp, 1
+            WHERE new.receiver_id != new.sender_id
+            ON CONFLICT (user_id, peer_id) DO UPDATE SET last_message_id = excluded.last_message_id,
+                preview = excluded.preview, last_timestamp = excluded.last_timestamp, unread = unread + 1;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER messages_group_summary AFTER INSERT ON messages WHEN new.conversation < 0 BEGIN
+            UPDATE conversations
+            SET last_message_id = new.id, preview = {preview.format('new')}, last_timestamp = new.timestamp
+            WHERE id = -new.conversation;
+        END
+    """)
+    rebuild_conversation_summary(cursor)
+
+
+def rebuild_conversation_summary(cursor):
+    # history written without the triggers starts out read; max(id) picks the other columns from the latest row
+    preview = SUMMARY_PREVIEW
+    cursor.execute("DELETE FROM conversation_summary")
+    cursor.execute(f"""
+        INSERT INTO conversation_summary (user_id, peer_id, last_message_id, preview, last_timestamp)
+        SELECT user_id, peer_id, max(id), {preview.format('m')}, timestamp FROM (
+            SELECT sender_id AS user_id, receiver_id AS peer_id, id, message, attachment, timestamp
+            FROM messages WHERE conversation >= 0
+            UNION ALL
+            SELECT receiver_id, sender_id, id, message, attachment, timestamp
+            FROM messages WHERE conversation >= 0 AND receiver_id != sender_id
+        ) AS m
+        GROUP BY user_id, peer_id
+    """)
+    cursor.execute(f"""
+        UPDATE conversations SET (last_message_id, preview, last_timestamp) = (
+            SELECT m.id, {preview.format('m')}, m.timestamp FROM messages m
+            WHERE m.conversation = -conversations.id ORDER BY m.id DESC LIMIT 1
+        )
+        WHERE EXISTS (SELECT 1 FROM messages WHERE conversation = -conversations.id)
+    """)
+
+
+def migrate_retention(cursor):
+    # per-conversation keep_days; the default for everything else is meta 'retention_days'.
+    # A NULL keep_days keeps that conversation forever whatever the default says
+    cursor.execute("CREATE TABLE retention (conversation INTEGER PRIMARY KEY, keep_days INTEGER)")
+
+
+def migrate_password_hashes(cursor):
+    # a one-off scrypt per existing account; rows imported later from old exports are plaintext
+    # again and get hashed on their first sign in instead
+    rows = cursor.execute("SELECT id, password FROM users").fetchall()
+    cursor.executemany("UPDATE users SET password=? WHERE id=?",
+                       [(hash_password(password), user_id) for user_id, password in rows if not is_hashed(password)])
+
+
+# MIGRATIONS[i] upgrades a database from PRAGMA user_version i to i + 1
+MIGRATIONS = [
+    migrate_conversation_key,
+    migrate_message_search,
+    migrate_attachments,
+    migrate_group_chats,
+    migrate_conversation_summary,
+    migrate_retention,
+    migrate_password_hashes,
+]
+
+
+# NDJSON history: a header line, then one object per row with a "type" naming its table
+HISTORY_VERSION = 1
+HISTORY_TABLES = {
+    "user": ("users", ("id", "username", "phone", "password", "profile_picture")),
+    "contact": ("contacts", ("user_id", "contact_id")),
+    "conversation": ("conversations", ("id", "title", "created_by", "created_at")),
+    "member": ("members", ("conversation_id", "user_id", "last_read_id")),
+    "message": ("messages", ("id", "sender_id", "receiver_id", "message", "timestamp", "conversation", "attachment")),
+}
+
+
+def open_history(path, mode):
+    if path == "-":
+        return open(sys.stdout.fileno() if mode == "w" else sys.stdin.fileno(), mode, encoding="utf-8", closefd=False)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+
+def fts_query(text):
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def open_archive(directory, month, readonly=False):
+    path = os.path.join(directory, f"{month}.db")
+    if readonly:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    archive = sqlite3.connect(path)
+    archive.executescript(ARCHIVE_SCHEMA)
+    return archive
+
+
+def write_archive(archive, rows):
+    # rows already there are from a batch archived just before a crash, before it was deleted
+    ids = [row[0] for row in rows]
+    existing = {row[0] for row in archive.execute("SELECT id FROM messages WHERE id BETWEEN ? AND ?",
+                                                  (min(ids), max(ids)))}
+    rows = [row for row in rows if row[0] not in existing]
+    if not rows:
+        return
+    # bodies are stored as one compressed block per batch; the index rows and FTS stay uncompressed
+    data = zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+    with archive:
+        block = archive.execute("INSERT INTO blocks (data) VALUES (?)", (data,)).lastrowid
+        archive.executemany("INSERT INTO messages (id, conversation, block, timestamp) VALUES (?, ?, ?, ?)",
+                            [(row[0], row[5], block, row[4]) for row in rows])
+        archive.executemany("INSERT INTO messages_fts (rowid, message, participants) VALUES (?, ?, ?)",
+                            [(row[0], row[3], participants(row[1], row[2], row[5])) for row in rows])
+
+
+def read_archive(archive, ids):
+    rows, blocks = {}, {}
+    placeholders = ", ".join("?" * len(ids))
+    for message_id, block in archive.execute(f"SELECT id, block FROM messages WHERE id IN ({placeholders})", ids):
+        blocks.setdefault(block, set()).add(message_id)
+    for block, wanted in blocks.items():
+        data = archive.execute("SELECT data FROM blocks WHERE id=?", (block,)).fetchone()[0]
+        for row in json.loads(zlib.decompress(data)):
+            if row[0] in wanted:
+                rows[row[0]] = row
+    return [rows[message_id] for message_id in ids if message_id in rows]
+
+
+def archive_snippet(text, words, width=12):
+    # the archive index is contentless, so the snippet is cut here the way snippet() would
+    tokens = text.split()
+    hits = {i for i, token in enumerate(tokens) if token.strip(string.punctuation).casefold().startswith(words)}
+    start = max(0, min(hits, default=0) - width // 2)
+    end = min(len(tokens), start + width)
+    shown = [HIGHLIGHT[0] + token + HIGHLIGHT[1] if i in hits else token
+             for i, token in enumerate(tokens[start:end], start)]
+    return ("…" if start else "") + " ".join(shown) + ("…" if end < len(tokens) else "")
+
+
+class MessageWriter(threading.Thread):
+    def __init__(self, path, batch_size=256, flush_interval=0.005, pragmas=PRAGMAS):
+        super().__init__(daemon=True)
+        self.path = path
+        self.pragmas = pragmas
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+
+    def submit(self, sender_id, receiver_id, message, attachment=None, conversation=None):
+        if conversation is None:
+            conversation = conversation_key(sender_id, receiver_id)
+        future = Future()
+        self.queue.put((sender_id, receiver_id, message, conversation, attachment, future))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        configure_connection(conn, self.pragmas)
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self.flush(conn, batch)
+        conn.close()
+
+    def flush(self, conn, batch):
+        with FLUSH_TIME.time():
+            self.write_batch(conn, batch)
+        MESSAGES_WRITTEN.inc(len(batch))
+
+    def write_batch(self, conn, batch):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                INSERT_MESSAGE,
+                [item[:5] for item in batch]
+            )
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for item in batch:
+                item[5].set_exception(e)
+            return
+        # AUTOINCREMENT ids are contiguous inside one write transaction
+        first_id = last_id - len(batch) + 1
+        for i, item in enumerate(batch):
+            item[5].set_result(first_id + i)
+
+
+class Database:
+    def __init__(self, path=DB_PATH, group_commit=False, batch_size=256, flush_interval=0.005,
+                 check_same_thread=True, pragmas=None, archive=None):
+        # an in-memory database belongs to this one connection, so nothing else can write to it
+        if path == MEMORY and group_commit:
+            raise ValueError("group commit needs a database file, not :memory:")
+        self.path = path
+        # directory of the monthly archives; an in-memory database only archives if given one
+        self.archive = archive or (None if path == MEMORY else archive_dir(path))
+        self.pragmas = pragma_settings(pragmas)
+        self.conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+        configure_connection(self.conn, self.pragmas)
+        self.create_tables()
+        self.migrate()
+        self.restore_deferred()
+        self.writer = None
+        if group_commit:
+            self.writer = MessageWriter(path, batch_size, flush_interval, self.pragmas)
+            self.writer.start()
+
+    def close(self):
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        self.conn.close()
+
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                phone TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                profile_picture TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS contacts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                contact_id INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (contact_id) REFERENCES users (id),
+                UNIQUE (user_id, contact_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_id INTEGER NOT NULL,
+                receiver_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (sender_id) REFERENCES users (id),
+                FOREIGN KEY (receiver_id) REFERENCES users (id)
+            )
+        """)
+        self.conn.commit()
+
+    def migrate(self):
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        for target, migration in enumerate(MIGRATIONS, 1):
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # read again under the write lock: another process or thread opening the same
+                # database may have applied this step while we waited for it
+                if cursor.execute("PRAGMA user_version").fetchone()[0] >= target:
+                    self.conn.rollback()
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version={target}")
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    @query_timer
+    def add_user(self, username, phone, password, profile_picture=None):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT INTO users (username, phone, password, profile_picture) VALUES (?, ?, ?, ?)",
+                (username, phone, hash_password(password), profile_picture)
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    @query_timer
+    def get_user(self, username=None, phone=None, user_id=None):
+        cursor = self.conn.cursor()
+        if username:
+            cursor.execute("SELECT * FROM users WHERE username=?", (username,))
+        elif phone:
+            cursor.execute("SELECT * FROM users WHERE phone=?", (phone,))
+        elif user_id:
+            cursor.execute("SELECT * FROM users WHERE id=?", (user_id,))
+        else:
+            return None
+        return cursor.fetchone()
+
+    def check_password(self, username, password):
+        # scrypt is slow on purpose, so this belongs on a worker thread, never the GUI one.
+        # Read only; returns the user row, or None for an unknown user or a wrong password
+        user = self.get_user(username=username)
+        if not user or not verification_cache.verify(password, user[3]):
+            return None
+        return user
+
+    def rehash_password(self, user_id, stored, password):
+        # for a password check_password accepted against plaintext or cheaper parameters (see
+        # needs_rehash). The old value in the WHERE keeps a concurrent change from being overwritten
+        self.conn.execute("UPDATE users SET password=? WHERE id=? AND password=?",
+                          (hash_password(password), user_id, stored))
+        self.conn.commit()
+
+    @query_timer
+    def add_contact(self, user_id, contact_username):
+        contact = self.get_user(username=contact_username)
+        if not contact:
+            return False
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT INTO contacts (user_id, contact_id) VALUES (?, ?)",
+                (user_id, contact[0])
+            )
+            self.conn.commit()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    @query_timer
+    def get_contacts(self, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT u.id, u.username, u.profile_picture 
+            FROM users u JOIN contacts c ON u.id = c.contact_id 
+            WHERE c.user_id=?
+        """, (user_id,))
+        return cursor.fetchall()
+
+    def add_message_async(self, sender_id, receiver_id, message, attachment=None):
+        if self.writer:
+            return self.writer.submit(sender_id, receiver_id, message, attachment)
+        future = Future()
+        future.set_result(self.add_message(sender_id, receiver_id, message, attachment))
+        return future
+
+    def add_message(self, sender_id, receiver_id, message, attachment=None):
+        return self.insert_message(sender_id, receiver_id, message, attachment,
+                                   conversation_key(sender_id, receiver_id))
+
+    def add_group_message(self, conversation_id, sender_id, message, attachment=None):
+        return self.insert_message(sender_id, GROUP_RECEIVER, message, attachment, group_key(conversation_id))
+
+    @query_timer
+    def insert_message(self, sender_id, receiver_id, message, attachment, conversation):
+        if self.writer:
+            return self.writer.submit(sender_id, receiver_id, message, attachment, conversation).result()
+        cursor = self.conn.cursor()
+        cursor.execute(INSERT_MESSAGE, (sender_id, receiver_id, message, conversation, attachment))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def get_messages_page(self, user1_id, user2_id, before_id=None, limit=50):
+        return self.conversation_page(conversation_key(user1_id, user2_id), before_id, limit)
+
+    def get_group_messages_page(self, conversation_id, before_id=None, limit=50):
+        return self.conversation_page(group_key(conversation_id), before_id, limit)
+
+    @query_timer
+    def conversation_page(self, conversation, before_id, limit):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT * FROM messages WHERE conversation=? AND id<? ORDER BY id DESC LIMIT ?",
+            (conversation, MAX_ID if before_id is None else before_id, limit)
+        )
+        rows = cursor.fetchall()
+        rows.reverse()
+        return rows
+
+    def create_group(self, user_id, title, member_ids):
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT INTO conversations (title, created_by) VALUES (?, ?)", (title, user_id))
+        conversation_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT OR IGNORE INTO members (conversation_id, user_id) VALUES (?, ?)",
+            [(conversation_id, member_id) for member_id in {user_id, *member_ids}]
+        )
+        self.conn.commit()
+        return conversation_id
+
+    def add_group_member(self, conversation_id, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO members (conversation_id, user_id) VALUES (?, ?)",
+                       (conversation_id, user_id))
+        self.conn.commit()
+        return cursor.rowcount > 0
+
+    @query_timer
+    def get_chat_list(self, user_id):
+        # contacts and groups, most recent first; groups are listed under -conversation_id
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT u.id, u.username, u.profile_picture, s.preview, coalesce(s.unread, 0),
+                   coalesce(s.last_message_id, 0) AS last_message_id
+            FROM contacts c JOIN users u ON u.id = c.contact_id
+            LEFT JOIN conversation_summary s ON s.user_id = c.user_id AND s.peer_id = c.contact_id
+            WHERE c.user_id=?
+            UNION ALL
+            SELECT -g.id, g.title, NULL, g.preview,
+                   (SELECT count(*) FROM messages WHERE conversation = -g.id AND id > m.last_read_id
+                                                        AND sender_id != m.user_id),
+                   g.last_message_id
+            FROM members m JOIN conversations g ON g.id = m.conversation_id
+            WHERE m.user_id=?
+            ORDER BY last_message_id DESC
+        """, (user_id, user_id))
+        return cursor.fetchall()
+
+    def get_groups(self, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT c.id, c.title,
+                   (SELECT count(*) FROM messages WHERE conversation = -c.id AND id > m.last_read_id
+                                                        AND sender_id != m.user_id),
+                   c.preview
+            FROM members m JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.user_id=?
+            ORDER BY c.id
+        """, (user_id,))
+        return cursor.fetchall()
+
+    def get_group_members(self, conversation_id):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT u.id, u.username FROM members m JOIN users u ON u.id = m.user_id
+            WHERE m.conversation_id=?
+        """, (conversation_id,))
+        return cursor.fetchall()
+
+    @query_timer
+    def get_unread(self, user_id, contact_id):
+        # contact_id as listed by get_chat_list, so negative for groups
+        if contact_id < 0:
+            row = self.conn.execute("""
+                SELECT (SELECT count(*) FROM messages WHERE conversation=? AND id > m.last_read_id
+                                                            AND sender_id != m.user_id)
+                FROM members m WHERE m.conversation_id=? AND m.user_id=?
+            """, (group_key(-contact_id), -contact_id, user_id)).fetchone()
+        else:
+            row = self.conn.execute("SELECT unread FROM conversation_summary WHERE user_id=? AND peer_id=?",
+                                    (user_id, contact_id)).fetchone()
+        return row[0] if row else 0
+
+    @query_timer
+    def mark_read(self, user_id, contact_id):
+        # contact_id as listed by get_chat_list, so negative for groups
+        cursor = self.conn.cursor()
+        if contact_id < 0:
+            cursor.execute("""
+                UPDATE members
+                SET last_read_id = coalesce((SELECT max(id) FROM messages WHERE conversation=?), 0)
+                WHERE conversation_id=? AND user_id=?
+            """, (group_key(-contact_id), -contact_id, user_id))
+        else:
+            cursor.execute("UPDATE conversation_summary SET unread=0 WHERE user_id=? AND peer_id=?",
+                           (user_id, contact_id))
+        self.conn.commit()
+
+    @query_timer
+    def get_messages(self, user1_id, user2_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT * FROM messages WHERE conversation=? ORDER BY id",
+            (conversation_key(user1_id, user2_id),)
+        )
+        return cursor.fetchall()
+
+    def participant_filter(self, user_id):
+        cursor = self.conn.execute("SELECT conversation_id FROM members WHERE user_id=?", (user_id,))
+        return " OR ".join([f'"u{int(user_id)}"'] + [f'"g{row[0]}"' for row in cursor.fetchall()])
+
+    @query_timer
+    def search_messages(self, user_id, query, limit=50):
+        query = fts_query(query)
+        if not query:
+            return []
+        cursor = self.conn.cursor()
+        participants = self.participant_filter(user_id)
+        # group hits report the negative group key as receiver so callers can tell them apart
+        cursor.execute(f"""
+            SELECT m.id, m.sender_id, CASE WHEN m.conversation < 0 THEN m.conversation ELSE m.receiver_id END,
+                   snippet(messages_fts, 0, '{HIGHLIGHT[0]}', '{HIGHLIGHT[1]}', '…', 12), m.timestamp
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+            ORDER BY bm25(messages_fts, 1.0, 0.0)
+            LIMIT ?
+        """, (f'message : ({query}) AND participants : ({participants})', limit))
+        return cursor.fetchall()
+
+    def search_archive(self, user_id, query, limit=50):
+        # archives are only opened when asked, newest month first, until limit hits are found
+        match = fts_query(query)
+        if not match or not self.archive or not os.path.isdir(self.archive):
+            return []
+        match = f'message : ({match}) AND participants : ({self.participant_filter(user_id)})'
+        words = tuple(word.casefold() for word in query.split())
+        results = []
+        for name in sorted(os.listdir(self.archive), reverse=True):
+            if len(results) >= limit:
+                break
+            if not name.endswith(".db"):
+                continue
+            archive = open_archive(self.archive, name[:-3], readonly=True)
+            try:
+                ids = [row[0] for row in archive.execute(
+                    "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? "
+                    "ORDER BY bm25(messages_fts, 1.0, 0.0) LIMIT ?", (match, limit - len(results)))]
+                for message_id, sender_id, receiver_id, message, timestamp, conversation, _ in read_archive(archive, ids):
+                    results.append((message_id, sender_id, conversation if conversation < 0 else receiver_id,
+                                    archive_snippet(message, words), timestamp))
+            finally:
+                archive.close()
+        return results
+
+    def set_retention(self, keep_days, conversation=None):
+        # conversation is a conversation key (group_key for groups); None sets the default for the rest
+        if conversation is None:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('retention_days', ?)", (keep_days,))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO retention (conversation, keep_days) VALUES (?, ?)",
+                              (conversation, keep_days))
+        self.conn.commit()
+
+    def clear_retention(self, conversation):
+        self.conn.execute("DELETE FROM retention WHERE conversation=?", (conversation,))
+        self.conn.commit()
+
+    def retention_horizon(self):
+        # nothing newer than the shortest keep_days in use can be due for archiving
+        row = self.conn.execute("""
+            SELECT datetime('now', printf('-%d days', min(keep_days))) FROM (
+                SELECT value AS keep_days FROM meta WHERE key='retention_days'
+                UNION ALL SELECT keep_days FROM retention
+            ) WHERE keep_days IS NOT NULL
+        """).fetchone()
+        return row[0]
+
+    def archive_batch(self, after_id=0, batch_size=ARCHIVE_BATCH):
+        # one step of archiving: the next batch_size ids after after_id are checked against their
+        # conversation's retention, copied to their month's archive, then deleted here in a short
+        # write transaction of their own. Returns (rows archived, id to continue after or None)
+        if not self.archive:
+            raise ValueError("archiving needs an archive directory")
+        # rows from before search existed are indexed newest first, and deleting a row that is not
+        # in the index yet corrupts it, so nothing is archived until the backfill has finished
+        if self.search_backfill_pending():
+            return 0, None
+        horizon = self.retention_horizon()
+        if horizon is None:
+            return 0, None
+        cursor = self.conn.cursor()
+        first = cursor.execute("SELECT id, timestamp FROM messages WHERE id>? ORDER BY id LIMIT 1",
+                               (after_id,)).fetchone()
+        # ids grow with time, so the first row past the horizon ends the pass
+        if first is None or first[1] is None or first[1] >= horizon:
+            return 0, None
+        last_id = first[0] + batch_size - 1
+        default = cursor.execute("SELECT value FROM meta WHERE key='retention_days'").fetchone()
+        rows = cursor.execute(f"""
+            SELECT {', '.join(HISTORY_TABLES['message'][1])} FROM (
+                SELECT m.*, CASE WHEN r.conversation IS NULL THEN ? ELSE r.keep_days END AS keep_days
+                FROM messages m LEFT JOIN retention r ON r.conversation = m.conversation
+                WHERE m.id>=? AND m.id<=?
+            )
+            WHERE keep_days IS NOT NULL AND timestamp < datetime('now', printf('-%d days', keep_days))
+        """, (default[0] if default else None, first[0], last_id)).fetchall()
+        if rows:
+            os.makedirs(self.archive, exist_ok=True)
+            months = {}
+            for row in rows:
+                months.setdefault(row[4][:7], []).append(row)
+            for month, batch in months.items():
+                archive = open_archive(self.archive, month)
+                try:
+                    write_archive(archive, batch)
+                finally:
+                    archive.close()
+            # each delete also updates the search index, so the lock is taken a hundred rows at a time.
+            # A crash in between leaves rows in both places; the next pass skips them in the archive
+            ids = [(row[0],) for row in rows]
+            for i in range(0, len(ids), ARCHIVE_LOCK_ROWS):
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    cursor.executemany("DELETE FROM messages WHERE id=?", ids[i:i + ARCHIVE_LOCK_ROWS])
+                    self.conn.commit()
+                except sqlite3.Error:
+                    self.conn.rollback()
+                    raise
+            MESSAGES_ARCHIVED.inc(len(rows))
+            # deletes only add tombstones to the search index; a bounded merge folds them in as we go
+            cursor.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', ?)", (-ARCHIVE_MERGE_PAGES,))
+            self.conn.commit()
+            # freed pages go back to the file system a few at a time instead of in one blocking VACUUM;
+            # what is left over is picked up by the next batch. executescript steps the pragma to
+            # completion, execute would free a single page
+            self.conn.executescript(f"PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})")
+        return len(rows), last_id
+
+    def archive_messages(self, batch_size=ARCHIVE_BATCH):
+        while self.backfill_search_index():
+            pass
+        archived, after_id = 0, 0
+        while after_id is not None:
+            count, after_id = self.archive_batch(after_id, batch_size)
+            archived += count
+        return archived
+
+    def compact(self):
+        # one-off, blocking: databases created before auto_vacuum was set need a VACUUM to switch to it
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("VACUUM")
+        self.conn.executescript("PRAGMA incremental_vacuum")
+
+    def search_backfill_pending(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key='fts_backfill_upto'").fetchone()
+        return bool(row and row[0] > 0)
+
+    def backfill_search_index(self, batch_size=20000):
+        cursor = self.conn.cursor()
+        row = cursor.execute("SELECT value FROM meta WHERE key='fts_backfill_upto'").fetchone()
+        if not row or row[0] <= 0:
+            return False
+        upto = row[0]
+        low = max(0, upto - batch_size)
+        cursor.execute(
+            "INSERT INTO messages_fts (rowid, message, participants) "
+            "SELECT id, message, participants FROM messages_search WHERE id>? AND id<=?",
+            (low, upto)
+        )
+        cursor.execute("UPDATE meta SET value=? WHERE key='fts_backfill_upto'", (low,))
+        self.conn.commit()
+        return low > 0
+
+    def export_history(self, f):
+        # one read transaction, so the export is a consistent snapshot even while the app is writing
+        count = 0
+        self.conn.execute("BEGIN")
+        try:
+            f.write(json.dumps({"type": "header", "version": HISTORY_VERSION}, separators=(",", ":")) + "\n")
+            for kind, (table, columns) in HISTORY_TABLES.items():
+                cursor = self.conn.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                for row in cursor:
+                    record = {"type": kind}
+                    record.update(zip(columns, row))
+                    f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    count += 1
+        finally:
+            self.conn.rollback()
+        return count
+
+    def import_history(self, f, batch_size=50000):
+        cursor = self.conn.cursor()
+        if cursor.execute("SELECT exists(SELECT 1 FROM users) OR exists(SELECT 1 FROM messages)").fetchone()[0]:
+            raise ValueError("history can only be imported into an empty database")
+        # secondary indexes and the search/summary triggers are rebuilt once at the end instead of per row
+        deferred = cursor.execute("""
+            SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND tbl_name IN ('messages', 'members') AND sql IS NOT NULL
+        """).fetchall()
+        # dropped in the same transaction that records them, so an import that dies part way leaves
+        # a marker restore_deferred() finds on the next open instead of a database missing its triggers
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('import_deferred', ?)",
+                           (json.dumps(deferred),))
+            for kind, name, sql in deferred:
+                cursor.execute(f"DROP {kind.upper()} {name}")
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        # index builds sort in temp storage; on disk that stays bounded by cache_size instead of the row count
+        cursor.execute("PRAGMA temp_store=FILE")
+        counts = dict.fromkeys(HISTORY_TABLES, 0)
+        try:
+            kind, batch = None, []
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("type") == "header":
+                    if record.get("version", 0) > HISTORY_VERSION:
+                        raise ValueError(f"history version {record.get('version')} is newer than this app")
+                    continue
+                if record.get("type") not in HISTORY_TABLES:
+                    raise ValueError(f"unknown history record type {record.get('type')!r}")
+                if batch and (record["type"] != kind or len(batch) >= batch_size):
+                    counts[kind] += self.insert_history(kind, batch)
+                    batch = []
+                kind = record["type"]
+                batch.append(tuple(record.get(column) for column in HISTORY_TABLES[kind][1]))
+            if batch:
+                counts[kind] += self.insert_history(kind, batch)
+        finally:
+            self.restore_deferred()
+            configure_connection(self.conn, self.pragmas)
+        return counts
+
+    def restore_deferred(self):
+        # recreates the indexes and triggers import_history dropped, then rebuilds what they maintain
+        if not self.conn.execute("SELECT 1 FROM meta WHERE key='import_deferred'").fetchone():
+            return
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            row = cursor.execute("SELECT value FROM meta WHERE key='import_deferred'").fetchone()
+            if row:
+                for kind, name, sql in json.loads(row[0]):
+                    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type=? AND name=?",
+                                          (kind, name)).fetchone():
+                        cursor.execute(sql)
+                cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+                cursor.execute("UPDATE meta SET value=0 WHERE key='fts_backfill_upto'")
+                rebuild_conversation_summary(cursor)
+                cursor.execute("DELETE FROM meta WHERE key='import_deferred'")
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
+    def insert_history(self, kind, batch):
+        table, columns = HISTORY_TABLES[kind]
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", batch)
+        return len(batch)
+
+    def update_user(self, user_id, username=None, phone=None, password=None, profile_picture=None):
+        cursor = self.conn.cursor()
+        updates, params = [], []
+        if username:
+            updates.append("username=?")
+            params.append(username)
+        if phone:
+            updates.append("phone=?")
+            params.append(phone)
+        if password:
+            updates.append("password=?")
+            params.append(hash_password(password))
+        if profile_picture:
+            updates.append("profile_picture=?")
+            params.append(profile_picture)
+        if updates:
+            query = "UPDATE users SET " + ", ".join(updates) + " WHERE id=?"
+            params.append(user_id)
+            cursor.execute(query, tuple(params))
+            self.conn.commit()
+            return True
+        return False
+
+
+def history_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="messanger.py", description="Export, import or archive message history")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export", help="write users, contacts, groups and messages to NDJSON")
+    p.add_argument("path", help="output file; .gz is compressed, - is stdout")
+    p.add_argument("--db", default=DB_PATH)
+    p = sub.add_parser("import", help="load an NDJSON export into an empty database")
+    p.add_argument("path", help="input file; .gz is decompressed, - is stdin")
+    p.add_argument("--db", default=DB_PATH)
+    p.add_argument("--batch-size", type=int, default=50000, help="rows per transaction")
+    p = sub.add_parser("retention", help="set how many days messages are kept before archiving")
+    p.add_argument("--days", type=int, help="days to keep; 0 archives everything, omit to keep forever")
+    p.add_argument("--conversation", type=int, help="conversation key; default applies to all others")
+    p.add_argument("--clear", action="store_true", help="drop the conversation's own policy")
+    p.add_argument("--db", default=DB_PATH)
+    p = sub.add_parser("archive", help="move messages past their retention into the monthly archives")
+    p.add_argument("--db", default=DB_PATH)
+    p.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH, help="rows per transaction")
+    p = sub.add_parser("compact", help="rewrite the database once so freed pages are returned to the OS")
+    p.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args(argv)
+
+    db = Database(args.db)
+    start = time.perf_counter()
+    try:
+        if args.command == "retention":
+            if args.clear:
+                if args.conversation is None:
+                    parser.error("--clear needs --conversation")
+                db.clear_retention(args.conversation)
+            else:
+                db.set_retention(args.days, args.conversation)
+            return 0
+        if args.command == "compact":
+            db.compact()
+            print(f"compacted in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            return 0
+        if args.command == "archive":
+            rows = db.archive_messages(args.batch_size)
+        else:
+            with open_history(args.path, "w" if args.command == "export" else "r") as f:
+                if args.command == "export":
+                    rows = db.export_history(f)
+                else:
+                    counts = db.import_history(f, args.batch_size)
+                    rows = sum(counts.values())
+                    print(", ".join(f"{count} {kind}s" for kind, count in counts.items()), file=sys.stderr)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start
+    verb = "archived" if args.command == "archive" else args.command + "ed"
+    print(f"{verb} {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} rows/sec)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(history_main(sys.argv[1:]))
@@ -1,199 +1,491 @@
 import sys
 import os
-import sqlite3
+import time
+import zlib
 import socket
 import threading
-from datetime import datetime
-from PyQt6.QtWidgets import QListWidgetItem, QWidget, QLabel, QHBoxLayout
-from PyQt6.QtGui import QPixmap, QPainter, QPainterPath
-from PyQt6.QtCore import Qt, QSize
-from PyQt6.QtWidgets import QFileDialog
+import random
+import hashlib
 import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (HELLO, MESSAGE, SUBSCRIBE, PRESENCE, ACK, PING, FILE, JOIN, GROUP, COMPRESS, ONLINE, ZLIB,
+                      FrameDecoder, ProtocolError, encode_frame, encode_ids)
+from attachments import AttachmentStore, TransferClient, file_digest, is_digest
+import metrics
+from passwords import needs_rehash
+from database import (BASE_DIR, DB_PATH, MEMORY, GROUP_RECEIVER, ARCHIVE_BATCH, MessageWriter, Database,
+                      group_key, message_preview, pragma_settings, history_main)
+
+if __name__ == "__main__" and sys.argv[1:2] in (["export"], ["import"], ["retention"], ["archive"], ["compact"]):
+    # these only need the database, so they run before Qt is loaded
+    sys.exit(history_main(sys.argv[1:]))
+
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QStackedWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QLineEdit, QPushButton, QMessageBox, QFileDialog, QListWidget,
-    QTextEdit, QListWidgetItem, QDialog
+    QListWidgetItem, QDialog, QListView, QAbstractItemView, QStyledItemDelegate, QStyle
 )
-from PyQt6.QtGui import QIcon,QPixmap
-from PyQt6.QtCore import Qt, pyqtSignal, QObject
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "messenger.db")
+from PyQt6.QtGui import (QIcon, QPixmap, QColor, QImage, QFont, QLinearGradient, QPainter, QPainterPath,
+                         QStandardItemModel, QStandardItem)
+from PyQt6.QtCore import (Qt, QSize, pyqtSignal, QObject, QAbstractListModel, QModelIndex, QRect, QTimer,
+                          QRunnable, QThreadPool)
+
+THUMBS_DIR = os.path.join(BASE_DIR, "thumbnails")
+DOWNLOADS_DIR = os.path.join(BASE_DIR, "downloads")
+IMAGES_DIR = os.path.join(BASE_DIR, "images")
+IMAGE_SIZES = (48, 150)
+
+PAGE_SIZE = 50
+ARCHIVE_INTERVAL_MS = 6 * 60 * 60 * 1000
+AVATAR_ROLE = 0x0101
+ONLINE_ROLE = 0x0102
+ATTACHMENT_ROLE = 0x0103
+PREVIEW_ROLE = 0x0104
+UNREAD_ROLE = 0x0105
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+
+# relay link tuning, both off unless asked for: MESSENGER_COALESCE_MS=5 batches sends for up to
+# 5 ms (or COALESCE_BYTES), MESSENGER_COMPRESS=1 asks the relay for a zlib stream
+COALESCE_MS = float(os.environ.get("MESSENGER_COALESCE_MS", 0))
+COALESCE_BYTES = 16384
+COMPRESSION = bool(os.environ.get("MESSENGER_COMPRESS"))
+
+MESSAGES_SENT = metrics.counter("client_messages_sent", "Chat messages handed to ClientSocket.send")
+MESSAGES_RECEIVED = metrics.counter("client_messages_received", "Chat messages delivered by the relay")
+BYTES_SENT = metrics.counter("client_bytes_sent", "Bytes written to the relay connection")
+BYTES_RECEIVED = metrics.counter("client_bytes_received", "Bytes read from the relay connection")
+SEND_DROPPED = metrics.counter("client_send_dropped", "Messages dropped from a full offline buffer")
+gui_timer = metrics.timed_by("gui_handler", "Time the GUI thread spends in a handler", "handler")
+
+
+class AsyncDatabase(QObject):
+    finished = pyqtSignal(object, object)
+
+    def __init__(self, path=DB_PATH, readers=4, batch_size=256, flush_interval=0.005, pragmas=None):
+        super().__init__()
+        if path == MEMORY:
+            raise ValueError("AsyncDatabase shares one database between threads and needs a file, not :memory:")
+        self.path = path
+        self.pragmas = pragmas
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.write_pool = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+        self.read_pool = ThreadPoolExecutor(readers, thread_name_prefix="db-read")
+        # the first write job opens the database and applies any pending migrations; they can take a
+        # while (a scrypt per plaintext password), so they run here rather than on the GUI thread,
+        # and every job waits for them
+        self.migrated = self.write_pool.submit(self.connection)
+        self.writer = MessageWriter(path, batch_size, flush_interval, pragma_settings(pragmas))
+        self.writer.start()
+        self.archiving = False
+        self.finished.connect(self.deliver)
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # each connection stays on its worker thread; close() only touches it after the pools stop
+            db = self.local.db = Database(self.path, check_same_thread=False, pragmas=self.pragmas)
+            with self.lock:
+                self.connections.append(db)
+        return db
+
+    def call(self, method, args, kwargs):
+        self.migrated.result()
+        return getattr(self.connection(), method)(*args, **kwargs)
+
+    def submit(self, pool, method, args, kwargs, callback):
+        future = pool.submit(self.call, method, args, kwargs)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def read(self, method, *args, callback=None, **kwargs):
+        return self.submit(self.read_pool, method, args, kwargs, callback)
+
+    def write(self, method, *args, callback=None, **kwargs):
+        return self.submit(self.write_pool, method, args, kwargs, callback)
+
+    def add_message(self, sender_id, receiver_id, message, attachment=None, callback=None):
+        future = self.writer.submit(sender_id, receiver_id, message, attachment)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def add_group_message(self, conversation_id, sender_id, message, attachment=None, callback=None):
+        future = self.writer.submit(sender_id, GROUP_RECEIVER, message, attachment, group_key(conversation_id))
+        if callback is not None:
+            future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def backfill_search_index(self, batch_size=20000, done=None):
+        # one short write transaction per batch so the backfill never holds up sends for long
+        def next_batch(more):
+            if more:
+                self.write("backfill_search_index", batch_size, callback=next_batch)
+            elif done is not None:
+                done()
+        next_batch(True)
+
+    def archive_messages(self, batch_size=ARCHIVE_BATCH):
+        # the same one-batch-per-job chain, so retention never holds the write lock for long
+        if self.archiving:
+            return
+        self.archiving = True
 
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_PATH)
-        self.create_tables()
-
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                phone TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                profile_picture TEXT
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS contacts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                contact_id INTEGER NOT NULL,
-                FOREIGN KEY (user_id) R EFERENCES users (id),
-                FOREIGN KEY (contact_id) REFERENCES users (id),
-                UNIQUE (user_id, contact_id)
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER NOT NULL,
-                receiver_id INTEGER NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id)
-            )
-        """)
-        self.conn.commit()
+        def next_batch(result):
+            if result is None or result[1] is None:
+                self.archiving = False
+                return
+            self.write("archive_batch", result[1], batch_size, callback=next_batch)
+        next_batch((0, 0))
 
-    def add_user(self, username, phone, password, profile_picture=None):
+    def deliver(self, callback, future):
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT INTO users (username, phone, password, profile_picture) VALUES (?, ?, ?, ?)",
-                (username, phone, password, profile_picture)
-            )
-            self.conn.commit()
-            return cursor.lastrowid
-        except sqlite3.IntegrityError:
-            return None
-
-    def get_user(self, username=None, phone=None, user_id=None):
-        cursor = self.conn.cursor()
-        if username:
-            cursor.execute("SELECT * FROM users WHERE username=?", (username,))
-        elif phone:
-            cursor.execute("SELECT * FROM users WHERE phone=?", (phone,))
-        elif user_id:
-            cursor.execute("SELECT * FROM users WHERE id=?", (user_id,))
-        else:
-            return None
-        return cursor.fetchone()
+            result = future.result()
+        except Exception as e:
+            print(f"Database error: {e}")
+            result = None
+        callback(result)
 
-    def add_contact(self, user_id, contact_username):
-        contact = self.get_user(username=contact_username)
-        if not contact:
-            return False
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-                "INSERT INTO contacts (user_id, contact_id) VALUES (?, ?)",
-                (user_id, contact[0])
-            )
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
+    def close(self):
+        self.read_pool.shutdown(wait=True)
+        self.write_pool.shutdown(wait=True)
+        self.writer.stop()
+        with self.lock:
+            for db in self.connections:
+                db.conn.close()
+            self.connections.clear()
 
-    def get_contacts(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT u.id, u.username, u.profile_picture 
-            FROM users u JOIN contacts c ON u.id = c.contact_id 
-            WHERE c.user_id=?
-        """, (user_id,))
-        return cursor.fetchall()
-
-    def add_message(self, sender_id, receiver_id, message):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT INTO messages (sender_id, receiver_id, message) VALUES (?, ?, ?)",
-            (sender_id, receiver_id, message)
-        )
-        self.conn.commit()
-        return cursor.lastrowid
-
-    def get_messages(self, user1_id, user2_id):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT * FROM messages 
-            WHERE (sender_id=? AND receiver_id=?) OR (sender_id=? AND receiver_id=?)
-            ORDER BY timestamp
-        """, (user1_id, user2_id, user2_id, user1_id))
-        return cursor.fetchall()
-
-    def update_user(self, user_id, username=None, phone=None, password=None, profile_picture=None):
-        cursor = self.conn.cursor()
-        updates, params = [], []
-        if username:
-            updates.append("username=?")
-            params.append(username)
-        if phone:
-            updates.append("phone=?")
-            params.append(phone)
-        if password:
-            updates.append("password=?")
-            params.append(password)
-        if profile_picture:
-            updates.append("profile_picture=?")
-            params.append(profile_picture)
-        if updates:
-            query = "UPDATE users SET " + ", ".join(updates) + " WHERE id=?"
-            params.append(user_id)
-            cursor.execute(query, tuple(params))
-            self.conn.commit()
-            return True
-        return False
 
 class ClientSocket(QObject):
-    message_received = pyqtSignal(str, str)
-
-    def __init__(self, host, port):
+    message_received = pyqtSignal(int, str)
+    presence_changed = pyqtSignal(int, bool)
+    attachment_received = pyqtSignal(int, str, str)
+    group_message_received = pyqtSignal(int, int, str)
+    state_changed = pyqtSignal(str)
+
+    def __init__(self, host, port, user_id, last_seen=0, heartbeat=10.0, max_backoff=30.0, max_pending=1000,
+                 coalesce_ms=COALESCE_MS, coalesce_bytes=COALESCE_BYTES, compress=COMPRESSION):
         super().__init__()
         self.host, self.port = host, port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.user_id = user_id
+        # highest relay seq handled; sent in HELLO so the relay only replays what we missed
+        self.last_seen = last_seen
+        self.heartbeat = heartbeat
+        self.max_backoff = max_backoff
+        # frames written while disconnected, flushed in order after the next HELLO
+        self.pending = deque(maxlen=max_pending)
+        self.watching = set()
+        self.groups = {}
+        self.socket = None
+        self.state = DISCONNECTED
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
         self.running = True
+        # coalescing: frames sent while connected wait in the outbox for up to coalesce seconds
+        self.coalesce = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self.outbox = []
+        self.outbox_size = 0
+        self.outbox_since = 0.0
+        self.outbox_ready = threading.Condition(self.send_lock)
+        self.compress = compress
+        # set once the relay grants compression; everything written after that goes through it
+        self.deflater = None
 
     def connect_to_server(self):
+        # returns at once; the first attempt is made on the connection thread, watch state_changed for the result
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        if self.coalesce:
+            threading.Thread(target=self.flush_periodically, daemon=True).start()
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.state_changed.emit(state)
+
+    def open(self):
+        self.set_state(CONNECTING)
         try:
-            self.socket.connect((self.host, self.port))
-            threading.Thread(target=self.receive_messages, daemon=True).start()
+            sock = socket.create_connection((self.host, self.port), timeout=self.heartbeat)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(self.heartbeat))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(self.heartbeat))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            with self.send_lock:
+                # a new connection starts uncompressed until the relay answers this HELLO
+                self.deflater = None
+                features = ZLIB if self.compress else 0
+                hello = (encode_frame(HELLO, self.user_id, features, self.last_seen, payload=encode_ids(self.watching))
+                         + b"".join(self.join_frame(conversation_id) for conversation_id in self.groups)
+                         + b"".join(self.outbox) + b"".join(self.pending))
+                sock.sendall(hello)
+                BYTES_SENT.inc(len(hello))
+                self.outbox, self.outbox_size = [], 0
+                self.pending.clear()
+                if not self.running:
+                    # close() ran while we were connecting
+                    sock.close()
+                    return False
+                self.socket = sock
+            self.set_state(CONNECTED)
             return True
-        except Exception as e:
+        except OSError as e:
             print(f"Connection error: {e}")
+            self.set_state(DISCONNECTED)
             return False
 
+    def run(self):
+        delay = 0
+        while self.running:
+            if self.socket is None:
+                # full jitter keeps a relay restart from being hit by every client at once
+                if delay:
+                    self.stopped.wait(random.uniform(0, delay))
+                delay = min(max(delay * 2, 0.5), self.max_backoff)
+                if not self.running or not self.open():
+                    continue
+            delay = 0.5
+            self.receive_messages()
+            with self.send_lock:
+                sock, self.socket = self.socket, None
+            if sock is not None:
+                sock.close()
+            self.set_state(DISCONNECTED)
+
     def receive_messages(self):
+        decoder = FrameDecoder()
+        sock = self.socket
+        waiting_for_pong = False
         while self.running:
             try:
-                data = self.socket.recv(1024).decode('utf-8')
-                if data:
-                    username, message = data.split(':', 1)
-                    self.message_received.emit(username, message)
-            except Exception:
-                break
-
-    def send_message(self, username, message):
+                n = sock.recv_into(decoder.writable())
+            except socket.timeout:
+                if waiting_for_pong:
+                    print("Connection error: relay stopped answering")
+                    return
+                # a silent link is probed with a PING; no reply within another interval means it is dead
+                waiting_for_pong = self.try_send(encode_frame(PING, self.user_id, 0))
+                continue
+            except OSError:
+                return
+            if not n:
+                return
+            BYTES_RECEIVED.inc(n)
+            waiting_for_pong = False
+            last_seen = self.last_seen
+            try:
+                decoder.advance(n)
+                for frame in decoder.frames():
+                    if frame.kind == MESSAGE or frame.kind == FILE or frame.kind == GROUP:
+                        # replays after a reconnect can overlap what we already handled
+                        if frame.msg_id <= self.last_seen:
+                            continue
+                        # counted as seen first, so a frame that cannot be handled is still acknowledged
+                        self.last_seen = frame.msg_id
+                        if frame.kind == MESSAGE:
+                            self.message_received.emit(frame.sender_id, frame.text())
+                        elif frame.kind == GROUP:
+                            self.group_message_received.emit(frame.receiver_id, frame.sender_id, frame.text())
+                        else:
+                            self.attachment_received.emit(frame.sender_id, str(frame.payload[:64], "ascii", "replace"),
+                                                          str(frame.payload[64:], "utf-8", "replace"))
+                        MESSAGES_RECEIVED.inc()
+                    elif frame.kind == PRESENCE:
+                        self.presence_changed.emit(frame.sender_id, frame.msg_id == ONLINE)
+                    elif frame.kind == HELLO and frame.receiver_id & ZLIB:
+                        # compression granted: the relay's side is deflated from the next byte on
+                        self.start_compression()
+                        decoder.inflate()
+            except ProtocolError as e:
+                print(f"Connection error: {e}")
+                return
+            except Exception as e:
+                # anything else would end this thread with the state still connected; reconnecting
+                # instead acknowledges the frame through the HELLO's last seen
+                print(f"Connection error: {e!r}")
+                return
+            # one cumulative ack per read instead of one per message
+            if self.last_seen != last_seen:
+                self.try_send(encode_frame(ACK, self.user_id, 0, self.last_seen))
+
+    def start_compression(self):
+        with self.send_lock:
+            if self.socket is None:
+                return
+            # frames queued so far go out plain, then the marker tells the relay to inflate the rest
+            self.flush_outbox()
+            try:
+                self.write(encode_frame(COMPRESS, self.user_id, 0))
+            except OSError:
+                self.drop_connection()
+                return
+            self.deflater = zlib.compressobj()
+
+    def write(self, data):
+        # callers hold send_lock; a sync flush per write lets the relay decode it straight away
+        if self.deflater is not None:
+            data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.socket.sendall(data)
+        BYTES_SENT.inc(len(data))
+
+    def try_send(self, data):
+        with self.send_lock:
+            if self.socket is None:
+                return False
+            try:
+                self.write(data)
+                return True
+            except OSError:
+                self.drop_connection()
+                return False
+
+    def drop_connection(self):
+        # wakes the receive thread so run() reconnects; callers hold send_lock
         try:
-            self.socket.send(f"{username}:{message}".encode('utf-8'))
-        except Exception as e:
-            print(f"Send error: {e}")
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, data):
+        MESSAGES_SENT.inc()
+        with self.send_lock:
+            if self.socket is not None and not self.pending:
+                if self.coalesce:
+                    self.outbox.append(data)
+                    self.outbox_size += len(data)
+                    if self.outbox_size >= self.coalesce_bytes:
+                        self.flush_outbox()
+                    elif len(self.outbox) == 1:
+                        self.outbox_since = time.monotonic()
+                        self.outbox_ready.notify()
+                    return
+                try:
+                    self.write(data)
+                    return
+                except OSError as e:
+                    print(f"Send error: {e}")
+                    self.drop_connection()
+            if len(self.pending) == self.pending.maxlen:
+                print("Send buffer full, dropping oldest message")
+                SEND_DROPPED.inc()
+            self.pending.append(data)
+
+    def flush_outbox(self):
+        # callers hold send_lock; what cannot be written waits in pending for the next HELLO
+        batch, self.outbox, self.outbox_size = self.outbox, [], 0
+        if not batch:
+            return
+        if self.socket is not None:
+            try:
+                self.write(b"".join(batch))
+                return
+            except OSError as e:
+                print(f"Send error: {e}")
+                self.drop_connection()
+        self.pending.extend(batch)
+
+    def flush_periodically(self):
+        # the first frame into an empty outbox starts the clock; the batch goes out coalesce
+        # seconds later unless coalesce_bytes sent it first
+        with self.send_lock:
+            while self.running:
+                if not self.outbox:
+                    self.outbox_ready.wait()
+                    continue
+                remaining = self.outbox_since + self.coalesce - time.monotonic()
+                if remaining > 0:
+                    self.outbox_ready.wait(remaining)
+                else:
+                    self.flush_outbox()
+
+    def subscribe(self, user_ids):
+        user_ids = [user_id for user_id in user_ids if user_id not in self.watching]
+        self.watching.update(user_ids)
+        if user_ids:
+            self.try_send(encode_frame(SUBSCRIBE, self.user_id, 0, payload=encode_ids(user_ids)))
+
+    def join_frame(self, conversation_id):
+        return encode_frame(JOIN, self.user_id, conversation_id, payload=encode_ids(self.groups[conversation_id]))
+
+    def join(self, conversation_id, member_ids):
+        # the relay fans group messages out to whoever the latest JOIN listed
+        self.groups[conversation_id] = list(member_ids)
+        self.try_send(self.join_frame(conversation_id))
+
+    def send_message(self, receiver_id, message, msg_id=0):
+        self.send(encode_frame(MESSAGE, self.user_id, receiver_id, msg_id, payload=message.encode('utf-8')))
+
+    def send_group_message(self, conversation_id, message, msg_id=0):
+        self.send(encode_frame(GROUP, self.user_id, conversation_id, msg_id, payload=message.encode('utf-8')))
+
+    def send_attachment(self, receiver_id, digest, name, msg_id=0):
+        self.send(encode_frame(FILE, self.user_id, receiver_id, msg_id,
+                               payload=digest.encode('ascii') + name.encode('utf-8')))
 
     def close(self):
         self.running = False
+        self.stopped.set()
+        with self.send_lock:
+            self.flush_outbox()
+            self.outbox_ready.notify()
+            sock = self.socket
+        if sock is None:
+            return
         try:
-            self.socket.close()
-        except Exception:
+            # shutdown wakes the receive thread; close alone leaves its recv blocked and the peer connected
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
 
+class TransferWorker(QObject):
+    finished = pyqtSignal(object, object)
+    progress = pyqtSignal(str, int, int)
+
+    def __init__(self, host, port, download_dir=DOWNLOADS_DIR):
+        super().__init__()
+        self.client = TransferClient(host, port, AttachmentStore(download_dir))
+        # one transfer at a time, on its own connection, so chat traffic never waits behind a file
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="transfer")
+        self.finished.connect(self.deliver)
+
+    def submit(self, name, transfer, arg, callback):
+        future = self.pool.submit(transfer, arg, lambda done, total: self.progress.emit(name, done, total))
+        future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def upload(self, path, callback):
+        return self.submit(os.path.basename(path), self.client.upload, path, callback)
+
+    def download(self, digest, name, callback):
+        return self.submit(name, self.client.download, digest, callback)
+
+    def deliver(self, callback, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Transfer error: {e}")
+            result = None
+        callback(result)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
 class SignInWidget(QWidget):
-    def __init__(self, db, on_sign_in_success):
+    def __init__(self, db, on_sign_in_success, on_show_sign_up):
         super().__init__()
         self.db = db
         self.on_sign_in_success = on_sign_in_success
+        self.on_show_sign_up = on_show_sign_up
         self.init_ui()
 
     def init_ui(self):
@@ -252,14 +544,22 @@ class SignInWidget(QWidget):
         username = self.username_edit.text().strip()
         password = self.password_edit.text().strip()
 
-        user = self.db.get_user(username=username)
-        if user and user[3] == password:
-            self.on_sign_in_success(user)
-        else:
-            QMessageBox.warning(self, "Error", "Invalid username or password")
+        # checking the hash takes a noticeable fraction of a second, so it runs on a database worker
+        def checked(user):
+            self.sign_in_btn.setEnabled(True)
+            if user:
+                if needs_rehash(user[3]):
+                    # plaintext or an older cost: upgraded on the write pool now that the password is known
+                    self.db.write("rehash_password", user[0], user[3], password)
+                self.on_sign_in_success(user)
+            else:
+                QMessageBox.warning(self, "Error", "Invalid username or password")
+
+        self.sign_in_btn.setEnabled(False)
+        self.db.read("check_password", username, password, callback=checked)
 
     def show_sign_up(self):
-        self.parentWidget().setCurrentIndex(1)
+        self.on_show_sign_up()
 
 class SignUpWidget(QWidget):
     def __init__(self, db, on_sign_up_success):
@@ -342,29 +642,485 @@ class SignUpWidget(QWidget):
             QMessageBox.warning(self, "Error", "information missing!")
             return
 
-        user_id = self.db.add_user(username, phone, password, self.profile_pic_path)
-        if user_id and passwordConfirm == password:
-            user = self.db.get_user(user_id=user_id)
-            self.on_sign_up_success(user)
-        else:
-            QMessageBox.warning(self, "Error", "Username or phone already taken")
+        def added(user_id):
+            self.sign_up_btn.setEnabled(True)
+            if user_id and passwordConfirm == password:
+                self.db.read("get_user", user_id=user_id, callback=self.on_sign_up_success)
+            else:
+                QMessageBox.warning(self, "Error", "Username or phone already taken")
+
+        self.sign_up_btn.setEnabled(False)
+        self.db.write("add_user", username, phone, password, self.profile_pic_path, callback=added)
 
     def show_sign_in(self):
         self.parentWidget().setCurrentIndex(0)
 
+def render_thumbnail(source, size, rounded):
+    image = QImage(source)
+    if image.isNull():
+        return image
+    if not rounded:
+        return image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio,
+                            Qt.TransformationMode.SmoothTransformation)
+    scaled = image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
+                          Qt.TransformationMode.SmoothTransformation)
+    thumbnail = QImage(size, size, QImage.Format.Format_ARGB32_Premultiplied)
+    thumbnail.fill(Qt.GlobalColor.transparent)
+    painter = QPainter(thumbnail)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    path = QPainterPath()
+    path.addEllipse(0, 0, size, size)
+    painter.setClipPath(path)
+    painter.drawImage((size - scaled.width()) // 2, (size - scaled.height()) // 2, scaled)
+    painter.end()
+    return thumbnail
+
+
+def square_crop(image, size):
+    scaled = image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
+                          Qt.TransformationMode.SmoothTransformation)
+    return scaled.copy((scaled.width() - size) // 2, (scaled.height() - size) // 2, size, size)
+
+
+class ImageStore(QObject):
+    finished = pyqtSignal(object, object)
+
+    # profile pictures are stored once per distinct file, named by sha256, as small PNG variants;
+    # the 48px one is a square crop for avatars, the others keep the aspect ratio
+    def __init__(self, root=IMAGES_DIR):
+        super().__init__()
+        self.root = root
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="images")
+        self.finished.connect(self.deliver)
+
+    def path(self, digest, size):
+        return os.path.join(self.root, digest[:2], f"{digest}_{size}.png")
+
+    def source(self, ref, size):
+        # users.profile_picture holds a digest, or a file path saved before the store existed
+        if ref and is_digest(ref):
+            return self.path(ref, next((s for s in IMAGE_SIZES if s >= size), IMAGE_SIZES[-1]))
+        return ref
+
+    def store(self, source):
+        digest = file_digest(source)
+        image = None
+        for size in IMAGE_SIZES:
+            path = self.path(digest, size)
+            if os.path.exists(path):
+                continue
+            if image is None:
+                image = QImage(source)
+                if image.isNull():
+                    raise ValueError(f"{source} is not an image")
+            if size == IMAGE_SIZES[0]:
+                variant = square_crop(image, size)
+            else:
+                variant = image.scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio,
+                                       Qt.TransformationMode.SmoothTransformation)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            variant.save(path + ".tmp", "PNG")
+            os.replace(path + ".tmp", path)
+        return digest
+
+    def add(self, source, callback):
+        future = self.pool.submit(self.store, source)
+        future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def deliver(self, callback, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Image error: {e}")
+            result = None
+        callback(result)
+
+
+class ThumbnailJob(QRunnable):
+    def __init__(self, cache, key, source, thumb_path):
+        super().__init__()
+        self.cache, self.key, self.source, self.thumb_path = cache, key, source, thumb_path
+
+    def run(self):
+        # QImage, unlike QPixmap, is safe to use off the GUI thread
+        image = QImage(self.thumb_path)
+        if image.isNull():
+            image = render_thumbnail(self.source, self.key[2], self.key[3])
+            if not image.isNull():
+                image.save(self.thumb_path, "PNG")
+        self.cache.rendered.emit(self.key, image)
+
+
+class AvatarCache(QObject):
+    ready = pyqtSignal(str)
+    rendered = pyqtSignal(object, QImage)
+
+    def __init__(self, thumb_dir=THUMBS_DIR, capacity=2048, threads=4, images=None):
+        super().__init__()
+        self.images = images or ImageStore()
+        self.thumb_dir = thumb_dir
+        self.capacity = capacity
+        self.pixmaps = OrderedDict()
+        self.pending = set()
+        self.placeholders = {}
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(threads)
+        self.rendered.connect(self.on_rendered)
+        os.makedirs(thumb_dir, exist_ok=True)
+
+    def key(self, path, size, rounded):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError, ValueError):
+            return None
+        return os.path.abspath(path), mtime, size, rounded
+
+    def source(self, ref, size):
+        path = self.images.source(ref, size)
+        return os.path.abspath(path) if path else None
+
+    def get(self, ref, size=48, rounded=True):
+        path = self.images.source(ref, size)
+        key = self.key(path, size, rounded) if path else None
+        if key is None:
+            return self.placeholder(size, rounded)
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+            return pixmap
+        if key not in self.pending:
+            self.pending.add(key)
+            name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".png"
+            self.pool.start(ThumbnailJob(self, key, path, os.path.join(self.thumb_dir, name)))
+        return self.placeholder(size, rounded)
+
+    def on_rendered(self, key, image):
+        self.pending.discard(key)
+        if image.isNull():
+            return
+        self.pixmaps[key] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.capacity:
+            self.pixmaps.popitem(last=False)
+        self.ready.emit(key[0])
+
+    def placeholder(self, size, rounded):
+        pixmap = self.placeholders.get((size, rounded))
+        if pixmap is None:
+            pixmap = QPixmap(size, size)
+            pixmap.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(pixmap)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor("#99AEAD"))
+            if rounded:
+                painter.drawEllipse(0, 0, size, size)
+            else:
+                painter.drawRect(0, 0, size, size)
+            painter.end()
+            self.placeholders[(size, rounded)] = pixmap
+        return pixmap
+
+    def wait(self):
+        self.pool.waitForDone()
+
+
+class ContactModel(QAbstractListModel):
+    def __init__(self):
+        super().__init__()
+        # [contact_id, username, profile_picture, preview, unread], most recent chat first
+        self.rows = []
+        self.ids = {}
+        self.online = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        contact_id, username, profile_pic_path, preview, unread = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return username
+        if role == Qt.ItemDataRole.UserRole:
+            return contact_id
+        if role == AVATAR_ROLE:
+            return profile_pic_path
+        if role == ONLINE_ROLE:
+            return contact_id in self.online
+        if role == PREVIEW_ROLE:
+            return preview
+        if role == UNREAD_ROLE:
+            return unread
+        return None
+
+    def make_row(self, contact):
+        # plain (id, username, picture) rows have no messages yet
+        return list(contact[:5]) + [None, 0][len(contact) - 3:]
+
+    def reindex(self, start, stop):
+        for row in range(start, stop):
+            self.ids[self.rows[row][0]] = row
+
+    def set_contacts(self, contacts):
+        self.beginResetModel()
+        self.rows = [self.make_row(contact) for contact in contacts]
+        self.ids = {}
+        self.reindex(0, len(self.rows))
+        self.endResetModel()
+
+    def index_of(self, contact_id):
+        row = self.ids.get(contact_id)
+        return QModelIndex() if row is None else self.index(row)
+
+    def add_contact(self, contact):
+        if contact[0] in self.ids:
+            return
+        row = len(self.rows)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows.append(self.make_row(contact))
+        self.ids[contact[0]] = row
+        self.endInsertRows()
+
+    def touch(self, contact_id, preview):
+        # a new message moves the chat to the top of the list
+        row = self.ids.get(contact_id)
+        if row is None:
+            return
+        contact = self.rows[row]
+        contact[3] = preview
+        if row:
+            self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), 0)
+            self.rows.insert(0, self.rows.pop(row))
+            self.reindex(0, row + 1)
+            self.endMoveRows()
+        index = self.index(0)
+        self.dataChanged.emit(index, index, [PREVIEW_ROLE, UNREAD_ROLE])
+
+    def set_unread(self, contact_id, unread):
+        index = self.index_of(contact_id)
+        if index.isValid() and unread is not None and self.rows[index.row()][4] != unread:
+            self.rows[index.row()][4] = unread
+            self.dataChanged.emit(index, index, [UNREAD_ROLE])
+
+    def clear_unread(self, contact_id):
+        self.set_unread(contact_id, 0)
+
+    def set_online(self, contact_id, online):
+        if online:
+            self.online.add(contact_id)
+        else:
+            self.online.discard(contact_id)
+        index = self.index_of(contact_id)
+        if index.isValid():
+            self.dataChanged.emit(index, index, [ONLINE_ROLE])
+
+
+class ContactDelegate(QStyledItemDelegate):
+    AVATAR_SIZE = 48
+
+    def __init__(self, avatars, parent=None):
+        super().__init__(parent)
+        self.avatars = avatars
+        self.font = QFont()
+        self.font.setPixelSize(16)
+        self.small_font = QFont()
+        self.small_font.setPixelSize(12)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        rect = option.rect.adjusted(2, 2, -2, -2)
+        gradient = QLinearGradient(rect.left(), 0, rect.right(), 0)
+        gradient.setColorAt(0, QColor(0, 84, 153, 180))
+        gradient.setColorAt(1, QColor(0, 110, 200, 180))
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(gradient)
+        painter.drawRoundedRect(rect, 8, 8)
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.setBrush(QColor(255, 255, 255, 40))
+            painter.drawRoundedRect(rect, 8, 8)
+
+        top = rect.top() + (rect.height() - self.AVATAR_SIZE) // 2
+        painter.drawPixmap(rect.left() + 10, top, self.avatars.get(index.data(AVATAR_ROLE), self.AVATAR_SIZE))
+        if index.data(ONLINE_ROLE):
+            painter.setPen(QColor("white"))
+            painter.setBrush(QColor("#3CCB5A"))
+            painter.drawEllipse(rect.left() + 10 + self.AVATAR_SIZE - 12, top + self.AVATAR_SIZE - 12, 12, 12)
+
+        text_rect = rect.adjusted(10 + self.AVATAR_SIZE + 12, 0, -10, 0)
+        unread = index.data(UNREAD_ROLE)
+        if unread:
+            badge = str(unread) if unread < 1000 else "999+"
+            painter.setFont(self.small_font)
+            width = max(20, painter.fontMetrics().horizontalAdvance(badge) + 10)
+            badge_rect = QRect(text_rect.right() - width, text_rect.center().y() - 10, width, 20)
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor("#3CCB5A"))
+            painter.drawRoundedRect(badge_rect, 10, 10)
+            painter.setPen(QColor("white"))
+            painter.drawText(badge_rect, Qt.AlignmentFlag.AlignCenter, badge)
+            text_rect.setRight(badge_rect.left() - 6)
+
+        preview = index.data(PREVIEW_ROLE)
+        painter.setPen(QColor("white"))
+        painter.setFont(self.font)
+        if preview:
+            name_rect = QRect(text_rect.left(), text_rect.top() + 8, text_rect.width(), text_rect.height() // 2 - 8)
+            painter.drawText(name_rect, Qt.AlignmentFlag.AlignBottom | Qt.AlignmentFlag.AlignLeft, index.data())
+            painter.setFont(self.small_font)
+            painter.setPen(QColor(255, 255, 255, 190))
+            metrics = painter.fontMetrics()
+            preview_rect = QRect(text_rect.left(), text_rect.center().y() + 2, text_rect.width(), metrics.height())
+            painter.drawText(preview_rect, Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft,
+                             metrics.elidedText(preview, Qt.TextElideMode.ElideRight, text_rect.width()))
+        else:
+            painter.drawText(text_rect, Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft, index.data())
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        return QSize(200, 60)
+
+
+class ChatModel(QStandardItemModel):
+    # a standard item model, so laying out the view reads each row's stored size hint without calling
+    # back into python; a python model made every insert re-run data() for the whole transcript
+    trimmed = pyqtSignal()
+
+    def __init__(self, max_rows=2000):
+        super().__init__()
+        self.max_rows = max_rows
+        self.pending = []
+        self.sizer = None
+
+    def make_item(self, msg_id, sender, text, attachment=None):
+        display = f"{sender}: \U0001F4CE {text}" if attachment else f"{sender}: {text}"
+        item = QStandardItem(display)
+        item.setEditable(False)
+        item.setData(msg_id, Qt.ItemDataRole.UserRole)
+        if attachment:
+            item.setData((attachment, text), ATTACHMENT_ROLE)
+        if self.sizer:
+            item.setData(self.sizer(display), Qt.ItemDataRole.SizeHintRole)
+        return item
+
+    def set_rows(self, rows):
+        self.pending.clear()
+        self.setRowCount(0)
+        rows = rows[-self.max_rows:]
+        if rows:
+            self.invisibleRootItem().appendRows([self.make_item(*row) for row in rows])
+
+    def append_row(self, msg_id, sender, text, attachment=None):
+        # each insert relayouts the view, so rows arriving in one event loop pass go in as one insert
+        if not self.pending:
+            QTimer.singleShot(0, self.flush_rows)
+        self.pending.append((msg_id, sender, text, attachment))
+
+    def flush_rows(self):
+        if not self.pending:
+            return
+        self.invisibleRootItem().appendRows([self.make_item(*row) for row in self.pending])
+        self.pending.clear()
+        # trim in chunks so a capped transcript doesn't shift the list on every append
+        if self.rowCount() > self.max_rows + self.max_rows // 10:
+            self.removeRows(0, self.rowCount() - self.max_rows)
+            self.trimmed.emit()
+
+    def resize_rows(self):
+        for row in range(self.rowCount()):
+            item = self.item(row)
+            item.setData(self.sizer(item.text()), Qt.ItemDataRole.SizeHintRole)
+
+    def can_prepend(self):
+        return self.rowCount() < self.max_rows
+
+    def prepend_rows(self, rows):
+        rows = rows[-(self.max_rows - self.rowCount()):]
+        if not rows:
+            return 0
+        self.invisibleRootItem().insertRows(0, [self.make_item(*row) for row in rows])
+        return len(rows)
+
+    def first_id(self):
+        return self.item(0).data(Qt.ItemDataRole.UserRole) if self.rowCount() else None
+
+
+class ChatDelegate(QStyledItemDelegate):
+    PADDING = 6
+    CACHE_SIZE = 20000
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.heights = {}
+
+    def text_rect(self, rect):
+        return rect.adjusted(self.PADDING, self.PADDING // 2, -self.PADDING, -self.PADDING // 2)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setPen(QColor("#2F575D"))
+        painter.drawText(self.text_rect(option.rect), int(Qt.TextFlag.TextWordWrap), index.data())
+        painter.restore()
+
+    def size_for(self, text, width, metrics):
+        height = self.heights.get((text, width))
+        if height is None:
+            if len(self.heights) > self.CACHE_SIZE:
+                self.heights.clear()
+            height = metrics.boundingRect(
+                QRect(0, 0, max(1, width - 2 * self.PADDING), 1_000_000),
+                int(Qt.TextFlag.TextWordWrap), text
+            ).height() + self.PADDING
+            self.heights[(text, width)] = height
+        return QSize(width, height)
+
+
+class ChatView(QListView):
+    # sizes rows once as the model creates them, and again only when the width they wrap to changes
+    def __init__(self, model):
+        super().__init__()
+        self.delegate = ChatDelegate(self)
+        self.setItemDelegate(self.delegate)
+        self.setModel(model)
+        self.row_width = self.viewport().width()
+        model.sizer = self.row_size
+
+    def row_size(self, text):
+        return self.delegate.size_for(text, self.viewport().width(), self.fontMetrics())
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.viewport().width() != self.row_width:
+            self.row_width = self.viewport().width()
+            self.model().resize_rows()
+
+
 class MainWindow(QMainWindow):
-    def __init__(self, db, user):
+    def __init__(self, db, user, avatars=None):
         super().__init__()
         self.db = db
+        self.avatars = avatars or AvatarCache()
+        self.avatars.ready.connect(self.on_avatar_ready)
         self.user = user
         self.user_id = user[0]
         self.username = user[1]
         self.phone = user[2]
         self.profile_pic_path = self.user[4]
-        self.client_socket = ClientSocket("localhost", 12345)
+        self.contact_names = {}
+        # conversation_id -> {user_id: username}; groups sit in the contacts list under -conversation_id
+        self.group_members = {}
+        self.client_socket = ClientSocket("localhost", 12345, self.user_id)
         self.client_socket.message_received.connect(self.receive_message)
-        self.client_socket.connect_to_server()
+        self.client_socket.presence_changed.connect(self.on_presence_changed)
+        self.client_socket.attachment_received.connect(self.receive_attachment)
+        self.client_socket.group_message_received.connect(self.receive_group_message)
+        self.client_socket.state_changed.connect(self.on_connection_state)
+        self.transfers = TransferWorker("localhost", 12345)
+        self.transfers.progress.connect(self.on_transfer_progress)
         self.init_ui()
+        # connect once the event loop is running, i.e. after the caller has shown the window
+        QTimer.singleShot(0, self.client_socket.connect_to_server)
 
     def init_ui(self):
         self.setFixedSize(700, 600)
@@ -398,9 +1154,9 @@ class MainWindow(QMainWindow):
         setting_and_profile_and_addcontact_layout.addWidget(setting_btn)
 
         Profile_btn = QPushButton()
-        pixmap = QPixmap(self.profile_pic_path)
-        Profile_btn.setIcon(QIcon(pixmap))
-        Profile_btn.setIconSize(Profile_btn.size())
+        self.profile_btn = Profile_btn
+        Profile_btn.setIcon(QIcon(self.avatars.get(self.profile_pic_path, 96, rounded=False)))
+        Profile_btn.setIconSize(QSize(96, 96))
 
         Profile_btn.setStyleSheet("background-color: #2F575D;")
         Profile_btn.setFixedSize(115, 100)
@@ -408,18 +1164,42 @@ class MainWindow(QMainWindow):
         setting_and_profile_and_addcontact_layout.addWidget(Profile_btn)
         layout.addLayout(setting_and_profile_and_addcontact_layout)
 
-        self.contacts_list = QListWidget()
-        self.contacts_list.itemClicked.connect(self.load_messages)
-        layout.addWidget(self.contacts_list)
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search messages")
+        self.search_edit.setStyleSheet("background-color: white; color: #2F575D;")
+        self.search_edit.returnPressed.connect(self.search_messages)
+        layout.addWidget(self.search_edit)
+
+        new_group_btn = QPushButton("New Group")
+        new_group_btn.setStyleSheet("background-color: #2F575D; color: white;")
+        new_group_btn.clicked.connect(self.new_group_dialog)
+        layout.addWidget(new_group_btn)
+
+        self.contacts_model = ContactModel()
+        self.contacts_view = QListView()
+        self.contacts_view.setModel(self.contacts_model)
+        self.contacts_view.setItemDelegate(ContactDelegate(self.avatars, self.contacts_view))
+        self.contacts_view.setUniformItemSizes(True)
+        self.contacts_view.clicked.connect(self.load_messages)
+        layout.addWidget(self.contacts_view)
 
         main_layout.addLayout(layout)
 
         chat_layout = QVBoxLayout()
 
-        self.chat_display = QTextEdit()
-        self.chat_display.setStyleSheet("background-color: #DEE1DD; color: #2F575D;")
-        self.chat_display.setReadOnly(True)
-        chat_layout.addWidget(self.chat_display)
+        self.chat_model = ChatModel()
+        self.chat_model.trimmed.connect(self.on_chat_trimmed)
+        self.chat_scroll_pending = False
+        self.loading_older_messages = False
+        self.chat_view = ChatView(self.chat_model)
+        self.chat_view.setStyleSheet("background-color: #DEE1DD; color: #2F575D;")
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_view.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.chat_view.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.chat_view.setWordWrap(True)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled)
+        self.chat_view.doubleClicked.connect(self.open_attachment)
+        chat_layout.addWidget(self.chat_view)
 
         msg_input_layout = QHBoxLayout()
         self.message_edit = QLineEdit()
@@ -431,6 +1211,11 @@ class MainWindow(QMainWindow):
         send_btn.clicked.connect(self.send_message)
         msg_input_layout.addWidget(send_btn)
 
+        attach_btn = QPushButton("Attach")
+        attach_btn.setStyleSheet("background-color: #2F575D; color: white;")
+        attach_btn.clicked.connect(self.attach_file)
+        msg_input_layout.addWidget(attach_btn)
+
         chat_layout.addLayout(msg_input_layout)
 
         main_layout.addLayout(chat_layout)
@@ -439,100 +1224,271 @@ class MainWindow(QMainWindow):
 
         self.load_contacts()
 
+    @gui_timer
     def load_contacts(self):
-        self.contacts_list.clear()
-        contacts = self.db.get_contacts(self.user_id)
+        self.db.read("get_chat_list", self.user_id, callback=self.show_contacts)
 
+    @gui_timer
+    def show_contacts(self, contacts):
+        contacts = contacts or []
         for contact in contacts:
-            contact_id = contact[0]
-            username = contact[1]
-            profile_pic_path = contact[2]
-
-            size = 48
-            pixmap = QPixmap(profile_pic_path).scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
-                                                      Qt.TransformationMode.SmoothTransformation)
-
-
-            rounded = QPixmap(size, size)
-            rounded.fill(Qt.GlobalColor.transparent)
-
-            painter = QPainter(rounded)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-            path = QPainterPath()
-            path.addEllipse(0, 0, size, size)
-            painter.setClipPath(path)
-            painter.drawPixmap(0, 0, pixmap)
-            painter.end()
-
-
-            widget = QWidget()
-            layout = QHBoxLayout(widget)
-            layout.setContentsMargins(10, 5, 10, 5)
-            layout.setSpacing(12)
-
-
-            image_label = QLabel()
-            image_label.setPixmap(rounded)
-            image_label.setFixedSize(size, size)
-            layout.addWidget(image_label)
-
-
-            name_label = QLabel(username)
-            name_label.setStyleSheet("color: white; font-size: 16px;")
-            layout.addWidget(name_label)
-
-
-            layout.addStretch()
-
-
-            widget.setStyleSheet("""
-                background-color: qlineargradient(
-                    spread:pad, x1:0, y1:0, x2:1, y2:0, 
-                    stop:0 rgba(0, 84, 153, 180), stop:1 rgba(0, 110, 200, 180)
-                );
-                border-radius: 8px;
-            """)
-
-
-            item = QListWidgetItem()
-            item.setSizeHint(QSize(200, 60))
-            item.setData(Qt.ItemDataRole.UserRole, contact_id)
-            self.contacts_list.addItem(item)
-            self.contacts_list.setItemWidget(item, widget)
-
-    def load_messages(self, item):
-        contact_id = item.data(Qt.ItemDataRole.UserRole)
-        self.current_contact_id = contact_id
-
-        contact = self.db.get_user(user_id=contact_id)
+            self.contact_names[contact[0]] = contact[1]
+        self.contacts_model.set_contacts(contacts)
+        self.client_socket.subscribe([contact[0] for contact in contacts if contact[0] > 0])
+        for contact in contacts:
+            if contact[0] < 0:
+                self.track_group(-contact[0])
+
+    def load_groups(self):
+        self.db.read("get_groups", self.user_id, callback=self.show_groups)
+
+    def show_groups(self, groups):
+        for conversation_id, title, unread, preview in groups or []:
+            self.contact_names[-conversation_id] = title
+            self.contacts_model.add_contact((-conversation_id, title, None, preview, unread))
+            self.track_group(conversation_id)
+
+    def track_group(self, conversation_id):
+        if conversation_id not in self.group_members:
+            self.group_members[conversation_id] = {}
+            self.db.read("get_group_members", conversation_id,
+                         callback=lambda members: self.join_group(conversation_id, members))
+
+    def join_group(self, conversation_id, members):
+        members = members or []
+        self.group_members[conversation_id] = dict(members)
+        self.client_socket.join(conversation_id, [member[0] for member in members])
+
+    def show_new_contact(self, contact):
         if contact:
-            contact_username = contact[1]
+            self.contact_names[contact[0]] = contact[1]
+            self.contacts_model.add_contact((contact[0], contact[1], contact[4]))
+            self.client_socket.subscribe([contact[0]])
+
+    def on_presence_changed(self, contact_id, online):
+        self.contacts_model.set_online(contact_id, online)
+
+    def on_connection_state(self, state):
+        title = f"Messenger - {self.username}"
+        self.setWindowTitle(title if state == CONNECTED else f"{title} ({state})")
+        if state == DISCONNECTED:
+            # presence is resent on reconnect; until then nobody is known to be online
+            for contact_id in list(self.contacts_model.online):
+                self.contacts_model.set_online(contact_id, False)
+
+    def on_avatar_ready(self, path):
+        self.contacts_view.viewport().update()
+        if self.profile_pic_path and self.avatars.source(self.profile_pic_path, 96) == path:
+            self.profile_btn.setIcon(QIcon(self.avatars.get(self.profile_pic_path, 96, rounded=False)))
+
+    @gui_timer
+    def load_messages(self, index):
+        contact_id = index.data(Qt.ItemDataRole.UserRole)
+        self.current_contact_id = contact_id
+        self.contact_username = self.contact_names.get(contact_id, "Unknown")
+        self.contacts_model.clear_unread(contact_id)
+        self.db.write("mark_read", self.user_id, contact_id)
+        self.has_older_messages = False
+        self.loading_older_messages = True
+        self.chat_model.set_rows([])
+        self.read_page(contact_id, lambda messages: self.show_messages(contact_id, messages))
+
+    def read_page(self, contact_id, callback, before_id=None):
+        if contact_id < 0:
+            self.db.read("get_group_messages_page", -contact_id, before_id=before_id, limit=PAGE_SIZE,
+                         callback=callback)
         else:
-            contact_username = "Unknown"
+            self.db.read("get_messages_page", self.user_id, contact_id, before_id=before_id, limit=PAGE_SIZE,
+                         callback=callback)
 
-        messages = self.db.get_messages(self.user_id, contact_id)
-        self.chat_display.clear()
+    @gui_timer
+    def show_messages(self, contact_id, messages):
+        if contact_id != self.current_contact_id:
+            return
+        messages = messages or []
+        self.loading_older_messages = False
+        self.has_older_messages = len(messages) == PAGE_SIZE
+        self.chat_model.set_rows([self.message_row(msg) for msg in messages])
+        self.chat_view.doItemsLayout()
+        self.chat_view.scrollToBottom()
+        self.fill_chat_view()
+
+    def fill_chat_view(self):
+        # keep fetching until the view can scroll, otherwise scrolling up never triggers
+        if self.chat_view.verticalScrollBar().maximum() == 0:
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        if (not getattr(self, 'has_older_messages', False) or self.loading_older_messages
+                or not self.chat_model.can_prepend()):
+            return
+        self.loading_older_messages = True
+        contact_id = self.current_contact_id
+        self.read_page(contact_id, lambda messages: self.show_older_messages(contact_id, messages),
+                       before_id=self.chat_model.first_id())
+
+    @gui_timer
+    def show_older_messages(self, contact_id, messages):
+        if contact_id != self.current_contact_id:
+            return
+        messages = messages or []
+        self.loading_older_messages = False
+        self.has_older_messages = len(messages) == PAGE_SIZE
+        added = self.chat_model.prepend_rows([self.message_row(msg) for msg in messages])
+        if added:
+            self.chat_view.doItemsLayout()
+            self.chat_view.scrollTo(self.chat_model.index(added, 0), QAbstractItemView.ScrollHint.PositionAtTop)
+            self.fill_chat_view()
+
+    def on_chat_scrolled(self, value):
+        if value == self.chat_view.verticalScrollBar().minimum():
+            self.load_older_messages()
+
+    def message_row(self, msg):
+        if msg[1] == self.user_id:
+            sender = "Me"
+        elif self.current_contact_id < 0:
+            sender = self.group_members.get(-self.current_contact_id, {}).get(msg[1], "Unknown")
+        else:
+            sender = self.contact_username
+        return msg[0], sender, msg[3], msg[6]
 
-        for msg in messages:
-        #     if msg[1]==self.user_id:
-        #         sender = "Me"
-        #     else:
-        #         sender = contact_username
-            sender = "Me" if msg[1] == self.user_id else contact_username
-            self.chat_display.append(f"{sender}: {msg[3]}")
+    def append_chat_row(self, msg_id, sender, text, attachment=None):
+        scrollbar = self.chat_view.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        self.chat_model.append_row(msg_id, sender, text, attachment)
+        # scrollToBottom forces a synchronous relayout, so coalesce bursts into one per event loop pass
+        if at_bottom and not self.chat_scroll_pending:
+            self.chat_scroll_pending = True
+            QTimer.singleShot(0, self.scroll_chat_to_bottom)
 
+    def on_chat_trimmed(self):
+        self.has_older_messages = True
 
+    def scroll_chat_to_bottom(self):
+        self.chat_scroll_pending = False
+        self.chat_view.scrollToBottom()
 
     def send_message(self):
         text = self.message_edit.text().strip()
         if text and hasattr(self, 'current_contact_id'):
-            self.db.add_message(self.user_id, self.current_contact_id, text)
-            self.client_socket.send_message(self.username, text)
-            self.chat_display.append(f"Me: {text}")
+            contact_id = self.current_contact_id
+            if contact_id < 0:
+                future = self.db.add_group_message(-contact_id, self.user_id, text)
+                future.add_done_callback(
+                    lambda f: self.client_socket.send_group_message(-contact_id, text, f.result()))
+            else:
+                future = self.db.add_message(self.user_id, contact_id, text)
+                future.add_done_callback(
+                    lambda f: self.client_socket.send_message(contact_id, text, f.result()))
+            self.append_chat_row(0, "Me", text)
+            self.contacts_model.touch(contact_id, message_preview(text))
             self.message_edit.clear()
 
-    def receive_message(self, username, message):
-        self.chat_display.append(f"{username}: {message}")
+    def show_incoming(self, contact_id, sender, text, attachment=None):
+        # the sender's insert already bumped the stored unread count; reading it here clears it again
+        self.contacts_model.touch(contact_id, message_preview(text, attachment))
+        if getattr(self, 'current_contact_id', None) == contact_id:
+            self.append_chat_row(0, sender, text, attachment)
+            self.db.write("mark_read", self.user_id, contact_id)
+        else:
+            # the count comes from the database rather than adding one here: the sender committed
+            # before sending, and a message replayed after a reconnect is already in that count
+            self.db.read("get_unread", self.user_id, contact_id,
+                         callback=lambda unread: self.contacts_model.set_unread(contact_id, unread))
+
+    def receive_message(self, sender_id, message):
+        self.show_incoming(sender_id, self.contact_names.get(sender_id, "Unknown"), message)
+
+    def receive_group_message(self, conversation_id, sender_id, message):
+        if conversation_id not in self.group_members:
+            # someone added us to a group since the list was loaded
+            self.load_groups()
+            return
+        self.show_incoming(-conversation_id, self.group_members[conversation_id].get(sender_id, "Unknown"), message)
+
+    def receive_attachment(self, sender_id, digest, name):
+        # the digest names the file the download is stored under, so it is never taken on trust
+        if not is_digest(digest):
+            print(f"Ignoring attachment from {sender_id} with a bad digest: {digest!r}")
+            return
+        self.show_incoming(sender_id, self.contact_names.get(sender_id, "Unknown"), name, digest)
+
+    def attach_file(self):
+        if not hasattr(self, 'current_contact_id'):
+            return
+        if self.current_contact_id < 0:
+            self.statusBar().showMessage("Attachments can only be sent in one-to-one chats", 5000)
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Attach File")
+        if path:
+            contact_id = self.current_contact_id
+            name = os.path.basename(path)
+            self.transfers.upload(path, callback=lambda digest: self.send_attachment(contact_id, name, digest))
+
+    def send_attachment(self, contact_id, name, digest):
+        if digest is None:
+            self.statusBar().showMessage(f"Could not upload {name}", 5000)
+            return
+        future = self.db.add_message(self.user_id, contact_id, name, digest)
+        future.add_done_callback(
+            lambda f: self.client_socket.send_attachment(contact_id, digest, name, f.result()))
+        if contact_id == self.current_contact_id:
+            self.append_chat_row(0, "Me", name, digest)
+        self.contacts_model.touch(contact_id, message_preview(name, digest))
+
+    def open_attachment(self, index):
+        attachment = index.data(ATTACHMENT_ROLE)
+        if attachment:
+            digest, name = attachment
+            self.transfers.download(digest, name, callback=lambda path: self.save_attachment(name, path))
+
+    def save_attachment(self, name, path):
+        if path is None:
+            self.statusBar().showMessage(f"Could not download {name}", 5000)
+            return
+        target, _ = QFileDialog.getSaveFileName(self, "Save Attachment", name)
+        if target:
+            shutil.copyfile(path, target)
+
+    def on_transfer_progress(self, name, done, total):
+        if done < total:
+            self.statusBar().showMessage(f"{name}: {done * 100 // total}%")
+        else:
+            self.statusBar().clearMessage()
+
+    def search_messages(self):
+        query = self.search_edit.text().strip()
+        if query:
+            self.db.read("search_messages", self.user_id, query, callback=self.show_search_results)
+
+    def show_search_results(self, results):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Search results")
+        dialog.resize(500, 400)
+        dlg_layout = QVBoxLayout()
+        results_list = QListWidget()
+        for msg_id, sender_id, receiver_id, snippet, timestamp in results or []:
+            # group hits carry the negative group key as receiver_id, which is also their contacts list id
+            peer_id = receiver_id if sender_id == self.user_id or receiver_id < 0 else sender_id
+            sender = "Me" if sender_id == self.user_id else self.contact_names.get(sender_id, "Unknown")
+            item = QListWidgetItem(f"{timestamp}  {sender}: {snippet}")
+            item.setData(Qt.ItemDataRole.UserRole, peer_id)
+            results_list.addItem(item)
+        if not results:
+            results_list.addItem("No messages found")
+        dlg_layout.addWidget(results_list)
+
+        def open_chat(item):
+            index = self.contacts_model.index_of(item.data(Qt.ItemDataRole.UserRole))
+            if index.isValid():
+                self.contacts_view.setCurrentIndex(index)
+                self.load_messages(index)
+                dialog.accept()
+
+        results_list.itemDoubleClicked.connect(open_chat)
+        dialog.setLayout(dlg_layout)
+        dialog.exec()
 
     def add_contact_dialog(self):
         dialog = QDialog(self)
@@ -547,20 +1503,66 @@ class MainWindow(QMainWindow):
         add_btn.setStyleSheet("background-color: #8FAD88; color: #CBDF90;")
         dlg_layout.addWidget(add_btn)
 
+        def added(success, contact_username):
+            if success:
+                QMessageBox.information(self, "Success", "Contact added!")
+                self.db.read("get_user", username=contact_username, callback=self.show_new_contact)
+                dialog.accept()
+            else:
+                QMessageBox.warning(self, "Error", "User not found or already added")
+
         def add():
             contact_username = contact_edit.text().strip()
             if contact_username:
-                if self.db.add_contact(self.user_id, contact_username):
-                    QMessageBox.information(self, "Success", "Contact added!")
-                    self.load_contacts()
-                    dialog.accept()
-                else:
-                    QMessageBox.warning(self, "Error", "User not found or already added")
+                self.db.write("add_contact", self.user_id, contact_username,
+                              callback=lambda success: added(success, contact_username))
 
         add_btn.clicked.connect(add)
         dialog.setLayout(dlg_layout)
         dialog.exec()
 
+    def new_group_dialog(self):
+        dialog = QDialog(self)
+        dialog.setStyleSheet("background-color: #1B4079; color: white;")
+        dialog.setWindowTitle("New Group")
+        dlg_layout = QVBoxLayout()
+        title_edit = QLineEdit()
+        title_edit.setStyleSheet("background-color: #CBDF90; color: #1B4079;")
+        dlg_layout.addWidget(QLabel("Group name:"))
+        dlg_layout.addWidget(title_edit)
+        dlg_layout.addWidget(QLabel("Members:"))
+        members_list = QListWidget()
+        for contact_id, username in self.contact_names.items():
+            if contact_id > 0:
+                item = QListWidgetItem(username)
+                item.setData(Qt.ItemDataRole.UserRole, contact_id)
+                item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+                item.setCheckState(Qt.CheckState.Unchecked)
+                members_list.addItem(item)
+        dlg_layout.addWidget(members_list)
+        create_btn = QPushButton("Create")
+        create_btn.setStyleSheet("background-color: #8FAD88; color: #CBDF90;")
+        dlg_layout.addWidget(create_btn)
+
+        def created(conversation_id):
+            if conversation_id is None:
+                QMessageBox.warning(self, "Error", "Could not create the group")
+                return
+            self.load_groups()
+            dialog.accept()
+
+        def create():
+            title = title_edit.text().strip()
+            member_ids = [members_list.item(row).data(Qt.ItemDataRole.UserRole)
+                          for row in range(members_list.count())
+                          if members_list.item(row).checkState() == Qt.CheckState.Checked]
+            if title and member_ids:
+                self.db.write("create_group", self.user_id, title, member_ids, callback=created)
+
+        create_btn.clicked.connect(create)
+        dialog.setLayout(dlg_layout)
+        dialog.exec()
+
     def setting_dialog(self):
         dialog = QDialog(self)
         dialog.setFixedSize(400, 600)
@@ -616,22 +1618,21 @@ class MainWindow(QMainWindow):
             )
 
             if file_path:
-                profile_pics_dir = os.path.join(os.getcwd(), "profile_pics")
-                if not os.path.exists(profile_pics_dir):
-                    os.makedirs(profile_pics_dir)
-
-
-                filename = os.path.basename(file_path)
-                dest_path = os.path.join(profile_pics_dir, f"user_{self.user_id}_{filename}")
-                shutil.copyfile(file_path, dest_path)
-
-                relative_path = os.path.relpath(dest_path, os.getcwd())
-
-                success = self.db.update_user(self.user_id, profile_picture=relative_path)
-                if success:
-                    QMessageBox.information(self, "Profile Picture", "Profile picture updated successfully!")
-                else:
-                    QMessageBox.warning(self, "Error", "Failed to update profile picture.")
+                def stored(digest):
+                    if digest is None:
+                        QMessageBox.warning(self, "Error", "Failed to update profile picture.")
+                        return
+
+                    def updated(success):
+                        if success:
+                            self.profile_pic_path = digest
+                            self.user = self.user[:4] + (digest,) + self.user[5:]
+                            self.profile_btn.setIcon(QIcon(self.avatars.get(digest, 96, rounded=False)))
+                            QMessageBox.information(self, "Profile Picture", "Profile picture updated successfully!")
+                        else:
+                            QMessageBox.warning(self, "Error", "Failed to update profile picture.")
+                    self.db.write("update_user", self.user_id, profile_picture=digest, callback=updated)
+                self.avatars.images.add(file_path, stored)
 
         change_profile_pic_btn.clicked.connect(change_profile_pic)
         btn_layout.addWidget(change_profile_pic_btn)
@@ -649,19 +1650,22 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "Error", "Passwords do not match")
                 return
 
-            success = self.db.update_user(
+            def updated(success):
+                if success:
+                    QMessageBox.information(self, "Success", "Profile updated")
+                    self.username = username
+                else:
+                    QMessageBox.warning(self, "Error", "Failed to update profile. Username or phone may be taken.")
+
+            self.db.write(
+                "update_user",
                 self.user_id,
                 username=username,
                 phone=phone,
-                password=password if password else None
+                password=password if password else None,
+                callback=updated
             )
 
-            if success:
-                QMessageBox.information(self, "Success", "Profile updated")
-                self.username = username
-            else:
-                QMessageBox.warning(self, "Error", "Failed to update profile. Username or phone may be taken.")
-
         save_changes_btn.clicked.connect(save_changes)
         btn_layout.addWidget(save_changes_btn)
 
@@ -679,10 +1683,12 @@ class MainWindow(QMainWindow):
         self.profile_pic_path = self.user[4]
         profile_pic_label = QLabel()
         if self.profile_pic_path:
-            pixmap = QPixmap(self.profile_pic_path)
-            pixmap = pixmap.scaled(150, 150, Qt.AspectRatioMode.KeepAspectRatio,
-                                   Qt.TransformationMode.SmoothTransformation)
-            profile_pic_label.setPixmap(pixmap)
+            profile_pic_label.setPixmap(self.avatars.get(self.profile_pic_path, 150, rounded=False))
+
+            def refresh(path):
+                if path == self.avatars.source(self.profile_pic_path, 150):
+                    profile_pic_label.setPixmap(self.avatars.get(path, 150, rounded=False))
+            self.avatars.ready.connect(refresh)
         else:
             profile_pic_label.setText("No Profile Picture")
             profile_pic_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
@@ -708,28 +1714,44 @@ class MainWindow(QMainWindow):
         close_btn.clicked.connect(close)
         dialog.setLayout(dlg_layout)
         dialog.exec()
+        if self.profile_pic_path:
+            self.avatars.ready.disconnect(refresh)
 
     def closeEvent(self, event):
         self.client_socket.close()
+        self.transfers.close()
         event.accept()
 
 class MessengerApp(QApplication):
     def __init__(self, argv):
         super().__init__(argv)
-        self.db = Database()
+        metrics.start()
+        self.async_db = AsyncDatabase()
+        # retention runs once the search backfill is done, then every few hours while the app stays open
+        self.async_db.backfill_search_index(done=self.async_db.archive_messages)
+        self.archive_timer = QTimer(self)
+        self.archive_timer.timeout.connect(self.async_db.archive_messages)
+        self.archive_timer.start(ARCHIVE_INTERVAL_MS)
+        self.aboutToQuit.connect(self.async_db.close)
         self.init_ui()
 
     def init_ui(self):
         self.stacked_widget = QStackedWidget()
-        self.sign_in_widget = SignInWidget(self.db, self.on_sign_in_success)
-        self.sign_up_widget = SignUpWidget(self.db, self.on_sign_up_success)
+        self.sign_in_widget = SignInWidget(self.async_db, self.on_sign_in_success, self.show_sign_up)
         self.stacked_widget.addWidget(self.sign_in_widget)
-        self.stacked_widget.addWidget(self.sign_up_widget)
+        # most starts are a sign in, so the sign up form is only built when asked for
+        self.sign_up_widget = None
         self.main_window = None
         self.stacked_widget.show()
 
+    def show_sign_up(self):
+        if self.sign_up_widget is None:
+            self.sign_up_widget = SignUpWidget(self.async_db, self.on_sign_up_success)
+            self.stacked_widget.addWidget(self.sign_up_widget)
+        self.stacked_widget.setCurrentWidget(self.sign_up_widget)
+
     def on_sign_in_success(self, user):
-        self.main_window = MainWindow(self.db, user)
+        self.main_window = MainWindow(self.async_db, user)
         self.main_window.show()
         self.stacked_widget.close()
 
@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import bisect
+import functools
+import threading
+from contextlib import nullcontext
+
+# collection is off unless one of these is set; the endpoint and the log dump each turn it on
+PORT = int(os.environ.get("MESSENGER_METRICS_PORT", 0))
+INTERVAL = float(os.environ.get("MESSENGER_METRICS_INTERVAL", 0))
+ENABLED = bool(os.environ.get("MESSENGER_METRICS") or PORT or INTERVAL)
+
+# seconds, Prometheus style upper bounds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REGISTRY = {}
+HELP = {}
+registry_lock = threading.Lock()
+
+
+class NullMetric:
+    # handed out while disabled so call sites never need to check
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return NULL_TIMER
+
+
+NULL_METRIC = NullMetric()
+NULL_TIMER = nullcontext()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name + "_total", labels, self.value
+
+    def summary(self):
+        return f"{self.value}"
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        with self.lock:
+            counts = list(self.counts)
+        target = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return 0.0
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", "+Inf" if bound == float("inf") else repr(bound)),), cumulative
+        yield name + "_sum", labels, total
+        yield name + "_count", labels, cumulative
+
+    def summary(self):
+        count = sum(self.counts)
+        if not count:
+            return "0"
+        return (f"{count} mean {self.sum / count * 1000:.2f}ms p50<={self.quantile(0.5) * 1000:g}ms "
+                f"p99<={self.quantile(0.99) * 1000:g}ms")
+
+
+def metric(cls, name, help, labels, **kwargs):
+    if not ENABLED:
+        return NULL_METRIC
+    key = (name, tuple(sorted(labels.items())))
+    with registry_lock:
+        existing = REGISTRY.get(key)
+        if existing is None:
+            existing = REGISTRY[key] = cls(**kwargs)
+            HELP.setdefault(name, (cls.kind, help))
+    return existing
+
+
+def counter(name, help="", **labels):
+    return metric(Counter, f"messenger_{name}", help, labels)
+
+
+def histogram(name, help="", buckets=BUCKETS, **labels):
+    return metric(Histogram, f"messenger_{name}_seconds", help, labels, buckets=buckets)
+
+
+def timed(name, help="", **labels):
+    # disabled, the function comes back untouched, so instrumented code costs nothing at all
+    def decorate(func):
+        if not ENABLED:
+            return func
+        hist = histogram(name, help, **labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def timed_by(name, help="", label="function"):
+    # one histogram for a family of functions, one series per function name
+    def decorate(func):
+        return timed(name, help, **{label: func.__name__})(func)
+    return decorate
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render():
+    with registry_lock:
+        metrics = sorted(REGISTRY.items())
+    lines, described = [], set()
+    for (name, labels), value in metrics:
+        if name not in described:
+            described.add(name)
+            kind, help = HELP[name]
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+        for sample, sample_labels, number in value.samples(name, labels):
+            lines.append(f"{sample}{format_labels(sample_labels)} {number}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(out=None):
+    with registry_lock:
+        metrics = sorted(REGISTRY.items())
+    for (name, labels), value in metrics:
+        print(f"metrics: {name}{format_labels(labels)} {value.summary()}", file=out or sys.stdout)
+
+
+def serve(port, host="127.0.0.1"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    return server
+
+
+def log_periodically(interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            dump()
+    threading.Thread(target=run, daemon=True, name="metrics-log").start()
+
+
+def start(offset=0):
+    # called once by each entry point; does nothing unless the environment asked for metrics.
+    # Relay workers pass their shard index so each gets its own port
+    server = None
+    if PORT:
+        try:
+            server = serve(PORT + offset)
+        except OSError as e:
+            print(f"Metrics endpoint error: {e}")
+    if INTERVAL:
+        log_periodically(INTERVAL)
+    return server
@@ -0,0 +1,113 @@
+import os
+import hmac
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# scrypt cost: n is the CPU/memory factor (a power of 2), r the block size, p the parallelism.
+# Hashes keep their own parameters, so raising these only affects new and re-hashed passwords
+SCRYPT_N = int(os.environ.get("MESSENGER_SCRYPT_N", 1 << 15))
+SCRYPT_R = int(os.environ.get("MESSENGER_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("MESSENGER_SCRYPT_P", 1))
+SALT_SIZE = 16
+KEY_SIZE = 32
+SCHEME = "scrypt"
+
+CACHE_SIZE = 1024
+
+HASH_TIME = metrics.histogram("password_hash", "scrypt time per hash or verification")
+CACHE_HITS = metrics.counter("password_cache_hits", "Password checks answered from the verification cache")
+
+
+def b64(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def unb64(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def scrypt(password, salt, n, r, p):
+    # hashlib wants maxmem to cover the 128 * n * r bytes scrypt uses, plus a little headroom
+    with HASH_TIME.time():
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + (1 << 20), dklen=KEY_SIZE)
+
+
+def hash_password(password, n=None, r=None, p=None):
+    # stored as scrypt$n$r$p$salt$key, base64 without padding
+    n, r, p = n or SCRYPT_N, r or SCRYPT_R, p or SCRYPT_P
+    salt = os.urandom(SALT_SIZE)
+    return f"{SCHEME}${n}${r}${p}${b64(salt)}${b64(scrypt(password, salt, n, r, p))}"
+
+
+def is_hashed(stored):
+    return stored.startswith(SCHEME + "$")
+
+
+def parse_hash(stored):
+    _, n, r, p, salt, key = stored.split("$")
+    return int(n), int(r), int(p), unb64(salt), unb64(key)
+
+
+def needs_rehash(stored):
+    # plaintext rows from old exports, or hashes made with cheaper parameters than the current ones
+    if not is_hashed(stored):
+        return True
+    n, r, p, _, _ = parse_hash(stored)
+    return (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def verify_password(password, stored):
+    if not stored:
+        return False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        n, r, p, salt, key = parse_hash(stored)
+    except ValueError:
+        return False
+    return hmac.compare_digest(scrypt(password, salt, n, r, p), key)
+
+
+class VerificationCache:
+    # remembers passwords that verified against a stored hash, so a reconnect or a second window
+    # does not pay for scrypt again. Entries are keyed by an HMAC under a per-process key, so
+    # nothing in memory can be checked against a password guess without that key, and a changed
+    # hash never matches an old entry
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def token(self, password, stored):
+        return hmac.new(self.key, stored.encode("utf-8") + b"\0" + password.encode("utf-8"), hashlib.sha256).digest()
+
+    def verify(self, password, stored):
+        if not stored:
+            return False
+        token = self.token(password, stored)
+        with self.lock:
+            if token in self.entries:
+                self.entries.move_to_end(token)
+                CACHE_HITS.inc()
+                return True
+        # failures are never cached, so a guess always costs a full scrypt
+        if not verify_password(password, stored):
+            return False
+        with self.lock:
+            self.entries[token] = True
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+verification_cache = VerificationCache()
@@ -0,0 +1,192 @@
+import time
+import zlib
+import struct
+
+# length (of everything after the length field), kind, sender_id, receiver_id, msg_id, timestamp_ms
+HEADER = struct.Struct("!IBIIQQ")
+HEADER_SIZE = HEADER.size
+LENGTH_SIZE = 4
+MSG_ID = struct.Struct("!Q")
+MSG_ID_OFFSET = 13
+MAX_FRAME = 16 * 1024 * 1024
+
+HELLO = 1
+MESSAGE = 2
+SUBSCRIBE = 3
+PRESENCE = 4
+ACK = 5
+PING = 6
+PONG = 7
+FILE = 8
+UPLOAD = 9
+CHUNK = 10
+OFFSET = 11
+FETCH = 12
+JOIN = 13
+GROUP = 14
+# everything after this frame on the client's side of the link is one zlib stream
+COMPRESS = 15
+
+OFFLINE = 0
+ONLINE = 1
+
+# feature bits: a client asks in the receiver_id of its HELLO, the relay grants in the HELLO it sends back
+ZLIB = 1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def encode_header(kind, sender_id, receiver_id, msg_id=0, timestamp=None, payload_size=0):
+    if timestamp is None:
+        timestamp = now_ms()
+    return HEADER.pack(HEADER_SIZE - LENGTH_SIZE + payload_size, kind, sender_id, receiver_id, msg_id, timestamp)
+
+
+def encode_frame(kind, sender_id, receiver_id, msg_id=0, timestamp=None, payload=b""):
+    return encode_header(kind, sender_id, receiver_id, msg_id, timestamp, len(payload)) + payload
+
+
+def with_msg_id(raw, msg_id):
+    data = bytearray(raw)
+    MSG_ID.pack_into(data, MSG_ID_OFFSET, msg_id)
+    return data
+
+
+def encode_ids(ids):
+    ids = list(ids)
+    return struct.pack(f"!{len(ids)}I", *ids)
+
+
+def decode_ids(payload):
+    return struct.unpack(f"!{len(payload) // 4}I", payload[:len(payload) // 4 * 4])
+
+
+class Frame:
+    __slots__ = ("kind", "sender_id", "receiver_id", "msg_id", "timestamp", "payload", "raw")
+
+    def __init__(self, kind, sender_id, receiver_id, msg_id, timestamp, payload, raw):
+        self.kind = kind
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.msg_id = msg_id
+        self.timestamp = timestamp
+        self.payload = payload
+        self.raw = raw
+
+    def text(self):
+        # payloads come from other clients; a bad byte is shown as U+FFFD rather than failing the frame
+        return str(self.payload, "utf-8", "replace")
+
+
+class FrameDecoder:
+    # One receive buffer for the life of the connection: recv_into()/get_buffer() write
+    # into writable(), frames() parses in place and yields memoryviews into it. Those views
+    # are only valid until the next call to writable(), so copy anything you keep.
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.inflater = None
+        self.compressed = None
+        self.tail = b""
+        self.full = False
+
+    def writable(self):
+        if self.inflater is not None:
+            return self.compressed
+        return self.space()
+
+    def space(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer) or self.start > len(self.buffer) // 2:
+            pending = self.end - self.start
+            needed = self.frame_size()
+            if needed > len(self.buffer):
+                self.grow(needed)
+            else:
+                self.view[:pending] = self.view[self.start:self.end]
+                self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def frame_size(self):
+        if self.end - self.start < LENGTH_SIZE:
+            return 0
+        return LENGTH_SIZE + int.from_bytes(self.view[self.start:self.start + LENGTH_SIZE], "big")
+
+    def grow(self, needed):
+        pending = self.end - self.start
+        buffer = bytearray(max(needed, len(self.buffer) * 2))
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer, self.view = buffer, memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def advance(self, n):
+        if self.inflater is not None:
+            self.tail = bytes(self.compressed[:n])
+            self.decompress()
+        else:
+            self.end += n
+
+    def decompress(self):
+        # inflates no more than the buffer has room for; the rest of the input waits in tail until
+        # frames() has consumed what is there, so a small compressed read cannot balloon the buffer
+        target = self.space()
+        try:
+            data = self.inflater.decompress(self.tail, len(target))
+        except zlib.error as e:
+            raise ProtocolError(f"bad compressed stream: {e}")
+        self.tail = self.inflater.unconsumed_tail
+        # a full buffer's worth may mean zlib is holding more output even with no input left
+        self.full = len(data) == len(target)
+        target[:len(data)] = data
+        self.end += len(data)
+
+    def inflate(self):
+        # called last while handling the final plain frame (its views are stale afterwards):
+        # whatever follows it, already received or not, is inflated on its way into the buffer
+        rest = self.end - self.start
+        self.inflater = zlib.decompressobj()
+        self.compressed = memoryview(bytearray(len(self.buffer)))
+        self.compressed[:rest] = self.view[self.start:self.end]
+        self.end = self.start
+        self.advance(rest)
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            target = self.writable()
+            n = min(len(target), len(data))
+            target[:n] = data[:n]
+            self.advance(n)
+            data = data[n:]
+            if data:
+                yield from self.frames()
+        yield from self.frames()
+
+    def frames(self):
+        while True:
+            while self.end - self.start >= HEADER_SIZE:
+                length, kind, sender_id, receiver_id, msg_id, timestamp = HEADER.unpack_from(self.buffer, self.start)
+                if length < HEADER_SIZE - LENGTH_SIZE or length > MAX_FRAME:
+                    raise ProtocolError(f"bad frame length: {length}")
+                frame_end = self.start + LENGTH_SIZE + length
+                if frame_end > self.end:
+                    break
+                view = self.view
+                frame = Frame(kind, sender_id, receiver_id, msg_id, timestamp,
+                              view[self.start + HEADER_SIZE:frame_end], view[self.start:frame_end])
+                # moved past before the frame is handled, so a handler can switch the stream with inflate()
+                self.start = frame_end
+                yield frame
+            # on a compressed stream, a frame's views are only valid until the next one is pulled
+            if self.inflater is None or not (self.tail or self.full):
+                return
+            self.decompress()
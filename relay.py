@@ -0,0 +1,476 @@
+import os
+import sys
+import time
+import zlib
+import asyncio
+import argparse
+from collections import deque
+
+from protocol import (HELLO, MESSAGE, SUBSCRIBE, PRESENCE, ACK, PING, PONG, FILE, UPLOAD, CHUNK, OFFSET, FETCH,
+                      JOIN, GROUP, COMPRESS, ZLIB,
+                      ONLINE, OFFLINE, FrameDecoder, ProtocolError, encode_frame, encode_header, decode_ids,
+                      with_msg_id, now_ms)
+from attachments import CHUNK_SIZE, MAX_ATTACHMENT, AttachmentStore, Upload, is_digest
+import metrics
+
+HOST = "localhost"
+PORT = 12345
+MAX_QUEUE = 10000
+# unacknowledged bytes kept for one recipient, and for all of them together
+MAX_MAILBOX_BYTES = 4 << 20
+MAX_QUEUED_BYTES = 256 << 20
+# a mailbox whose recipient has not been connected for this long is dropped
+MAILBOX_TTL = 24 * 3600
+EXPIRE_INTERVAL = 60
+# compression is opt-in on both ends: clients ask with MESSENGER_COMPRESS, the relay needs a level
+COMPRESSION_LEVEL = 0
+ATTACHMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "attachments")
+
+BYTES_RECEIVED = metrics.counter("relay_bytes_received", "Bytes read from client connections")
+MESSAGES_ROUTED = metrics.counter("relay_messages_routed", "Chat and group messages accepted for delivery")
+MAILBOX_EVICTED = metrics.counter("relay_mailbox_evicted", "Queued frames dropped by a mailbox cap or expiry")
+
+
+class DeflateTransport:
+    # stands in for the transport of a connection that negotiated compression. Everything
+    # written during one pass of the event loop shares a single sync flush and a single
+    # send, and the shared zlib window means repeated text compresses across messages
+    def __init__(self, transport, level):
+        self.transport = transport
+        self.deflater = zlib.compressobj(level)
+        self.chunks = []
+        self.scheduled = False
+        self.loop = asyncio.get_running_loop()
+
+    def write(self, data):
+        self.chunks.append(self.deflater.compress(data))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def writelines(self, items):
+        for data in items:
+            self.write(data)
+
+    def flush(self):
+        self.scheduled = False
+        if self.transport.is_closing():
+            self.chunks.clear()
+            return
+        self.chunks.append(self.deflater.flush(zlib.Z_SYNC_FLUSH))
+        self.transport.write(b"".join(self.chunks))
+        self.chunks.clear()
+
+    def close(self):
+        if self.scheduled:
+            self.flush()
+        self.transport.close()
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class Mailbox(deque):
+    # (seq, frame) entries written to one recipient but not yet acknowledged, with their total
+    # size and when the recipient was last connected, or when the mailbox was made if never
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.touched = time.monotonic()
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.user_id = None
+        self.watching = set()
+        self.decoder = FrameDecoder()
+        self.upload = None
+        self.download = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=4 * CHUNK_SIZE)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes):
+        BYTES_RECEIVED.inc(nbytes)
+        try:
+            self.decoder.advance(nbytes)
+            for frame in self.decoder.frames():
+                self.relay.route(self, frame)
+        except ProtocolError as e:
+            print(f"Dropping client {self.user_id}: {e}")
+            self.transport.close()
+
+    def start_compression(self, level):
+        # the grant goes out plain, everything after it deflated
+        self.transport.write(encode_frame(HELLO, 0, ZLIB))
+        self.transport = DeflateTransport(self.transport, level)
+
+    def connection_lost(self, exc):
+        self.relay.unregister(self)
+        if self.download is not None:
+            self.download.close()
+            self.download = None
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.send_chunks()
+
+    def send_chunks(self):
+        # reads only as far ahead as the transport drains, so a slow reader never pulls the file into memory
+        while self.download is not None and not self.paused:
+            offset = self.download.tell()
+            data = self.download.read(CHUNK_SIZE)
+            if not data:
+                self.download.close()
+                self.download = None
+                return
+            self.transport.write(encode_header(CHUNK, 0, 0, offset, 0, len(data)))
+            self.transport.write(data)
+
+
+class Relay:
+    def __init__(self, max_queue=MAX_QUEUE, attachments=ATTACHMENTS_DIR, compression=COMPRESSION_LEVEL,
+                 max_mailbox_bytes=MAX_MAILBOX_BYTES, max_queued_bytes=MAX_QUEUED_BYTES, mailbox_ttl=MAILBOX_TTL):
+        self.routes = {}
+        # set by shards.Shards when this relay is one worker of several
+        self.shards = None
+        self.watchers = {}
+        # recipient -> Mailbox, oldest first
+        self.mailboxes = {}
+        self.max_queue = max_queue
+        self.max_mailbox_bytes = max_mailbox_bytes
+        self.max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+        self.mailbox_ttl = mailbox_ttl
+        self.next_expiry = time.monotonic() + EXPIRE_INTERVAL
+        # seqs start from the clock so they keep increasing across relay restarts
+        # and a client's last seen seq never hides messages queued by a new relay
+        self.seq = now_ms() << 20
+        # conversation_id -> member user_ids, as last announced by a member's JOIN
+        self.groups = {}
+        self.store = AttachmentStore(attachments)
+        self.uploads = {}
+        self.compression = compression
+        self.delivered = 0
+        self.dropped = 0
+
+    def register(self, conn, user_id, last_seen=0):
+        old = self.routes.get(user_id)
+        if old is not None and old is not conn:
+            self.unsubscribe(old)
+            old.user_id = None
+            old.transport.close()
+        conn.user_id = user_id
+        self.routes[user_id] = conn
+        if old is None:
+            self.presence(user_id, ONLINE)
+        self.ack(user_id, last_seen)
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox:
+            mailbox.touched = time.monotonic()
+            conn.transport.writelines([data for _, data in mailbox])
+            self.delivered += len(mailbox)
+
+    def unregister(self, conn):
+        self.unsubscribe(conn)
+        if conn.upload is not None:
+            conn.upload.close()
+            if self.uploads.get(conn.upload.digest) is conn:
+                del self.uploads[conn.upload.digest]
+            conn.upload = None
+        if conn.user_id is not None and self.routes.get(conn.user_id) is conn:
+            del self.routes[conn.user_id]
+            self.presence(conn.user_id, OFFLINE)
+            mailbox = self.mailboxes.get(conn.user_id)
+            if mailbox:
+                mailbox.touched = time.monotonic()
+
+    def subscribe(self, conn, user_ids):
+        for user_id in user_ids:
+            if user_id in conn.watching:
+                continue
+            conn.watching.add(user_id)
+            self.watchers.setdefault(user_id, set()).add(conn)
+            if user_id in self.routes or self.shards is not None and user_id in self.shards.online:
+                conn.transport.write(encode_frame(PRESENCE, user_id, 0, ONLINE))
+
+    def unsubscribe(self, conn):
+        for user_id in conn.watching:
+            watchers = self.watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(conn)
+                if not watchers:
+                    del self.watchers[user_id]
+        conn.watching.clear()
+
+    def presence(self, user_id, status):
+        self.announce(user_id, status)
+        if self.shards is not None:
+            self.shards.broadcast(encode_frame(PRESENCE, user_id, 0, status))
+
+    def announce(self, user_id, status):
+        watchers = self.watchers.get(user_id)
+        if not watchers:
+            return
+        frame = encode_frame(PRESENCE, user_id, 0, status)
+        for watcher in watchers:
+            watcher.transport.write(frame)
+
+    def deliver(self, receiver_id, frame):
+        # every user has one home shard that holds their connection, mailbox and seqs
+        if self.shards is not None and not self.shards.is_local(receiver_id):
+            self.shards.forward(receiver_id, frame.raw)
+            return
+        self.seq += 1
+        self.push(receiver_id, (self.seq, with_msg_id(frame.raw, self.seq)))
+
+    def push(self, receiver_id, entry):
+        mailbox = self.mailboxes.get(receiver_id)
+        if mailbox is None:
+            mailbox = self.mailboxes[receiver_id] = Mailbox()
+        mailbox.append(entry)
+        size = len(entry[1])
+        mailbox.bytes += size
+        self.queued_bytes += size
+        # the newest entry always stays, even if it alone is over the byte cap
+        while len(mailbox) > self.max_queue or mailbox.bytes > self.max_mailbox_bytes and len(mailbox) > 1:
+            self.drop_oldest(mailbox)
+        if self.queued_bytes > self.max_queued_bytes:
+            self.evict(receiver_id)
+        now = time.monotonic()
+        if now >= self.next_expiry:
+            self.expire(now)
+        target = self.routes.get(receiver_id)
+        # a closing transport is still routed until connection_lost runs; the mailbox covers it
+        if target is not None and not target.transport.is_closing():
+            target.transport.write(entry[1])
+            self.delivered += 1
+
+    def fan_out(self, sender_id, frame):
+        members = self.groups.get(frame.receiver_id)
+        if not members or sender_id not in members:
+            self.dropped += 1
+            return False
+        # seqs are relay-wide, so one stamped copy serves every member; offline members
+        # are skipped and read the group from the database when they open it
+        self.seq += 1
+        entry = (self.seq, with_msg_id(frame.raw, self.seq))
+        routes = self.routes
+        for member in members:
+            if member in routes and member != sender_id:
+                self.push(member, entry)
+        return True
+
+    def ack(self, user_id, seq):
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox is None:
+            return
+        while mailbox and mailbox[0][0] <= seq:
+            size = len(mailbox.popleft()[1])
+            mailbox.bytes -= size
+            self.queued_bytes -= size
+        if not mailbox:
+            del self.mailboxes[user_id]
+
+    def drop_oldest(self, mailbox):
+        size = len(mailbox.popleft()[1])
+        mailbox.bytes -= size
+        self.queued_bytes -= size
+        self.dropped += 1
+        MAILBOX_EVICTED.inc()
+
+    def discard(self, user_id):
+        mailbox = self.mailboxes.pop(user_id)
+        self.queued_bytes -= mailbox.bytes
+        self.dropped += len(mailbox)
+        MAILBOX_EVICTED.inc(len(mailbox))
+
+    def evict(self, keep):
+        # over the global cap: drop whole mailboxes of offline recipients, longest waiting first,
+        # then the oldest entries of the mailbox just pushed to
+        over = self.queued_bytes - self.max_queued_bytes
+        victims = []
+        for user_id, mailbox in self.mailboxes.items():
+            if over <= 0:
+                break
+            if user_id != keep and user_id not in self.routes:
+                victims.append(user_id)
+                over -= mailbox.bytes
+        for user_id in victims:
+            self.discard(user_id)
+        mailbox = self.mailboxes[keep]
+        while self.queued_bytes > self.max_queued_bytes and len(mailbox) > 1:
+            self.drop_oldest(mailbox)
+
+    def expire(self, now):
+        self.next_expiry = now + EXPIRE_INTERVAL
+        cutoff = now - self.mailbox_ttl
+        for user_id in [user_id for user_id, mailbox in self.mailboxes.items()
+                        if mailbox.touched < cutoff and user_id not in self.routes]:
+            self.discard(user_id)
+
+    def start_upload(self, conn, digest, size):
+        if not is_digest(digest) or size > MAX_ATTACHMENT or conn.upload is not None:
+            raise ProtocolError(f"bad upload: {digest!r} ({size} bytes)")
+        if self.store.size(digest) == size:
+            conn.transport.write(encode_frame(OFFSET, 0, 0, size))
+            return
+        # a client resuming after a dropped connection may beat connection_lost for the old one
+        old = self.uploads.get(digest)
+        if old is not None:
+            self.unregister(old)
+            old.transport.close()
+        upload = conn.upload = Upload(self.store, digest, size)
+        self.uploads[digest] = conn
+        if not os.path.exists(upload.part):
+            upload.resume()
+            self.upload_ready(conn)
+            return
+        # rehashing what is already on disk can take seconds, which would stall every connection
+        future = asyncio.get_running_loop().run_in_executor(None, upload.resume)
+        future.add_done_callback(lambda future: self.upload_resumed(conn, upload, future))
+
+    def upload_resumed(self, conn, upload, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if conn.upload is not upload:
+            # the connection dropped, or a newer upload of the same file took over, while hashing
+            upload.close()
+        elif error is not None:
+            print(f"Dropping client {conn.user_id}: cannot resume upload {upload.digest}: {error}")
+            conn.transport.close()
+        else:
+            self.upload_ready(conn)
+
+    def upload_ready(self, conn):
+        if conn.upload.offset == conn.upload.size:
+            self.finish_upload(conn)
+        else:
+            conn.transport.write(encode_frame(OFFSET, 0, 0, conn.upload.offset))
+
+    def upload_chunk(self, conn, frame):
+        if conn.upload is None:
+            raise ProtocolError("chunk without an upload")
+        if conn.upload.write(frame.msg_id, frame.payload):
+            self.finish_upload(conn)
+
+    def finish_upload(self, conn):
+        upload = conn.upload
+        del self.uploads[upload.digest]
+        conn.upload = None
+        conn.transport.write(encode_frame(OFFSET, 0, 0, upload.size if upload.finish() else 0))
+
+    def start_download(self, conn, digest, offset):
+        if not is_digest(digest):
+            raise ProtocolError(f"bad digest: {digest!r}")
+        size = self.store.size(digest)
+        conn.transport.write(encode_frame(OFFSET, 0, 0, size or 0))
+        if size and offset < size:
+            conn.download = open(self.store.path(digest), "rb")
+            conn.download.seek(offset)
+            conn.send_chunks()
+
+    def route(self, conn, frame):
+        kind = frame.kind
+        if (kind == MESSAGE or kind == FILE or kind == GROUP) and (
+                conn.user_id is None or frame.sender_id != conn.user_id):
+            # only sent as the user the connection said HELLO as, never before it did
+            self.dropped += 1
+            return
+        if kind == MESSAGE or kind == FILE:
+            MESSAGES_ROUTED.inc()
+            self.deliver(frame.receiver_id, frame)
+        elif kind == GROUP:
+            MESSAGES_ROUTED.inc()
+            if self.fan_out(conn.user_id, frame) and self.shards is not None:
+                self.shards.fan_out(frame.receiver_id, frame.raw)
+        elif kind == CHUNK:
+            self.upload_chunk(conn, frame)
+        elif kind == ACK and conn.user_id is not None:
+            self.ack(conn.user_id, frame.msg_id)
+        elif kind == PING:
+            conn.transport.write(encode_frame(PONG, 0, frame.sender_id))
+        elif kind == HELLO:
+            # one identity per connection; a second HELLO would leave the first id routed and online
+            if conn.user_id is not None:
+                raise ProtocolError(f"second HELLO on the connection of user {conn.user_id}")
+            if frame.receiver_id & ZLIB and self.compression:
+                conn.start_compression(self.compression)
+            # msg_id of a HELLO is the last seq the client saw; everything after it is resent
+            self.register(conn, frame.sender_id, frame.msg_id)
+            self.subscribe(conn, decode_ids(frame.payload))
+        elif kind == SUBSCRIBE and conn.user_id is not None:
+            self.subscribe(conn, decode_ids(frame.payload))
+        elif kind == JOIN and conn.user_id is not None:
+            members = set(decode_ids(frame.payload))
+            if conn.user_id in members:
+                self.groups[frame.receiver_id] = members
+                if self.shards is not None:
+                    self.shards.broadcast(frame.raw)
+        elif kind == COMPRESS:
+            if not isinstance(conn.transport, DeflateTransport):
+                raise ProtocolError("compressed stream without a HELLO granting it")
+            conn.decoder.inflate()
+        elif kind == UPLOAD:
+            self.start_upload(conn, str(frame.payload, "ascii", "replace"), frame.msg_id)
+        elif kind == FETCH:
+            self.start_download(conn, str(frame.payload, "ascii", "replace"), frame.msg_id)
+
+    async def serve(self, host=HOST, port=PORT, ready=None):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: RelayProtocol(self), host, port, backlog=4096)
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Message relay for messanger.py clients")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="unacknowledged messages kept per recipient")
+    parser.add_argument("--max-mailbox-bytes", type=int, default=MAX_MAILBOX_BYTES,
+                        help="unacknowledged bytes kept per recipient")
+    parser.add_argument("--max-queued-bytes", type=int, default=MAX_QUEUED_BYTES,
+                        help="unacknowledged bytes kept for all recipients together")
+    parser.add_argument("--mailbox-ttl", type=int, default=MAILBOX_TTL,
+                        help="seconds a mailbox is kept for a recipient who is not connected")
+    parser.add_argument("--attachments", default=ATTACHMENTS_DIR, help="directory for uploaded files")
+    parser.add_argument("--compression-level", type=int, default=COMPRESSION_LEVEL,
+                        help="zlib level (1-9) for clients that ask for compression; 0, the default, refuses")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="relay processes to run, each owning the users whose id maps to it")
+    # set by the supervisor on the processes it starts
+    parser.add_argument("--shard", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--runtime", help=argparse.SUPPRESS)
+    parser.add_argument("--handoff", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.workers > 1 or args.shard is not None:
+        import shards
+        if args.shard is not None:
+            return shards.worker_main(args)
+        return shards.supervisor_main(args)
+    metrics.start()
+    try:
+        relay = Relay(args.max_queue, args.attachments, args.compression_level,
+                      args.max_mailbox_bytes, args.max_queued_bytes, args.mailbox_ttl)
+        asyncio.run(relay.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import asyncio
+import tempfile
+import subprocess
+from collections import deque
+
+from protocol import (HELLO, MESSAGE, PRESENCE, FILE, UPLOAD, FETCH, JOIN, GROUP, ONLINE, HEADER, HEADER_SIZE,
+                      LENGTH_SIZE, FrameDecoder, ProtocolError, encode_frame, encode_ids, decode_ids)
+from relay import Relay, RelayProtocol
+import metrics
+
+RELAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "relay.py")
+# how long a new connection has to send its first frame before the supervisor drops it
+HANDOFF_TIMEOUT = 10.0
+PEEK_INTERVAL = 0.002
+# hex digits of an attachment digest used to pick the worker for a transfer
+DIGEST_PREFIX = 8
+# frames kept for a peer worker while it is down or restarting
+MAX_PENDING = 100000
+WATCH_INTERVAL = 0.5
+MAX_RESTART_DELAY = 10.0
+
+
+def connection_key(data):
+    # chat connections belong to the shard of the HELLO sender; attachment transfers are
+    # keyed by digest so two uploads of one file never race in different workers
+    kind, sender_id = HEADER.unpack_from(data)[1:3]
+    if kind == UPLOAD or kind == FETCH:
+        try:
+            return int(bytes(data[HEADER_SIZE:HEADER_SIZE + DIGEST_PREFIX]), 16)
+        except ValueError:
+            return 0
+    return sender_id
+
+
+def has_key(data):
+    if len(data) < HEADER_SIZE:
+        return False
+    kind = data[LENGTH_SIZE]
+    return (kind != UPLOAD and kind != FETCH) or len(data) >= HEADER_SIZE + DIGEST_PREFIX
+
+
+def listen(host, port, backlog=4096):
+    # one socket per address, like loop.create_server, but left to the supervisor to accept on
+    listeners = []
+    addresses = set(info[:3] + (info[4],) for info in
+                    socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE))
+    for family, kind, proto, address in addresses:
+        sock = socket.socket(family, kind, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        try:
+            sock.bind(address)
+        except OSError:
+            sock.close()
+            for listener in listeners:
+                listener.close()
+            raise
+        sock.listen(backlog)
+        sock.setblocking(False)
+        listeners.append(sock)
+    return listeners
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    # the receiving end of another worker's Link
+    def __init__(self, shards):
+        self.shards = shards
+        self.peer = None
+        self.transport = None
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.writable()
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.decoder.advance(nbytes)
+            for frame in self.decoder.frames():
+                self.shards.receive(self, frame)
+        except ProtocolError as e:
+            print(f"Dropping relay worker {self.peer}: {e}")
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.shards.peer_lost(self)
+
+
+class Link(asyncio.Protocol):
+    # outgoing frames to one other worker; reconnects on its own and buffers while the peer is away
+    def __init__(self, shards, index):
+        self.shards = shards
+        self.index = index
+        self.transport = None
+        self.closed = None
+        self.pending = deque(maxlen=MAX_PENDING)
+
+    def send(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+        else:
+            self.pending.append(data)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # a restarted peer starts empty, so it first hears who is online here and which groups
+        # exist; anything buffered meanwhile follows and is newer than that state
+        transport.write(encode_frame(HELLO, self.shards.index, self.index))
+        transport.writelines(list(self.shards.state()))
+        transport.writelines(self.pending)
+        self.pending.clear()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        path = self.shards.path(self.index)
+        delay = 0.05
+        while True:
+            self.closed = loop.create_future()
+            try:
+                await loop.create_unix_connection(lambda: self, path)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            delay = 0.05
+            await self.closed
+
+
+class Shards:
+    # cross-shard state of one worker: users connected to other workers and the links to them
+    def __init__(self, relay, index, count, runtime):
+        self.relay = relay
+        relay.shards = self
+        self.index = index
+        self.count = count
+        self.runtime = runtime
+        # users online on other workers, as announced by their PRESENCE frames
+        self.online = set()
+        self.peers = {}
+        self.links = [Link(self, i) if i != index else None for i in range(count)]
+        # conversation_id -> (members, other shards with members), recomputed when a JOIN replaces the set
+        self.group_shards = {}
+        self.tasks = []
+
+    def path(self, index):
+        return os.path.join(self.runtime, f"shard-{index}.sock")
+
+    def is_local(self, user_id):
+        return user_id % self.count == self.index
+
+    def forward(self, user_id, data):
+        # frames are views into a receive buffer, so they are copied before being queued
+        self.links[user_id % self.count].send(bytes(data))
+
+    def broadcast(self, data):
+        data = bytes(data)
+        for link in self.links:
+            if link is not None:
+                link.send(data)
+
+    def fan_out(self, conversation_id, data):
+        members = self.relay.groups[conversation_id]
+        cached = self.group_shards.get(conversation_id)
+        if cached is None or cached[0] is not members:
+            shards = {member % self.count for member in members} - {self.index}
+            cached = self.group_shards[conversation_id] = (members, shards)
+        data = bytes(data)
+        for shard in cached[1]:
+            self.links[shard].send(data)
+
+    def state(self):
+        for user_id in self.relay.routes:
+            yield encode_frame(PRESENCE, user_id, 0, ONLINE)
+        for conversation_id, members in self.relay.groups.items():
+            yield encode_frame(JOIN, 0, conversation_id, payload=encode_ids(members))
+
+    def receive(self, peer, frame):
+        # frames from a peer were checked by the worker that took them from the client
+        kind = frame.kind
+        relay = self.relay
+        if kind == MESSAGE or kind == FILE:
+            relay.deliver(frame.receiver_id, frame)
+        elif kind == GROUP:
+            relay.fan_out(frame.sender_id, frame)
+        elif kind == PRESENCE:
+            self.set_online(frame.sender_id, frame.msg_id == ONLINE)
+        elif kind == JOIN:
+            relay.groups[frame.receiver_id] = set(decode_ids(frame.payload))
+        elif kind == HELLO:
+            peer.peer = frame.sender_id
+            self.peers[frame.sender_id] = peer
+
+    def set_online(self, user_id, online):
+        if online == (user_id in self.online):
+            return
+        if online:
+            self.online.add(user_id)
+        else:
+            self.online.discard(user_id)
+        self.relay.announce(user_id, int(online))
+
+    def peer_lost(self, peer):
+        # a worker that died took its connections with it; a newer link from its replacement wins
+        if peer.peer is None or self.peers.get(peer.peer) is not peer:
+            return
+        del self.peers[peer.peer]
+        for user_id in [user_id for user_id in self.online if user_id % self.count == peer.peer]:
+            self.set_online(user_id, False)
+
+    def adopt(self, channel):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                _, fds, _, _ = socket.recv_fds(channel, 1, 1)
+            except BlockingIOError:
+                return
+            for fd in fds:
+                sock = socket.socket(fileno=fd)
+                self.tasks.append(loop.create_task(
+                    loop.connect_accepted_socket(lambda: RelayProtocol(self.relay), sock)))
+            self.tasks = [task for task in self.tasks if not task.done()]
+
+    async def serve(self, handoff):
+        loop = asyncio.get_running_loop()
+        path = self.path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await loop.create_unix_server(lambda: PeerProtocol(self), path)
+        links = [loop.create_task(link.run()) for link in self.links if link is not None]
+        channel = socket.socket(fileno=handoff)
+        channel.setblocking(False)
+        loop.add_reader(channel.fileno(), self.adopt, channel)
+        parent = os.getppid()
+        async with server:
+            # the supervisor owns the listening socket; without it there is nothing left to serve
+            while os.getppid() == parent:
+                await asyncio.sleep(1)
+        for task in links:
+            task.cancel()
+
+
+class Worker:
+    def __init__(self, index, proc, channel, delay):
+        self.index = index
+        self.proc = proc
+        self.channel = channel
+        self.delay = delay
+        self.started = time.monotonic()
+        self.restart_at = None
+        # one handoff at a time waits for room in the channel, since a fd takes a single writer callback
+        self.sending = asyncio.Lock()
+
+
+class Supervisor:
+    # accepts every connection, reads just enough of its first frame to know whose it is and
+    # passes the socket to that user's worker, so a connection, its mailbox and its acks stay
+    # in one process and only traffic between workers crosses a Unix socket
+    def __init__(self, count, max_queue, attachments, compression, max_mailbox_bytes, max_queued_bytes, mailbox_ttl):
+        self.count = count
+        # the global cap is split between the workers, since each holds its own users' mailboxes
+        self.worker_args = ["--max-queue", str(max_queue), "--attachments", attachments,
+                            "--compression-level", str(compression), "--max-mailbox-bytes", str(max_mailbox_bytes),
+                            "--max-queued-bytes", str(max_queued_bytes // count), "--mailbox-ttl", str(mailbox_ttl)]
+        self.runtime = tempfile.mkdtemp(prefix="relay-")
+        self.workers = []
+        self.tasks = set()
+
+    def spawn(self, index, delay=0.0):
+        channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        with child:
+            proc = subprocess.Popen([sys.executable, RELAY_SCRIPT, "--workers", str(self.count),
+                                     "--shard", str(index), "--runtime", self.runtime,
+                                     "--handoff", str(child.fileno()), *self.worker_args],
+                                    pass_fds=(child.fileno(),))
+        channel.setblocking(False)
+        return Worker(index, proc, channel, delay)
+
+    async def peek(self, conn):
+        deadline = time.monotonic() + HANDOFF_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                data = conn.recv(HEADER_SIZE + DIGEST_PREFIX, socket.MSG_PEEK)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                return None
+            if data == b"":
+                return None
+            if data and has_key(data):
+                return data
+            await asyncio.sleep(PEEK_INTERVAL)
+        return None
+
+    async def hand_off(self, conn):
+        with conn:
+            # peeked, not read: the worker gets the stream exactly as the client sent it
+            data = await self.peek(conn)
+            if data is None:
+                return
+            worker = self.workers[connection_key(data) % self.count]
+            try:
+                await self.send_fd(worker, conn)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Relay worker {worker.index} unavailable: {e!r}")
+
+    async def send_fd(self, worker, conn):
+        loop = asyncio.get_running_loop()
+        async with worker.sending:
+            deadline = loop.time() + HANDOFF_TIMEOUT
+            while True:
+                try:
+                    socket.send_fds(worker.channel, [b"c"], [conn.fileno()])
+                    return
+                except BlockingIOError:
+                    pass
+                # the worker is behind on adopting connections; wait for room without stalling the loop
+                ready = loop.create_future()
+                fd = worker.channel.fileno()
+                loop.add_writer(fd, lambda: ready.done() or ready.set_result(None))
+                try:
+                    await asyncio.wait_for(ready, deadline - loop.time())
+                finally:
+                    loop.remove_writer(fd)
+
+    async def accept(self, listener):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                conn, _ = await loop.sock_accept(listener)
+            except OSError as e:
+                print(f"Accept error: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            task = loop.create_task(self.hand_off(conn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            now = time.monotonic()
+            for index, worker in enumerate(self.workers):
+                if worker.proc.poll() is None:
+                    continue
+                if worker.restart_at is None:
+                    # a worker that keeps dying right after it starts is restarted less and less often
+                    if now - worker.started < 5:
+                        worker.delay = min(max(worker.delay * 2, 0.5), MAX_RESTART_DELAY)
+                    else:
+                        worker.delay = 0.0
+                    worker.restart_at = now + worker.delay
+                    print(f"Relay worker {index} exited with code {worker.proc.returncode}, "
+                          f"restarting in {worker.delay:g}s")
+                if now >= worker.restart_at:
+                    worker.channel.close()
+                    self.workers[index] = self.spawn(index, worker.delay)
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        listeners = listen(host, port)
+        self.workers = [self.spawn(index) for index in range(self.count)]
+        stop = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+        tasks = [loop.create_task(self.accept(listener)) for listener in listeners]
+        tasks.append(loop.create_task(self.watch()))
+        try:
+            await stop
+        finally:
+            for task in tasks:
+                task.cancel()
+            for listener in listeners:
+                listener.close()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.proc.poll() is None:
+                worker.proc.terminate()
+        for worker in self.workers:
+            try:
+                worker.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                worker.proc.kill()
+                worker.proc.wait()
+            worker.channel.close()
+        shutil.rmtree(self.runtime, ignore_errors=True)
+
+
+def supervisor_main(args):
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket, "send_fds"):
+        print("--workers needs Unix domain sockets; run a single relay instead")
+        return 1
+    supervisor = Supervisor(args.workers, args.max_queue, args.attachments, args.compression_level,
+                            args.max_mailbox_bytes, args.max_queued_bytes, args.mailbox_ttl)
+    try:
+        asyncio.run(supervisor.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+def worker_main(args):
+    metrics.start(args.shard)
+    relay = Relay(args.max_queue, args.attachments, args.compression_level,
+                  args.max_mailbox_bytes, args.max_queued_bytes, args.mailbox_ttl)
+    shards = Shards(relay, args.shard, args.workers, args.runtime)
+    try:
+        asyncio.run(shards.serve(args.handoff))
+    except KeyboardInterrupt:
+        pass